@@ -19,8 +19,13 @@ Not implemented yet:
       - placeholders are ignored
 """
 
+import atexit
+import binascii
+import collections
 import ConfigParser
+import contextlib
 import errno
+import fcntl
 import grp
 import hashlib
 import json
@@ -28,24 +33,34 @@ import logging
 import os
 import os.path
 import pwd
-try:
-    import rpmUtils.miscutils as rpmutils
-    import rpmUtils.updates as rpmupdates
-    rpmutils_present = True
-except ImportError:
-    rpmutils_present = False
+import random
 import re
+import select
+import signal
+import stat
 import subprocess
+import tempfile
+import threading
+import time
 
 # Override BOTO_CONFIG, which makes boto look only at the specified
 # config file, instead of the default locations
 os.environ['BOTO_CONFIG'] = '/var/lib/heat-cfntools/cfn-boto-cfg'
-from boto.cloudformation import CloudFormationConnection
 
 
 LOG = logging.getLogger(__name__)
 
 
+def cloudformation_connection_class():
+    '''
+    Return boto's CloudFormationConnection, importing boto on first use
+    so that tools which never talk to the metadata server do not pay for
+    loading it
+    '''
+    from boto.cloudformation import CloudFormationConnection
+    return CloudFormationConnection
+
+
 def to_boolean(b):
     val = b.lower().strip() if isinstance(b, basestring) else b
     return val in [True, 'true', 'yes', '1', 1]
@@ -67,7 +82,122 @@ def parse_creds_file(path='/etc/cfn/cfn-credentials'):
     return creds
 
 
+def metadata_digest(metadata):
+    """
+    Return an md5 hex digest of some metadata which does not depend on the
+    ordering of its keys.
+    """
+    return hashlib.md5(json.dumps(metadata, sort_keys=True)).hexdigest()
+
+
+def metadata_diff(old, new, depth=3):
+    """
+    Return the key paths (tuples of keys, at most depth keys long) under
+    which two metadata trees differ. An empty tuple means the trees differ
+    at the top level, e.g. because one of them is not a dict.
+
+    With the default depth, paths in resource metadata stop at the config
+    sections, e.g. ('AWS::CloudFormation::Init', 'config', 'files').
+    """
+    if old == new:
+        return []
+    if depth == 0 or not (isinstance(old, dict) and isinstance(new, dict)):
+        return [()]
+    changes = []
+    for key in sorted(set(old) | set(new)):
+        if key not in old or key not in new:
+            changes.append((key,))
+        else:
+            changes.extend((key,) + path for path in
+                           metadata_diff(old[key], new[key], depth - 1))
+    return changes
+
+
+def write_file_atomic(path, content, mode=0600):
+    """
+    Write content to path via a temporary file in the same directory, which
+    is then renamed into place so that readers never see a partial file.
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname or '.',
+                                    prefix='.%s.' % basename)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _syncfs(path):
+    """
+    Flush the filesystem holding path to disk with syncfs().
+
+    Returns False if syncfs() is not available or failed.
+    """
+    import ctypes
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (AttributeError, OSError):
+        return False
+    syncfs.argtypes = [ctypes.c_int]
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if syncfs(fd) != 0:
+            LOG.debug("syncfs failed: %s" % os.strerror(ctypes.get_errno()))
+            return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def sync_files(paths):
+    """
+    Flush the data of the files at paths to disk, with one syncfs() for
+    each filesystem they are on where syncfs() is available, and one
+    fsync() for each file where it is not.
+    """
+    filesystems = {}
+    for path in paths:
+        filesystems.setdefault(os.stat(path).st_dev, []).append(path)
+    unsynced = []
+    for dev_paths in filesystems.values():
+        if not _syncfs(dev_paths[0]):
+            unsynced.extend(dev_paths)
+    for path in unsynced:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def sync_dirs(dirs):
+    """
+    Flush the entries of the directories dirs, such as renames into them,
+    to disk.
+    """
+    for path in set(dirs):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            LOG.debug(str(e))
+            continue
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            # some filesystems cannot sync directories
+            LOG.debug(str(e))
+        finally:
+            os.close(fd)
+
+
 class HupConfig(object):
+    # fraction of the interval by which each poll is randomly offset
+    jitter = 0.1
+
     def __init__(self, fp_list):
         self.config = ConfigParser.SafeConfigParser()
         for fp in fp_list:
@@ -83,7 +213,8 @@ class HupConfig(object):
                     self.config.get(s, 'triggers'),
                     self.config.get(s, 'path'),
                     self.config.get(s, 'runas'),
-                    self.config.get(s, 'action')))
+                    self.config.get(s, 'action'),
+                    in_process=self.in_process_hooks))
 
     def load_main_section(self):
         # required values
@@ -107,10 +238,33 @@ class HupConfig(object):
         except ConfigParser.NoOptionError:
             self.interval = 10
 
+        try:
+            self.concurrency = self.config.getint('main', 'concurrency')
+        except ConfigParser.NoOptionError:
+            self.concurrency = 4
+
+        try:
+            self.in_process_hooks = self.config.getboolean(
+                'main', 'in-process-hooks')
+        except ConfigParser.NoOptionError:
+            self.in_process_hooks = False
+
     def __str__(self):
         return '{stack: %s, credential_file: %s, region: %s, interval:%d}' % \
             (self.stack, self.credential_file, self.region, self.interval)
 
+    def poll_delay(self):
+        """
+        Return the number of seconds to wait before the next poll.
+
+        The interval is configured in minutes and is randomly offset by up
+        to `jitter` of its length, so that instances started together do
+        not all poll the metadata server at the same moment.
+        """
+        delay = self.interval * 60
+        spread = delay * self.jitter
+        return max(0, delay + random.uniform(-spread, spread))
+
     def unique_resources_get(self):
         resources = []
         for h in self.hooks:
@@ -120,26 +274,94 @@ class HupConfig(object):
         return resources
 
 
+# cfn-* tools which a hook may run inside the calling process, by name;
+# filled in by heat_cfntools.cfntools.cli
+in_process_tools = {}
+
+# anything but these characters means the action needs a shell
+_shell_syntax_re = re.compile(r'[^\w@%+=:,./ -]')
+
+
 class Hook(object):
-    def __init__(self, name, triggers, path, runas, action):
+    def __init__(self, name, triggers, path, runas, action,
+                 in_process=False):
         self.name = name
         self.triggers = triggers
         self.path = path
         self.runas = runas
         self.action = action
+        self.in_process = in_process
 
     def resource_name_get(self):
         sp = self.path.split('.')
         return sp[1]
 
-    def event(self, ev_name, ev_object, ev_resource):
+    def path_matches(self, changed_paths):
+        """
+        Indicates whether any of the changed metadata paths (dotted, in the
+        same form as the hook path) is at, above or below the hook path.
+        """
+        for changed in changed_paths:
+            if changed == self.path or \
+                    changed.startswith(self.path + '.') or \
+                    self.path.startswith(changed + '.'):
+                return True
+        return False
+
+    def event(self, ev_name, ev_object, ev_resource, changed_paths=None):
+        """
+        Run the hook action if it is triggered by the event. If
+        changed_paths is given, the hook is only run if one of them
+        matches the hook path.
+        """
         if self.resource_name_get() == ev_resource and \
-                ev_name in self.triggers:
-            CommandRunner(self.action).run(user=self.runas)
+                ev_name in self.triggers and \
+                (changed_paths is None or self.path_matches(changed_paths)):
+            if not self._run_in_process():
+                CommandRunner(self.action).run(user=self.runas)
         else:
             LOG.debug('event: {%s, %s, %s} did not match %s' %
                       (ev_name, ev_object, ev_resource, self.__str__()))
 
+    def _run_in_process(self):
+        """
+        Run the action inside this process if it is a plain invocation of
+        one of in_process_tools as the current user, saving the start-up
+        of a new interpreter. Returns whether the action was run.
+        """
+        argv = self.action.split()
+        if not self.in_process or not argv or \
+                _shell_syntax_re.search(self.action):
+            return False
+        tool = in_process_tools.get(os.path.basename(argv[0]))
+        if tool is None or \
+                self.runas != pwd.getpwuid(os.geteuid()).pw_name:
+            return False
+
+        LOG.debug("Running hook %s in process: %s" % (self.name,
+                                                      self.action))
+        # the tools set up their own logging; keep it out of this process
+        loggers = [logging.getLogger(), logging.getLogger('cfntools')]
+        saved = [(l, l.level, list(l.handlers)) for l in loggers]
+        try:
+            status = tool(argv[1:])
+        except SystemExit as ex:
+            status = ex.code
+        except Exception:
+            LOG.exception("Error running hook %s" % self.name)
+            return True
+        finally:
+            for logger, level, handlers in saved:
+                for handler in list(logger.handlers):
+                    if handler not in handlers:
+                        logger.removeHandler(handler)
+                        handler.close()
+                logger.setLevel(level)
+        if status:
+            LOG.debug("Return code of %s after executing: '%s'" % (
+                status, self.action))
+        return True
+
     def __str__(self):
         return '{%s, %s, %s, %s, %s}' % \
             (self.name,
@@ -149,21 +371,80 @@ class Hook(object):
              self.action)
 
 
+class OutputBuffer(object):
+    """
+    Keeps the first and the last limit bytes written to it, and a count of
+    all the bytes written, so that the memory held for the output of a
+    command does not grow with the amount of output.
+    """
+
+    def __init__(self, limit=65536):
+        self.limit = limit
+        self.total = 0
+        self._head = []
+        self._head_len = 0
+        self._tail = collections.deque()
+        self._tail_len = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if self._head_len < self.limit:
+            part = data[:self.limit - self._head_len]
+            self._head.append(part)
+            self._head_len += len(part)
+            data = data[len(part):]
+        if data:
+            self._tail.append(data)
+            self._tail_len += len(data)
+            while self._tail_len - len(self._tail[0]) >= self.limit:
+                self._tail_len -= len(self._tail.popleft())
+
+    def getvalue(self):
+        head = ''.join(self._head)
+        tail = ''.join(self._tail)
+        omitted = self.total - len(head) - min(len(tail), self.limit)
+        if omitted <= 0:
+            return head + tail
+        return '%s\n[... %d bytes omitted ...]\n%s' % (
+            head, omitted, tail[-self.limit:])
+
+
+# Popen is serialised so that a command started from one thread does not
+# inherit the write end of another command's output pipe, which would keep
+# that pipe from reaching EOF until both commands had exited
+_popen_lock = threading.Lock()
+
+
 class CommandRunner(object):
     """
     Helper class to run a command and store the output.
+
+    The command is either a string, which is run by the user's shell, or a
+    list of arguments, which is executed directly without a shell.
     """
 
+    # bytes kept from each end of the output of a streamed command
+    output_limit = 65536
+    # seconds after which a command is killed, or None to wait forever
+    default_timeout = None
+    # whether commands run with shared_shell go to a ShellWorker
+    use_shell_workers = False
+
     def __init__(self, command, nextcommand=None):
         self._command = command
         self._next = nextcommand
         self._stdout = None
         self._stderr = None
+        self._stdout_bytes = None
+        self._stderr_bytes = None
         self._status = None
+        self._timed_out = False
+        self._start_time = None
+        self._end_time = None
 
     def __str__(self):
         s = "CommandRunner:"
-        s += "\n\tcommand: %s" % self._command
+        s += "\n\tcommand: %s" % self.command_str
         if self._status:
             s += "\n\tstatus: %s" % self.status
         if self._stdout:
@@ -172,25 +453,179 @@ class CommandRunner(object):
             s += "\n\tstderr: %s" % self.stderr
         return s
 
-    def run(self, user='root', cwd=None, env=None):
+    @property
+    def command_str(self):
+        if isinstance(self._command, basestring):
+            return self._command
+        import pipes
+        return ' '.join(pipes.quote(arg) for arg in self._command)
+
+    def _user_command(self, user, env):
+        """
+        Work out how to run the command as user: directly when this process
+        already runs as user, switching to user in the child when this
+        process runs as root, and through su otherwise.
+
+        Returns:
+            (argv, extra keyword arguments for Popen)
+        """
+        try:
+            pw = pwd.getpwnam(user)
+        except KeyError:
+            pw = None
+        euid = os.geteuid()
+        if pw is None or (pw.pw_uid != euid and euid != 0):
+            return ['su', user, '-c', self.command_str], {'env': env}
+
+        if isinstance(self._command, basestring):
+            cmd = [pw.pw_shell or '/bin/sh', '-c', self._command]
+        else:
+            cmd = list(self._command)
+        if pw.pw_uid == euid:
+            return cmd, {'env': env}
+
+        # the environment su would give the command
+        env = dict(os.environ if env is None else env)
+        env.update({'HOME': pw.pw_dir, 'SHELL': pw.pw_shell or '/bin/sh',
+                    'USER': pw.pw_name, 'LOGNAME': pw.pw_name})
+        groups = [g.gr_gid for g in grp.getgrall() if user in g.gr_mem]
+
+        def switch_user():
+            os.setgroups(groups + [pw.pw_gid])
+            os.setgid(pw.pw_gid)
+            os.setuid(pw.pw_uid)
+
+        return cmd, {'env': env, 'preexec_fn': switch_user}
+
+    def _stream(self, subproc):
+        """
+        Read the output of subproc as it is produced, logging each line and
+        keeping only a bounded amount of it.
+        """
+        stdout = OutputBuffer(self.output_limit)
+        stderr = OutputBuffer(self.output_limit)
+
+        def pump(pipe, output, name):
+            for line in iter(lambda: pipe.readline(8192), ''):
+                output.write(line)
+                LOG.debug("%s: %s" % (name, line.rstrip('\n')))
+            pipe.close()
+
+        # stderr is read in a thread so that neither pipe can fill up and
+        # block the command while the other one is being read
+        reader = threading.Thread(target=pump,
+                                  args=(subproc.stderr, stderr, 'stderr'))
+        reader.daemon = True
+        reader.start()
+        pump(subproc.stdout, stdout, 'stdout')
+        reader.join()
+        subproc.wait()
+        return stdout, stderr
+
+    def _start_timer(self, subproc, timeout):
+        """
+        Kill the process group of subproc if it is still running after
+        timeout seconds.
+        """
+        def expire():
+            if subproc.returncode is not None:
+                return
+            LOG.warn("Command timed out after %ss, killing it: %s" %
+                     (timeout, self.command_str))
+            self._timed_out = True
+            try:
+                os.killpg(subproc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def run(self, user='root', cwd=None, env=None, stream=False,
+            timeout=None, shared_shell=False):
         """
         Run the Command and return the output.
 
+        If stream is set, the output is logged line by line as the command
+        runs, and only the first and last output_limit bytes of each of
+        stdout and stderr are kept.
+
+        If the command is still running after timeout seconds (default
+        default_timeout), it is killed together with any processes it
+        started.
+
+        If shared_shell is set and use_shell_workers is enabled, a command
+        which needs neither env, stream nor timeout is run by the
+        ShellWorker for user and cwd instead of a shell of its own.
+
         Returns:
             self
         """
-        LOG.debug("Running command: %s" % self._command)
-        cmd = ['su', user, '-c', self._command]
-        subproc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE, cwd=cwd, env=env)
-        output = subproc.communicate()
+        if timeout is None:
+            timeout = self.default_timeout
+        if (shared_shell and self.use_shell_workers and env is None and
+                not stream and not timeout):
+            return self._run_shared(user, cwd)
+        LOG.debug("Running command: %s" % self.command_str)
+        cmd, kwargs = self._user_command(user, env)
+        if timeout:
+            # run the command in its own process group, so that the whole
+            # group can be killed when it times out
+            preexec_fn = kwargs.get('preexec_fn')
+
+            def new_session():
+                os.setsid()
+                if preexec_fn:
+                    preexec_fn()
+            kwargs['preexec_fn'] = new_session
+
+        self._timed_out = False
+        self._start_time = time.time()
+        with _popen_lock:
+            subproc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, cwd=cwd,
+                                       **kwargs)
+        timer = None
+        if timeout:
+            timer = self._start_timer(subproc, timeout)
+        try:
+            if stream:
+                stdout, stderr = self._stream(subproc)
+                self._stdout = stdout.getvalue()
+                self._stderr = stderr.getvalue()
+                self._stdout_bytes = stdout.total
+                self._stderr_bytes = stderr.total
+            else:
+                self._stdout, self._stderr = subproc.communicate()
+                self._stdout_bytes = len(self._stdout or '')
+                self._stderr_bytes = len(self._stderr or '')
+        finally:
+            if timer:
+                timer.cancel()
+        self._end_time = time.time()
 
         self._status = subproc.returncode
-        self._stdout = output[0]
-        self._stderr = output[1]
+        return self._finish()
+
+    def _run_shared(self, user, cwd):
+        LOG.debug("Running command in shell worker: %s" % self.command_str)
+        self._timed_out = False
+        self._start_time = time.time()
+        self._status, self._stdout, self._stderr = ShellWorker.get(
+            user, cwd).run(self.command_str)
+        self._end_time = time.time()
+        self._stdout_bytes = len(self._stdout)
+        self._stderr_bytes = len(self._stderr)
+        return self._finish()
+
+    def _finish(self):
+        LOG.debug("Command finished in %.3fs: %s" % (self.duration,
+                                                     self.command_str))
         if self._status:
             LOG.debug("Return code of %d after executing: '%s'" % (
-                self._status, cmd))
+                self._status, self.command_str))
         if self._next:
             self._next.run()
         return self
@@ -203,22 +638,292 @@ class CommandRunner(object):
     def stderr(self):
         return self._stderr
 
+    @property
+    def timed_out(self):
+        """Whether the command was killed for running past its timeout."""
+        return self._timed_out
+
+    @property
+    def start_time(self):
+        return self._start_time
+
+    @property
+    def end_time(self):
+        return self._end_time
+
+    @property
+    def duration(self):
+        """The wall-clock seconds the command ran for."""
+        if self._start_time is None or self._end_time is None:
+            return None
+        return self._end_time - self._start_time
+
+    @property
+    def stdout_bytes(self):
+        """The number of bytes the command wrote to stdout."""
+        return self._stdout_bytes
+
+    @property
+    def stderr_bytes(self):
+        """The number of bytes the command wrote to stderr."""
+        return self._stderr_bytes
+
     @property
     def status(self):
         return self._status
 
 
+class ShellWorker(object):
+    """
+    A shell kept running as one user in one directory, which runs the
+    commands written to it one at a time, so that many small commands cost
+    one shell start-up rather than one each.
+
+    Each command runs in a subshell with stdin from /dev/null, so that it
+    cannot change the directory or environment of the commands after it.
+    Its exit status and the end of its output are marked on stdout and
+    stderr with a marker chosen at random for each command.
+    """
+
+    _workers = {}
+    _workers_lock = threading.Lock()
+    _atexit_registered = False
+
+    def __init__(self, user='root', cwd=None):
+        self.user = user
+        self.cwd = cwd
+        self._lock = threading.Lock()
+        self._proc = None
+
+    @classmethod
+    def get(cls, user='root', cwd=None):
+        """
+        Returns the worker for user and cwd, creating it if needed.
+        """
+        with cls._workers_lock:
+            worker = cls._workers.get((user, cwd))
+            if worker is None:
+                worker = cls._workers[(user, cwd)] = cls(user, cwd)
+                if not cls._atexit_registered:
+                    atexit.register(cls.close_all)
+                    cls._atexit_registered = True
+            return worker
+
+    @classmethod
+    def close_all(cls):
+        """
+        Stops all workers; the next get() starts a new one.
+        """
+        with cls._workers_lock:
+            workers = cls._workers.values()
+            cls._workers.clear()
+        for worker in workers:
+            worker.close()
+
+    def _start(self):
+        try:
+            shell = pwd.getpwnam(self.user).pw_shell or '/bin/sh'
+        except KeyError:
+            shell = '/bin/sh'
+        cmd, kwargs = CommandRunner([shell, '-s'])._user_command(self.user,
+                                                                 None)
+        LOG.debug("Starting shell worker for %s in %s" % (self.user,
+                                                          self.cwd))
+        with _popen_lock:
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          cwd=self.cwd, **kwargs)
+
+    def _stop(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+    def close(self):
+        with self._lock:
+            self._stop()
+
+    def _read(self, marker):
+        """
+        Read the output of the current command up to its markers.
+
+        Returns:
+            (status, stdout, stderr)
+        """
+        out_fd = self._proc.stdout.fileno()
+        err_fd = self._proc.stderr.fileno()
+        ends = {out_fd: '\n%s ' % marker, err_fd: '\n%s\n' % marker}
+        output = {out_fd: '', err_fd: ''}
+        found = {}
+        status = None
+        while status is None or err_fd not in found:
+            pending = [fd for fd in (out_fd, err_fd) if fd not in found or
+                       (fd == out_fd and status is None)]
+            for fd in select.select(pending, [], [])[0]:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise EOFError()
+                start = max(0, len(output[fd]) - len(ends[fd]))
+                output[fd] += data
+                if fd not in found:
+                    index = output[fd].find(ends[fd], start)
+                    if index >= 0:
+                        found[fd] = index
+                if fd == out_fd and out_fd in found:
+                    rest = output[fd][found[fd] + len(ends[fd]):]
+                    if rest.endswith('\n'):
+                        status = int(rest)
+        return (status, output[out_fd][:found[out_fd]],
+                output[err_fd][:found[err_fd]])
+
+    def run(self, command):
+        """
+        Run the shell command and wait for it to finish.
+
+        Returns:
+            (status, stdout, stderr), with a status of -1 if the worker
+            died while running the command
+        """
+        import pipes
+        with self._lock:
+            if self._proc is None:
+                self._start()
+            marker = 'cfn-worker-%s' % binascii.hexlify(os.urandom(8))
+            script = ("( eval %s\n) </dev/null\n"
+                      "printf '\\n%s %%d\\n' $?\n"
+                      "printf '\\n%s\\n' >&2\n" %
+                      (pipes.quote(command), marker, marker))
+            try:
+                self._proc.stdin.write(script)
+                self._proc.stdin.flush()
+                return self._read(marker)
+            except (EOFError, IOError, OSError):
+                LOG.warn("Shell worker for %s exited while running: %s" %
+                         (self.user, command))
+                self._stop()
+                return -1, '', 'shell worker exited\n'
+
+
+_rpm_segment_re = re.compile('~|[0-9]+|[a-zA-Z]+')
+
+
 class RpmHelper(object):
 
-    if rpmutils_present:
-        _rpm_util = rpmupdates.Updates([], [])
+    # seconds for which the yum cache is reused after a makecache
+    cache_ttl = 3600
+    cache_stamp = '/var/lib/heat-cfntools/yum-makecache'
+    cache_dir = '/var/cache/yum'
+    repo_configs = ['/etc/yum.conf', '/etc/yum.repos.d']
 
     @classmethod
-    def prepcache(cls):
+    def _cache_stale(cls, ttl):
         """
-        Prepare the yum cache
+        Returns the reason the yum cache needs to be remade, or None if it
+        is fresh.
         """
-        CommandRunner("yum -y makecache").run()
+        try:
+            made = os.path.getmtime(cls.cache_stamp)
+        except OSError:
+            return "no previous makecache"
+        if not os.path.isdir(cls.cache_dir):
+            return "%s is missing" % cls.cache_dir
+        age = time.time() - made
+        if age > ttl:
+            return "made %d seconds ago" % age
+
+        paths = []
+        for path in cls.repo_configs:
+            paths.append(path)
+            if os.path.isdir(path):
+                paths.extend(os.path.join(path, f) for f in os.listdir(path))
+        for path in paths:
+            try:
+                if os.path.getmtime(path) > made:
+                    return "%s has changed" % path
+            except OSError:
+                pass
+        return None
+
+    @classmethod
+    def prepcache(cls, ttl=None):
+        """
+        Prepare the yum cache, unless it was prepared less than ttl seconds
+        (default cache_ttl) ago and the yum configuration has not changed
+        since.
+        """
+        if ttl is None:
+            ttl = cls.cache_ttl
+        reason = cls._cache_stale(ttl)
+        if reason is None:
+            LOG.info("Yum cache is fresh, skipping makecache")
+            return
+        LOG.info("Preparing yum cache: %s" % reason)
+        command = CommandRunner(['yum', '-y', 'makecache']).run()
+        if command.status:
+            LOG.warn("Failed to prepare yum cache")
+            return
+        try:
+            with open(cls.cache_stamp, 'w'):
+                pass
+        except IOError as e:
+            LOG.warn("Unable to record yum makecache: %s" % e)
+
+    # parsed version keys, cached by version string
+    _version_keys = {}
+    _version_keys_max = 4096
+
+    @staticmethod
+    def _rpmvercmp_key(s):
+        """
+        Returns a tuple which orders like rpmvercmp() orders strings:
+        alphabetic and numeric segments are compared in turn, numeric
+        segments being newer than alphabetic ones, and a '~' sorting before
+        anything, even the end of the string.
+        """
+        key = []
+        for segment in _rpm_segment_re.findall(s):
+            if segment == '~':
+                key.append((0,))
+            elif segment.isdigit():
+                key.append((3, int(segment)))
+            else:
+                key.append((2, segment))
+        key.append((1,))
+        return tuple(key)
+
+    @classmethod
+    def rpm_version_key(cls, v):
+        """
+        Returns a sort key for an RPM [epoch:]version[-release] string,
+        ordering versions as rpmUtils.miscutils.compareVerOnly does.
+        Keys are cached, so repeated comparisons of the same versions only
+        parse them once.
+        """
+        try:
+            return cls._version_keys[v]
+        except KeyError:
+            pass
+
+        epoch, sep, rest = v.partition(':')
+        if not sep:
+            epoch, rest = '0', v
+        version, sep, release = rest.partition('-')
+        key = (cls._rpmvercmp_key(epoch),
+               cls._rpmvercmp_key(version),
+               cls._rpmvercmp_key(release))
+
+        if len(cls._version_keys) >= cls._version_keys_max:
+            cls._version_keys.clear()
+        cls._version_keys[v] = key
+        return key
 
     @classmethod
     def compare_rpm_versions(cls, v1, v2):
@@ -235,7 +940,7 @@ class RpmHelper(object):
            -1 -- v2 is greater
         """
         if v1 and v2:
-            return rpmutils.compareVerOnly(v1, v2)
+            return cmp(cls.rpm_version_key(v1), cls.rpm_version_key(v2))
         elif v1:
             return 1
         elif v2:
@@ -255,9 +960,7 @@ class RpmHelper(object):
         if versions:
             if isinstance(versions, basestring):
                 return versions
-            versions = sorted(versions, rpmutils.compareVerOnly,
-                              reverse=True)
-            return versions[0]
+            return max(versions, key=cls.rpm_version_key)
         else:
             return None
 
@@ -269,10 +972,46 @@ class RpmHelper(object):
         Arguments:
             pkg -- A package name
         """
-        cmd = "rpm -q --queryformat '%{VERSION}-%{RELEASE}' %s" % pkg
+        cmd = ['rpm', '-q', '--queryformat', '%{VERSION}-%{RELEASE}', pkg]
         command = CommandRunner(cmd).run()
         return command.stdout
 
+    @classmethod
+    def rpm_installed_packages(cls):
+        """
+        Returns an index of the installed RPMs, built from a single query of
+        the rpm database, which maps each package name to a list of its
+        installed version-release strings.
+        """
+        cmd = ['rpm', '-qa', '--queryformat',
+               '%{NAME} %{VERSION}-%{RELEASE}\\n']
+        command = CommandRunner(cmd).run()
+        index = {}
+        for line in (command.stdout or '').splitlines():
+            fields = line.split()
+            if len(fields) == 2:
+                index.setdefault(fields[0], []).append(fields[1])
+        return index
+
+    @classmethod
+    def rpm_version_match(cls, versions, ver=None):
+        """
+        Indicates whether a version of a package is among a list of its
+        versions, as found in the indexes returned by rpm_installed_packages
+        and yum_available_packages.
+
+        Arguments:
+            versions -- a list of version-release strings
+            ver -- a version (e.g. 2.2.22) or version-release
+                   (e.g. 2.2.22-1.fc16), or None to match any version
+        """
+        if not ver:
+            return bool(versions)
+        for version in versions:
+            if version == ver or version.startswith(ver + '-'):
+                return True
+        return False
+
     @classmethod
     def rpm_package_installed(cls, pkg):
         """
@@ -284,7 +1023,7 @@ class RpmHelper(object):
                    e.g., httpd-2.2.22
                    e.g., httpd-2.2.22-1.fc16
         """
-        command = CommandRunner("rpm -q %s" % pkg).run()
+        command = CommandRunner(['rpm', '-q', pkg]).run()
         return command.status == 0
 
     @classmethod
@@ -298,10 +1037,41 @@ class RpmHelper(object):
                    e.g., httpd-2.2.22
                    e.g., httpd-2.2.22-1.fc16
         """
-        cmd_str = "yum -C -y --showduplicates list available %s" % pkg
-        command = CommandRunner(cmd_str).run()
+        cmd = ['yum', '-C', '-y', '--showduplicates', 'list', 'available',
+               pkg]
+        command = CommandRunner(cmd).run()
         return command.status == 0
 
+    @classmethod
+    def yum_available_packages(cls, pkgs):
+        """
+        Returns an index of the packages available via yum, built from a
+        single yum query for all of pkgs, which maps each package name to a
+        list of its available version-release strings.
+
+        Arguments:
+            pkgs -- A list of package names (with optional version and
+                    release spec).
+                    e.g., ['httpd', 'mysql-5.5.31', 'wget-1.14-5.fc19']
+        """
+        if not pkgs:
+            return {}
+        cmd = ['yum', '-C', '-y', '--showduplicates', 'list', 'available']
+        command = CommandRunner(cmd + sorted(pkgs)).run()
+        index = {}
+        if command.status != 0 or not command.stdout:
+            return index
+
+        # "name.arch [epoch:]version-release repo" entries follow the
+        # header, wrapped over several lines when the name is long
+        output = command.stdout.split('Available Packages', 1)[-1]
+        fields = output.split()
+        for i in range(0, len(fields) - 2, 3):
+            name = fields[i].rsplit('.', 1)[0]
+            version = fields[i + 1].split(':')[-1]
+            index.setdefault(name, []).append(version)
+        return index
+
     @classmethod
     def install(cls, packages, rpms=True):
         """
@@ -319,18 +1089,20 @@ class RpmHelper(object):
                           - pkg name with version spec (httpd-2.2.22), or
                           - pkg name with version-release spec
                             (httpd-2.2.22-1.fc16)
+
+        Returns:
+            whether the install succeeded
         """
         if rpms:
-            cmd = "rpm -U --force --nosignature "
-            cmd += " ".join(packages)
-            LOG.info("Installing packages: %s" % cmd)
+            cmd = ['rpm', '-U', '--force', '--nosignature'] + list(packages)
         else:
-            cmd = "yum -y install "
-            cmd += " ".join(packages)
-            LOG.info("Installing packages: %s" % cmd)
-        command = CommandRunner(cmd).run()
+            cmd = ['yum', '-y', 'install'] + list(packages)
+        command = CommandRunner(cmd)
+        LOG.info("Installing packages: %s" % command.command_str)
+        command.run(stream=True)
         if command.status:
-            LOG.warn("Failed to install packages: %s" % cmd)
+            LOG.warn("Failed to install packages: %s" % command.command_str)
+        return not command.status
 
     @classmethod
     def downgrade(cls, packages, rpms=True):
@@ -348,16 +1120,18 @@ class RpmHelper(object):
                           - pkg name with version spec (httpd-2.2.22), or
                           - pkg name with version-release spec
                             (httpd-2.2.22-1.fc16)
+
+        Returns:
+            whether the downgrade succeeded
         """
         if rpms:
-            cls.install(packages)
-        else:
-            cmd = "yum -y downgrade "
-            cmd += " ".join(packages)
-            LOG.info("Downgrading packages: %s" % cmd)
-            command = CommandRunner(cmd).run()
-            if command.status:
-                LOG.warn("Failed to downgrade packages: %s" % cmd)
+            return cls.install(packages)
+        command = CommandRunner(['yum', '-y', 'downgrade'] + list(packages))
+        LOG.info("Downgrading packages: %s" % command.command_str)
+        command.run(stream=True)
+        if command.status:
+            LOG.warn("Failed to downgrade packages: %s" % command.command_str)
+        return not command.status
 
 
 class PackagesHandler(object):
@@ -381,6 +1155,13 @@ class PackagesHandler(object):
 
     def __init__(self, packages):
         self._packages = packages
+        self.failed = False
+
+    def _run(self, command, **kwargs):
+        command.run(**kwargs)
+        if command.status:
+            LOG.warn("Failed to install packages: %s" % command.command_str)
+            self.failed = True
 
     def _handle_gem_packages(self, packages):
         """
@@ -395,9 +1176,11 @@ class PackagesHandler(object):
                 cmd_str = 'gem install %s --version %s %s' % (opts,
                                                               versions[0],
                                                               pkg_name)
-                CommandRunner(cmd_str).run()
+                self._run(CommandRunner(cmd_str), stream=True)
             else:
-                CommandRunner('gem install %s %s' % (opts, pkg_name)).run()
+                self._run(CommandRunner('gem install %s %s' % (opts,
+                                                               pkg_name)),
+                          stream=True)
 
     def _handle_python_packages(self, packages):
         """
@@ -406,7 +1189,51 @@ class PackagesHandler(object):
         # TODO(asalkeld) support versions
         for pkg_name, versions in packages.iteritems():
             cmd_str = 'easy_install %s' % (pkg_name)
-            CommandRunner(cmd_str).run()
+            self._run(CommandRunner(cmd_str), stream=True)
+
+    def _plan_yum_packages(self, packages):
+        """
+        Work out which of a set of packages must be installed (or upgraded)
+        and which downgraded via yum, using one rpm query and one yum query
+        for the whole set.
+
+        Arguments:
+        packages -- a package entries map, as for _handle_yum_packages
+
+        Returns:
+            a tuple of sorted lists of package specs (installs, downgrades)
+        """
+        installs = []
+        downgrades = []
+        installed = RpmHelper.rpm_installed_packages()
+        missing = []
+        for pkg_name, versions in packages.iteritems():
+            ver = RpmHelper.newest_rpm_version(versions)
+            pkg = "%s-%s" % (pkg_name, ver) if ver else pkg_name
+            installed_versions = installed.get(pkg_name, [])
+            if RpmHelper.rpm_version_match(installed_versions, ver):
+                LOG.debug("Package '%s' is already installed" % pkg)
+            else:
+                missing.append((pkg_name, ver, pkg))
+
+        available = RpmHelper.yum_available_packages(
+            [m[2] for m in missing])
+        for pkg_name, ver, pkg in missing:
+            installed_versions = installed.get(pkg_name, [])
+            if not RpmHelper.rpm_version_match(available.get(pkg_name, []),
+                                               ver):
+                LOG.warn("Skipping package '%s'. Not available via yum" % pkg)
+                self.failed = True
+            elif not ver:
+                installs.append(pkg)
+            else:
+                current_ver = RpmHelper.newest_rpm_version(installed_versions)
+                rc = RpmHelper.compare_rpm_versions(current_ver, ver)
+                if rc < 0:
+                    installs.append(pkg)
+                elif rc > 0:
+                    downgrades.append(pkg)
+        return sorted(installs), sorted(downgrades)
 
     def _handle_yum_packages(self, packages):
         """
@@ -429,147 +1256,1015 @@ class PackagesHandler(object):
             if version matches installed package)
           * if a version array is supplied, choose the highest version from the
             array and follow same logic for version string above
+
+        The plan for the whole set is worked out first, then carried out
+        with at most one yum install and one yum downgrade transaction.
         """
-        # collect pkgs for batch processing at end
-        installs = []
-        downgrades = []
         # update yum cache
         RpmHelper.prepcache()
-        for pkg_name, versions in packages.iteritems():
-            ver = RpmHelper.newest_rpm_version(versions)
-            pkg = "%s-%s" % (pkg_name, ver) if ver else pkg_name
-            if RpmHelper.rpm_package_installed(pkg):
-                # FIXME:print non-error, but skipping pkg
-                pass
-            elif not RpmHelper.yum_package_available(pkg):
-                LOG.warn("Skipping package '%s'. Not available via yum" % pkg)
-            elif not ver:
-                installs.append(pkg)
-            else:
-                current_ver = RpmHelper.rpm_package_version(pkg)
-                rc = RpmHelper.compare_rpm_versions(current_ver, ver)
-                if rc < 0:
-                    installs.append(pkg)
-                elif rc > 0:
-                    downgrades.append(pkg)
-            if installs:
-                RpmHelper.install(installs, rpms=False)
-            if downgrades:
-                RpmHelper.downgrade(downgrades)
+        installs, downgrades = self._plan_yum_packages(packages)
+        LOG.info("Yum packages to install: %s, to downgrade: %s" %
+                 (installs, downgrades))
+        if installs and not RpmHelper.install(installs, rpms=False):
+            self.failed = True
+        if downgrades and not RpmHelper.downgrade(downgrades, rpms=False):
+            self.failed = True
 
     def _handle_rpm_packages(self, packages):
         """
         Handle installation, upgrade, or downgrade of a set of
         packages via rpm.
 
-        Arguments:
-        packages -- a package entries map of the form:
-                      "pkg_name" : "url"
+        Arguments:
+        packages -- a package entries map of the form:
+                      "pkg_name" : "url"
+
+        For each package entry:
+          * if the EXACT package is already installed, skip it
+          * if a different version of the package is installed, overwrite it
+          * if the package isn't installed, install it
+        """
+        #FIXME: handle rpm installs
+        pass
+
+    def _handle_apt_packages(self, packages):
+        """
+        very basic support for apt
+        """
+        # TODO(asalkeld) support versions
+        pkg_list = ' '.join([p for p in packages])
+
+        cmd_str = 'apt-get -y install %s' % pkg_list
+        self._run(CommandRunner(cmd_str))
+
+    # map of function pointers to handle different package managers
+    _package_handlers = {"yum": _handle_yum_packages,
+                         "rpm": _handle_rpm_packages,
+                         "apt": _handle_apt_packages,
+                         "rubygems": _handle_gem_packages,
+                         "python": _handle_python_packages}
+
+    def _package_handler(self, manager_name):
+        handler = None
+        if manager_name in self._package_handlers:
+            handler = self._package_handlers[manager_name]
+        return handler
+
+    def apply_packages(self):
+        """
+        Install, upgrade, or downgrade packages listed
+        Each package is a dict containing package name and a list of versions
+        Install order:
+          * dpkg
+          * rpm
+          * apt
+          * yum
+        """
+        if not self._packages:
+            return
+        packages = sorted(self._packages.iteritems(), PackagesHandler._pkgsort)
+
+        for manager, package_entries in packages:
+            handler = self._package_handler(manager)
+            if not handler:
+                LOG.warn("Skipping invalid package type: %s" % manager)
+            else:
+                handler(self, package_entries)
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _checksum_digest(checksum):
+    """
+    Returns (a new hash object, the expected hex digest) for a checksum of
+    the form "algorithm:hexdigest".
+    """
+    algorithm, sep, expected = checksum.partition(':')
+    try:
+        return hashlib.new(algorithm), expected.lower()
+    except ValueError:
+        raise DownloadError('Unsupported checksum: %s' % checksum)
+
+
+def _temp_path(path):
+    """
+    Returns an unused hidden file name in the directory of path.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.%s.%s' % (
+        basename, binascii.hexlify(os.urandom(4))))
+
+
+def _verify_checksum(url, path, checksum):
+    digest, expected = _checksum_digest(checksum)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    if digest.hexdigest() != expected:
+        raise DownloadError('Checksum of %s is %s:%s, expected %s' %
+                            (url, digest.name, digest.hexdigest(), checksum))
+
+
+def _copy_file(url, src, dest):
+    """
+    Copy the downloaded file src to dest via a temporary file which is
+    renamed into place.
+
+    Returns:
+        the size of dest
+    """
+    import shutil
+    tmp_path = _temp_path(dest)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.rename(tmp_path, dest)
+    except (IOError, OSError) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise DownloadError('Error copying %s to %s: %s' % (url, dest, e))
+    return os.path.getsize(dest)
+
+
+class DownloadCache(object):
+    """
+    Store of downloaded files, so that a file already downloaded by this
+    or an earlier run on the same host is not downloaded again.
+
+    Each file is stored once, named by the SHA-256 of its content, and an
+    index maps each URL to its file together with the ETag and
+    Last-Modified the server sent, with which the server is asked whether
+    the file has changed. When the files take up more than max_size bytes,
+    the least recently used are removed; a max_size of 0 turns the cache
+    off. Errors using the cache are logged and treated as misses.
+    """
+
+    cache_dir = '/var/cache/heat-cfntools/downloads'
+    max_size = 512 * 1024 * 1024
+    # seconds by which the last use of an entry may be out of date, so
+    # that the index is not rewritten every time a file is used
+    used_granularity = 60
+
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+        if max_size is not None:
+            self.max_size = max_size
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def object_path(self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256)
+
+    @contextlib.contextmanager
+    def _index(self):
+        """
+        Lock the index against other threads and processes and yield it,
+        saving it afterwards if it was changed.
+        """
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        with self._lock:
+            try:
+                os.makedirs(os.path.join(self.cache_dir, 'objects'), 0700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(os.path.join(self.cache_dir, 'lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    with open(index_path) as f:
+                        index = json.load(f)
+                except (IOError, ValueError):
+                    index = {}
+                saved = dict((url, dict(entry))
+                             for url, entry in index.items())
+                yield index
+                if index != saved:
+                    write_file_atomic(index_path, json.dumps(index), 0644)
+
+    def get(self, url):
+        """
+        Returns the index entry for url, or None if it is not cached.
+        """
+        try:
+            with self._index() as index:
+                entry = index.get(url)
+        except (IOError, OSError) as e:
+            LOG.debug("Download cache unavailable: %s" % e)
+            return None
+        if entry and os.path.exists(self.object_path(entry['sha256'])):
+            return entry
+        return None
+
+    def find(self, checksum):
+        """
+        Returns the cached file with the given checksum, if there is one
+        and the checksum is a SHA-256.
+        """
+        algorithm, sep, digest = (checksum or '').partition(':')
+        if algorithm.lower() != 'sha256' or not digest:
+            return None
+        path = self.object_path(digest.lower())
+        if os.path.exists(path):
+            return path
+        return None
+
+    def _evict(self, index):
+        sizes = dict((entry['sha256'], entry['size'])
+                     for entry in index.values())
+        total = sum(sizes.values())
+        for url, entry in sorted(index.items(),
+                                 key=lambda item: item[1]['used']):
+            if total <= self.max_size:
+                break
+            del index[url]
+            if all(e['sha256'] != entry['sha256'] for e in index.values()):
+                LOG.debug("Evicting %s from the download cache" % url)
+                total -= entry['size']
+
+        # remove the files no longer in the index, skipping any being
+        # written
+        used = set(entry['sha256'] for entry in index.values())
+        objects = os.path.join(self.cache_dir, 'objects')
+        for name in os.listdir(objects):
+            if not name.startswith('.') and name not in used:
+                os.remove(os.path.join(objects, name))
+
+    def use(self, url, sha256, etag=None, last_modified=None):
+        """
+        Record that url has the cached file sha256 and was just used.
+        """
+        path = self.object_path(sha256)
+        try:
+            with self._index() as index:
+                entry = index.get(url)
+                if entry is None or entry['sha256'] != sha256:
+                    entry = index[url] = {'sha256': sha256,
+                                          'size': os.path.getsize(path),
+                                          'etag': etag,
+                                          'last_modified': last_modified}
+                now = time.time()
+                if now - entry.get('used', 0) >= self.used_granularity:
+                    entry['used'] = now
+        except (IOError, OSError) as e:
+            LOG.debug("Download cache unavailable: %s" % e)
+
+    def store(self, url, path, sha256, etag=None, last_modified=None,
+              link=False):
+        """
+        Add a copy of the file at path, downloaded from url, to the cache.
+        With link, the file is hard linked into the cache instead, if it
+        can be, so the caller must not change it afterwards.
+        """
+        if not self.enabled:
+            return
+        try:
+            with self._index() as index:
+                object_path = self.object_path(sha256)
+                if not os.path.exists(object_path):
+                    linked = False
+                    if link:
+                        try:
+                            os.link(path, object_path)
+                            linked = True
+                        except OSError:
+                            pass
+                    if not linked:
+                        _copy_file(url, path, object_path)
+                index[url] = {'sha256': sha256,
+                              'size': os.path.getsize(path),
+                              'etag': etag,
+                              'last_modified': last_modified,
+                              'used': time.time()}
+                self._evict(index)
+        except (DownloadError, IOError, OSError) as e:
+            LOG.debug("Could not cache %s: %s" % (url, e))
+
+
+class Downloader(object):
+    """
+    Downloads files over HTTP and HTTPS without starting a process for
+    each one.
+
+    Connections are kept open after each download and reused for the next
+    download from the same host. Proxies are taken from the usual
+    http_proxy, https_proxy and no_proxy environment variables.
+
+    If a DownloadCache is given, files are served from it when the server
+    says they have not changed, or without asking the server at all when
+    the caller gives their SHA-256.
+    """
+
+    chunk_size = 65536
+    max_redirects = 5
+    timeout = 60
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection_key(self, scheme, netloc):
+        import urllib
+        import urlparse
+        proxy = urllib.getproxies().get(scheme)
+        if proxy and not urllib.proxy_bypass(netloc.split(':')[0]):
+            return (scheme, netloc, urlparse.urlsplit(proxy).netloc)
+        return (scheme, netloc, None)
+
+    def _connect(self, key):
+        import httplib
+        scheme, netloc, proxy = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(proxy or netloc,
+                                           timeout=self.timeout)
+            if proxy:
+                conn.set_tunnel(netloc)
+        else:
+            conn = httplib.HTTPConnection(proxy or netloc,
+                                          timeout=self.timeout)
+        return conn
+
+    def _acquire(self, key):
+        """
+        Returns (connection, whether it was used before).
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _release(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+    def _get(self, key, target, headers):
+        import httplib
+        import socket
+        conn, reused = self._acquire(key)
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if not reused:
+                raise DownloadError('Error fetching %s from %s: %s' %
+                                    (target, key[1], e))
+        # the server closed the kept-alive connection; try a new one
+        return self._get(key, target, headers)
+
+    def _open(self, url, headers=None):
+        """
+        Send a GET for url with the given headers, following redirects.
+
+        Returns:
+            (connection key, connection, response)
+        """
+        import urlparse
+        for i in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.netloc:
+                raise DownloadError('Unsupported URL: %s' % url)
+            key = self._connection_key(parts.scheme, parts.netloc)
+            if key[2] and parts.scheme == 'http':
+                target = urlparse.urlunsplit(parts[:4] + ('',))
+            else:
+                target = urlparse.urlunsplit(('', '', parts.path or '/',
+                                              parts.query, ''))
+            conn, response = self._get(key, target, headers or {})
+            if response.status not in (301, 302, 303, 307, 308):
+                return key, conn, response
+            location = response.getheader('location')
+            response.read()
+            self._release(key, conn, response)
+            if not location:
+                raise DownloadError('Redirect without a location from %s' %
+                                    url)
+            LOG.debug("Redirected from %s to %s" % (url, location))
+            url = urlparse.urljoin(url, location)
+        raise DownloadError('Too many redirects for %s' % url)
+
+    @contextlib.contextmanager
+    def open(self, url):
+        """
+        Yield a file object from which the content of url can be read as it
+        arrives, without saving it anywhere.
+
+        If the cache has an unchanged copy of url, that is read instead.
+        """
+        cache = self.cache if self.cache and self.cache.enabled else None
+        entry = cache.get(url) if cache else None
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = str(entry['etag'])
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = str(entry['last_modified'])
+
+        LOG.debug("Opening %s" % url)
+        key, conn, response = self._open(url, headers)
+        if response.status == 304 and entry:
+            response.read()
+            self._release(key, conn, response)
+            try:
+                cached = open(cache.object_path(entry['sha256']), 'rb')
+            except IOError:
+                # evicted since it was looked up
+                key, conn, response = self._open(url)
+            else:
+                LOG.debug("%s is unchanged, using cached copy" % url)
+                cache.use(url, entry['sha256'])
+                with cached:
+                    yield cached
+                return
+        if response.status != 200:
+            conn.close()
+            raise DownloadError('Error downloading %s: %d %s' % (
+                url, response.status, response.reason))
+        try:
+            yield response
+        except Exception:
+            conn.close()
+            raise
+        if response.isclosed():
+            self._release(key, conn, response)
+        else:
+            conn.close()
+
+    def _request(self, url, checksum, cache):
+        """
+        Find an up to date copy of url in the cache, asking the server
+        whether the cached copy has changed, or else start downloading it.
+
+        Returns:
+            (path of the cached copy, None) or
+            (None, (connection key, connection, response))
+        """
+        entry = None
+        headers = {}
+        if cache:
+            path = cache.find(checksum)
+            if path:
+                LOG.debug("Using cached copy of %s" % url)
+                cache.use(url, os.path.basename(path))
+                return path, None
+            entry = cache.get(url)
+            if entry and entry.get('etag'):
+                headers['If-None-Match'] = str(entry['etag'])
+            if entry and entry.get('last_modified'):
+                headers['If-Modified-Since'] = str(entry['last_modified'])
+
+        LOG.debug("Downloading %s" % url)
+        key, conn, response = self._open(url, headers)
+        if response.status == 304 and entry:
+            response.read()
+            self._release(key, conn, response)
+            path = cache.object_path(entry['sha256'])
+            if not os.path.exists(path):
+                # evicted since it was looked up
+                return self._request(url, checksum, cache)
+            LOG.debug("%s is unchanged, using cached copy" % url)
+            if checksum:
+                _verify_checksum(url, path, checksum)
+            cache.use(url, entry['sha256'])
+            return path, None
+        if response.status != 200:
+            conn.close()
+            raise DownloadError('Error downloading %s: %d %s' % (
+                url, response.status, response.reason))
+        return None, (key, conn, response)
+
+    def _save(self, url, checksum, opened, dest, cache, link=False):
+        """
+        Write the response to a temporary file next to dest, which is only
+        renamed to dest once the whole file has arrived, and add it to the
+        cache.
+
+        Returns:
+            the number of bytes downloaded
+        """
+        key, conn, response = opened
+        digest = None
+        if checksum:
+            digest, expected_digest = _checksum_digest(checksum)
+        tmp_path = _temp_path(dest)
+        content_digest = hashlib.sha256() if cache else None
+        size = 0
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0666)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: response.read(self.chunk_size),
+                                  ''):
+                    f.write(chunk)
+                    size += len(chunk)
+                    if digest:
+                        digest.update(chunk)
+                    if content_digest:
+                        content_digest.update(chunk)
+            length = response.getheader('content-length')
+            if length is not None and size != int(length):
+                raise DownloadError('Download of %s ended after %d of %s '
+                                    'bytes' % (url, size, length))
+            if digest and digest.hexdigest() != expected_digest:
+                raise DownloadError('Checksum of %s is %s:%s, expected %s' %
+                                    (url, digest.name, digest.hexdigest(),
+                                     checksum))
+            os.rename(tmp_path, dest)
+        except Exception as e:
+            conn.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(e, DownloadError):
+                raise
+            raise DownloadError('Error downloading %s: %s' % (url, e))
+        self._release(key, conn, response)
+        LOG.debug("Downloaded %d bytes from %s to %s" % (size, url, dest))
+        if cache:
+            cache.store(url, dest, content_digest.hexdigest(),
+                        response.getheader('etag'),
+                        response.getheader('last-modified'), link=link)
+        return size
+
+    def download(self, url, dest, checksum=None):
+        """
+        Download url to the file dest.
+
+        The data is written to a temporary file next to dest, which is only
+        renamed to dest once the whole file has arrived, so a failed
+        download leaves any existing dest untouched.
 
-        For each package entry:
-          * if the EXACT package is already installed, skip it
-          * if a different version of the package is installed, overwrite it
-          * if the package isn't installed, install it
+        If checksum is given, as "algorithm:hexdigest" (for example
+        "sha256:9f86d0..."), the data must match it.
+
+        Returns:
+            the number of bytes downloaded
         """
-        #FIXME: handle rpm installs
-        pass
+        cache = self.cache if self.cache and self.cache.enabled else None
+        path, opened = self._request(url, checksum, cache)
+        if path:
+            return _copy_file(url, path, dest)
+        return self._save(url, checksum, opened, dest, cache)
 
-    def _handle_apt_packages(self, packages):
+    def fetch(self, url, dest):
         """
-        very basic support for apt
+        Make sure that a copy of url is kept somewhere for reading, writing
+        it only once: into the cache if there is one, or else to dest.
+
+        Returns:
+            the path of the copy in the cache, or dest
         """
-        # TODO(asalkeld) support versions
-        pkg_list = ' '.join([p for p in packages])
+        cache = self.cache if self.cache and self.cache.enabled else None
+        path, opened = self._request(url, None, cache)
+        if path:
+            return path
+        if cache is None:
+            self._save(url, None, opened, dest, None)
+            return dest
+
+        # save it among the cache files, under a name the cache skips, so
+        # that it can be linked into the cache rather than copied
+        tmp_path = _temp_path(cache.object_path('fetch'))
+        try:
+            self._save(url, None, opened, tmp_path, cache, link=True)
+            entry = cache.get(url)
+            if entry:
+                path = cache.object_path(entry['sha256'])
+                try:
+                    if os.path.samefile(path, tmp_path):
+                        return path
+                except OSError:
+                    pass
+            # the cache could not keep it
+            try:
+                os.rename(tmp_path, dest)
+            except OSError:
+                _copy_file(url, tmp_path, dest)
+            return dest
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
-        cmd_str = 'apt-get -y install %s' % pkg_list
-        CommandRunner(cmd_str).run()
 
-    # map of function pointers to handle different package managers
-    _package_handlers = {"yum": _handle_yum_packages,
-                         "rpm": _handle_rpm_packages,
-                         "apt": _handle_apt_packages,
-                         "rubygems": _handle_gem_packages,
-                         "python": _handle_python_packages}
+_downloader = None
+_downloader_lock = threading.Lock()
 
-    def _package_handler(self, manager_name):
-        handler = None
-        if manager_name in self._package_handlers:
-            handler = self._package_handlers[manager_name]
-        return handler
 
-    def apply_packages(self):
+def get_downloader():
+    """
+    Returns the Downloader, with a DownloadCache, shared by the handlers,
+    creating it on first use.
+    """
+    global _downloader
+    with _downloader_lock:
+        if _downloader is None:
+            _downloader = Downloader(DownloadCache())
+        return _downloader
+
+
+class Prefetcher(object):
+    """
+    Downloads the URLs a config will need before its sections are
+    applied, so that they are fetched concurrently instead of one at a time
+    as each file or source is reached.
+
+    At most max_parallel downloads run at once, and at most per_host of
+    them from any one host. Each URL is downloaded into the download cache,
+    or into a staging directory if it cannot be cached, so that it is only
+    written once. Handlers given a Prefetcher as their downloader then take
+    the prefetched copy of a URL instead of fetching it; a URL which could
+    not be prefetched is downloaded again when it is asked for, so that the
+    error is reported where it is used.
+    """
+
+    max_parallel = 8
+    per_host = 4
+
+    def __init__(self):
+        self._dir = None
+        self._staged = {}
+        self._uses = {}
+        self._lock = threading.Lock()
+
+    def _fetch(self, url, path):
+        try:
+            fetched = get_downloader().fetch(url, path)
+        except DownloadError as e:
+            LOG.warn("Prefetch failed: %s" % e)
+            return
+        except Exception:
+            # the URL is downloaded again when it is asked for
+            LOG.exception("Prefetch of %s failed" % url)
+            return
+        with self._lock:
+            self._staged[url] = (fetched, fetched == path)
+
+    def fetch(self, urls):
         """
-        Install, upgrade, or downgrade packages listed
-        Each package is a dict containing package name and a list of versions
-        Install order:
-          * dpkg
-          * rpm
-          * apt
-          * yum
+        Download urls (which may repeat) into the staging directory, and
+        wait for all the downloads to finish.
         """
-        if not self._packages:
+        import urlparse
+        urls = list(urls)
+        if not urls:
             return
-        packages = sorted(self._packages.iteritems(), PackagesHandler._pkgsort)
+        for url in urls:
+            self._uses[url] = self._uses.get(url, 0) + 1
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='cfn-prefetch-')
+
+        queues = {}
+        for url in sorted(self._uses):
+            host = urlparse.urlsplit(url).netloc
+            path = os.path.join(self._dir, hashlib.sha1(url).hexdigest())
+            queues.setdefault(host, []).append((url, path))
+        slots = threading.BoundedSemaphore(self.max_parallel)
+
+        def worker(queue):
+            while True:
+                with self._lock:
+                    if not queue:
+                        return
+                    url, path = queue.pop(0)
+                with slots:
+                    self._fetch(url, path)
+
+        LOG.debug("Prefetching %d URLs from %d hosts" % (len(self._uses),
+                                                         len(queues)))
+        threads = []
+        for queue in queues.values():
+            for i in range(min(self.per_host, len(queue))):
+                thread = threading.Thread(target=worker, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _take(self, url):
+        """
+        Returns the prefetched file for url and whether it is staged and
+        this is its last use, or (None, False) if url was not prefetched.
+        """
+        with self._lock:
+            if url not in self._staged:
+                return None, False
+            path, staged = self._staged[url]
+            self._uses[url] -= 1
+            last = self._uses[url] <= 0
+            if last:
+                del self._staged[url]
+            return path, last and staged
+
+    def download(self, url, dest, checksum=None):
+        """
+        Put the prefetched copy of url at dest, as Downloader.download
+        would.
+        """
+        path, last = self._take(url)
+        if path is None or not os.path.exists(path):
+            # not prefetched, or evicted from the cache since
+            return get_downloader().download(url, dest, checksum)
 
-        for manager, package_entries in packages:
-            handler = self._package_handler(manager)
-            if not handler:
-                LOG.warn("Skipping invalid package type: %s" % manager)
-            else:
-                handler(self, package_entries)
+        try:
+            if checksum:
+                _verify_checksum(url, path, checksum)
+            if last:
+                try:
+                    os.rename(path, dest)
+                    return os.path.getsize(dest)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise DownloadError('Error moving %s to %s: %s' %
+                                            (url, dest, e))
+            return _copy_file(url, path, dest)
+        finally:
+            if last and os.path.exists(path):
+                os.remove(path)
+
+    @contextlib.contextmanager
+    def open(self, url):
+        """
+        Yield the prefetched copy of url, opened for reading, as
+        Downloader.open would.
+        """
+        path, last = self._take(url)
+        try:
+            stream = open(path, 'rb') if path else None
+        except IOError:
+            # evicted from the cache since it was prefetched
+            stream = None
+        if stream is None:
+            with get_downloader().open(url) as stream:
+                yield stream
+            return
+        try:
+            with stream:
+                yield stream
+        finally:
+            if last:
+                os.remove(path)
+
+    def close(self):
+        """
+        Remove the staging directory and anything left in it.
+        """
+        if self._dir is not None:
+            import shutil
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+        self._staged.clear()
+        self._uses.clear()
 
 
 class FilesHandler(object):
-    def __init__(self, files):
+    """
+    Writes the files of a config.
+
+    With compare_before_write set, a file whose content, owner and mode
+    are already as wanted is left alone, so that its mtime does not change
+    and nothing watching it is told it has. The paths of the files which
+    were changed are kept in changed_files.
+
+    The files which need writing are all first written to temporary files
+    next to them and, with durable_writes set, flushed to disk together,
+    before they are all renamed into place; so an interrupted run leaves
+    each file either as it was or complete, for the cost of about one
+    sync for the whole section.
+    """
+
+    compare_before_write = True
+    durable_writes = True
+
+    def __init__(self, files, downloader=None):
         self._files = files
+        self._downloader = downloader
+        self.changed_files = []
+        self.failed = False
 
-    def apply_files(self):
-        if not self._files:
-            return
-        for fdest, meta in self._files.iteritems():
-            dest = fdest.encode()
+    def _download(self, url, dest, checksum=None):
+        return (self._downloader or get_downloader()).download(url, dest,
+                                                               checksum)
+
+    def _has_checksum(self, dest, url, checksum):
+        """
+        Whether dest already holds a file matching checksum, so that url
+        need not be downloaded for it.
+        """
+        if not (self.compare_before_write and checksum and
+                os.path.isfile(dest)):
+            return False
+        try:
+            _verify_checksum(url, dest, checksum)
+        except (DownloadError, IOError):
+            return False
+        return True
+
+    def download_urls(self):
+        """
+        Returns the URLs apply_files will download.
+        """
+        return [meta['source']
+                for dest, meta in (self._files or {}).iteritems()
+                if 'source' in meta and 'content' not in meta and
+                not self._has_checksum(dest.encode(), meta['source'],
+                                       meta.get('checksum'))]
+
+    def _digest(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _has_content(self, path, content):
+        """
+        Whether the file at path already holds content.
+        """
+        if not self.compare_before_write:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode) or st.st_size != len(content):
+            return False
+        return self._digest(path) == hashlib.sha256(content).hexdigest()
+
+    def _stage_content(self, dest, content):
+        """
+        Returns a temporary file holding content to replace dest with, or
+        None if dest already holds it.
+        """
+        if self._has_content(dest, content):
+            return None
+        tmp_path = _temp_path(dest)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def _stage_source(self, dest, url, checksum):
+        """
+        Returns a temporary file holding the download of url to replace
+        dest with, or None if dest already holds it.
+        """
+        exists = os.path.isfile(dest)
+        if self._has_checksum(dest, url, checksum):
+            return None
+        tmp_path = _temp_path(dest)
+        try:
+            self._download(url, tmp_path, checksum)
+            if self.compare_before_write and exists and \
+                    self._digest(tmp_path) == self._digest(dest):
+                os.remove(tmp_path)
+                return None
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return tmp_path
+
+    def _set_attributes(self, path, meta, current):
+        """
+        Give the file at path the owner and mode in meta, where they
+        differ from those in the stat result current.
+
+        Returns whether the owner or mode was changed.
+        """
+        uid = -1
+        gid = -1
+        if 'owner' in meta:
             try:
-                os.makedirs(os.path.dirname(dest))
-            except OSError as e:
-                if e.errno == errno.EEXIST:
-                    LOG.debug(str(e))
-                else:
-                    LOG.exception(e)
+                user_info = pwd.getpwnam(meta['owner'])
+                uid = user_info[2]
+            except KeyError:
+                pass
 
-            if 'content' in meta:
-                if isinstance(meta['content'], basestring):
-                    f = open(dest, 'w+')
-                    f.write(meta['content'])
-                    f.close()
-                else:
-                    f = open(dest, 'w+')
-                    f.write(json.dumps(meta['content'], indent=4))
-                    f.close()
-            elif 'source' in meta:
-                CommandRunner('wget -O %s %s' % (dest, meta['source'])).run()
-            else:
-                LOG.error('%s %s' % (dest, str(meta)))
-                continue
+        if 'group' in meta:
+            try:
+                group_info = grp.getgrnam(meta['group'])
+                gid = group_info[2]
+            except KeyError:
+                pass
 
-            uid = -1
-            gid = -1
-            if 'owner' in meta:
-                try:
-                    user_info = pwd.getpwnam(meta['owner'])
-                    uid = user_info[2]
-                except KeyError as ex:
-                    pass
+        changed = False
+        if not self.compare_before_write or \
+                uid not in (-1, current.st_uid) or \
+                gid not in (-1, current.st_gid):
+            os.chown(path, uid, gid)
+            changed = uid != -1 or gid != -1
+        if 'mode' in meta:
+            mode = int(meta['mode'], 8)
+            if not self.compare_before_write or \
+                    stat.S_IMODE(mode) != stat.S_IMODE(current.st_mode):
+                os.chmod(path, mode)
+                changed = True
+        return changed
+
+    def _prepare(self, tmp_path, dest, meta):
+        """
+        Give tmp_path the owner and mode of the dest it will replace, and
+        then those in meta.
+        """
+        try:
+            st = os.stat(dest)
+        except OSError:
+            st = None
+        if st is not None:
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except OSError as e:
+                LOG.debug(str(e))
+        self._set_attributes(tmp_path, meta, os.stat(tmp_path))
 
-            if 'group' in meta:
-                try:
-                    group_info = grp.getgrnam(meta['group'])
-                    gid = group_info[2]
-                except KeyError as ex:
-                    pass
+    def _stage(self, dest, meta):
+        """
+        Returns the temporary file to replace dest with, None if dest is
+        already up to date, or False if dest cannot be written.
+        """
+        try:
+            os.makedirs(os.path.dirname(dest))
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                LOG.debug(str(e))
+            else:
+                LOG.exception(e)
+
+        if 'content' in meta:
+            content = meta['content']
+            if not isinstance(content, basestring):
+                content = json.dumps(content, indent=4)
+            if isinstance(content, unicode):
+                content = content.encode('utf-8')
+            return self._stage_content(dest, content)
+        elif 'source' in meta:
+            try:
+                return self._stage_source(dest, meta['source'],
+                                          meta.get('checksum'))
+            except DownloadError as e:
+                LOG.error(str(e))
+                self.failed = True
+                return False
+        LOG.error('%s %s' % (dest, str(meta)))
+        self.failed = True
+        return False
 
-            os.chown(dest, uid, gid)
-            if 'mode' in meta:
-                os.chmod(dest, int(meta['mode'], 8))
+    def apply_files(self):
+        self.changed_files = []
+        if not self._files:
+            return
+        staged = []
+        try:
+            for fdest, meta in sorted(self._files.iteritems()):
+                dest = fdest.encode()
+                tmp_path = self._stage(dest, meta)
+                if tmp_path:
+                    self._prepare(tmp_path, dest, meta)
+                    staged.append((tmp_path, dest))
+                elif tmp_path is None:
+                    if self._set_attributes(dest, meta, os.stat(dest)):
+                        self.changed_files.append(dest)
+                    else:
+                        LOG.debug("%s is unchanged" % dest)
+
+            if staged and self.durable_writes:
+                sync_files([path for path, staged_dest in staged])
+            renamed = []
+            while staged:
+                tmp_path, dest = staged.pop(0)
+                os.rename(tmp_path, dest)
+                renamed.append(dest)
+        finally:
+            for tmp_path, dest in staged:
+                os.remove(tmp_path)
+        if renamed and self.durable_writes:
+            sync_dirs(os.path.dirname(dest) for dest in renamed)
+        self.changed_files.extend(renamed)
+        for dest in sorted(self.changed_files):
+            LOG.info("Updated %s" % dest)
 
 
 class SourcesHandler(object):
@@ -578,57 +2273,143 @@ class SourcesHandler(object):
     '''
     _sources = {}
 
-    def __init__(self, sources):
+    # bytes of a zip archive held in memory before it is spooled to disk
+    zip_spool_size = 16 * 1024 * 1024
+    # most sources downloaded and unpacked at once
+    max_parallel = 4
+
+    def __init__(self, sources, downloader=None):
         self._sources = sources
+        self._downloader = downloader
+        self.failed = False
+
+    def download_urls(self):
+        """
+        Returns the URLs apply_sources will download.
+        """
+        return list((self._sources or {}).values())
 
-    def _url_to_tmp_filename(self, url):
+    def _archive_name(self, url):
         sp = url.split('/')
         if 'https://github.com' in url:
             if 'zipball' == sp[-2]:
-                return '/tmp/%s-%s.zip' % (sp[-3], sp[-1])
+                return '%s-%s.zip' % (sp[-3], sp[-1])
             elif 'tarball' == sp[-2]:
-                return '/tmp/%s-%s.tar.gz' % (sp[-3], sp[-1])
+                return '%s-%s.tar.gz' % (sp[-3], sp[-1])
             else:
                 pass
 
-        return '/tmp/%s' % (sp[-1])
+        return sp[-1]
 
-    def _decompress(self, archive, dest_dir):
-        cmd_str = ''
-        LOG.debug("Decompressing")
-        (r, ext) = os.path.splitext(archive)
-        if ext == '.tgz':
-            cmd_str = 'tar -C %s -xzf %s' % (dest_dir, archive)
-        elif ext == '.tbz2':
-            cmd_str = 'tar -C %s -xjf %s' % (dest_dir, archive)
+    def _archive_type(self, name):
+        """
+        Returns 'tar', 'zip', 'gz' or 'bz2' for a (possibly compressed)
+        tarball, a zip archive, or a single gzip or bzip2 compressed file,
+        or None if name has none of their extensions.
+        """
+        (r, ext) = os.path.splitext(name)
+        if ext in ('.tgz', '.tbz2', '.tar'):
+            return 'tar'
         elif ext == '.zip':
-            cmd_str = 'unzip -d %s %s' % (dest_dir, archive)
-        elif ext == '.tar':
-            cmd_str = 'tar -C %s -xf %s' % (dest_dir, archive)
-        elif ext == '.gz':
-            (r, ext) = os.path.splitext(r)
-            if ext:
-                cmd_str = 'tar -C %s -xzf %s' % (dest_dir, archive)
-            else:
-                cmd_str = 'gunzip -c %s > %s' % (archive, dest_dir)
-        elif ext == 'bz2':
-            (r, ext) = os.path.splitext(r)
-            if ext:
-                cmd_str = 'tar -C %s -xjf %s' % (dest_dir, archive)
-            else:
-                cmd_str = 'bunzip2 -c %s > %s' % (archive, dest_dir)
+            return 'zip'
+        elif ext in ('.gz', '.bz2'):
+            (r, inner_ext) = os.path.splitext(r)
+            if inner_ext:
+                return 'tar'
+            return ext[1:]
+        return None
+
+    def _is_inside(self, dest_dir, path):
+        path = os.path.realpath(os.path.join(dest_dir, path))
+        return path == dest_dir or path.startswith(dest_dir + os.sep)
+
+    def _safe_members(self, tar, dest_dir):
+        """
+        Yield the members of tar, skipping any which would be written, or
+        hard linked to, outside dest_dir.
+        """
+        for member in tar:
+            if not self._is_inside(dest_dir, member.name) or (
+                    member.islnk() and
+                    not self._is_inside(dest_dir, member.linkname)):
+                LOG.warn("Skipping archive member outside %s: %s" %
+                         (dest_dir, member.name))
+                continue
+            yield member
+
+    def _extract_tar(self, stream, dest_dir):
+        import tarfile
+        # the archive is read in a single pass, so it need not be seekable
+        tar = tarfile.open(fileobj=stream, mode='r|*')
+        try:
+            tar.extractall(dest_dir, self._safe_members(tar, dest_dir))
+        finally:
+            tar.close()
+
+    def _extract_zip(self, stream, dest_dir):
+        import zipfile
+        # zip archives are indexed from the end, so unless stream is
+        # already a local file it is spooled to one that can seek
+        spool = None
+        if not isinstance(stream, file):
+            spool = tempfile.SpooledTemporaryFile(self.zip_spool_size)
+            for chunk in iter(lambda: stream.read(65536), ''):
+                spool.write(chunk)
+            spool.seek(0)
+        try:
+            archive = zipfile.ZipFile(spool or stream)
+            for info in archive.infolist():
+                # zipfile drops absolute and parent directory components
+                path = archive.extract(info, dest_dir)
+                mode = (info.external_attr >> 16) & 0777
+                if mode and not info.filename.endswith('/'):
+                    os.chmod(path, mode)
+        finally:
+            if spool:
+                spool.close()
+
+    def _extract_compressed(self, stream, dest_dir, name, archive_type):
+        if archive_type == 'gz':
+            import zlib
+            # 16 selects the gzip header and trailer
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
         else:
-            pass
-        return CommandRunner(cmd_str)
+            import bz2
+            decompressor = bz2.BZ2Decompressor()
+        path = os.path.join(dest_dir, os.path.splitext(name)[0])
+        with open(path, 'wb') as f:
+            for chunk in iter(lambda: stream.read(65536), ''):
+                f.write(decompressor.decompress(chunk))
+            if archive_type == 'gz':
+                f.write(decompressor.flush())
+
+    def _extract(self, stream, name, dest_dir):
+        """
+        Unpack the archive called name, read from stream, into dest_dir.
+        """
+        archive_type = self._archive_type(name)
+        LOG.debug("Decompressing %s into %s" % (name, dest_dir))
+        dest_dir = os.path.realpath(dest_dir)
+        if archive_type == 'tar':
+            self._extract_tar(stream, dest_dir)
+        elif archive_type == 'zip':
+            self._extract_zip(stream, dest_dir)
+        elif archive_type in ('gz', 'bz2'):
+            self._extract_compressed(stream, dest_dir, name, archive_type)
+        else:
+            LOG.warn("Skipping %s, which is not a supported archive" % name)
 
     def apply_sources(self):
+        """
+        Download and unpack each source, running the sources concurrently.
+
+        Each archive is unpacked as it is read, without first being saved
+        to a temporary file.
+        """
         if not self._sources:
             return
-        for dest, url in self._sources.iteritems():
-            tmp_name = self._url_to_tmp_filename(url)
-            cmd_str = 'wget -O %s %s' % (tmp_name, url)
-            decompress_command = self._decompress(tmp_name, dest)
-            CommandRunner(cmd_str, decompress_command).run()
+        sources = sorted(self._sources.iteritems())
+        for dest, url in sources:
             try:
                 os.makedirs(dest)
             except OSError as e:
@@ -637,6 +2418,29 @@ class SourcesHandler(object):
                 else:
                     LOG.exception(e)
 
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(self.max_parallel, len(sources)))
+        try:
+            pool.map(lambda source: self._apply_source(source[1],
+                                                       source[0]),
+                     sources)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _apply_source(self, url, dest):
+        import tarfile
+        import zipfile
+        import zlib
+        name = self._archive_name(url)
+        try:
+            with (self._downloader or get_downloader()).open(url) as stream:
+                self._extract(stream, name, dest)
+        except (DownloadError, EnvironmentError, EOFError,
+                tarfile.TarError, zipfile.BadZipfile, zlib.error) as e:
+            LOG.error("Error unpacking %s into %s: %s" % (url, dest, e))
+            self.failed = True
+
 
 class ServicesHandler(object):
     _services = {}
@@ -645,52 +2449,50 @@ class ServicesHandler(object):
         self._services = services
         self.resource = resource
         self.hooks = hooks
+        self.failed = False
 
     def _handle_sysv_command(self, service, command):
         service_exe = "/sbin/service"
         enable_exe = "/sbin/chkconfig"
-        cmd = ""
+        cmd = []
         if "enable" == command:
-            cmd = "%s %s on" % (enable_exe, service)
+            cmd = [enable_exe, service, "on"]
         elif "disable" == command:
-            cmd = "%s %s off" % (enable_exe, service)
+            cmd = [enable_exe, service, "off"]
         elif "start" == command:
-            cmd = "%s %s start" % (service_exe, service)
+            cmd = [service_exe, service, "start"]
         elif "stop" == command:
-            cmd = "%s %s stop" % (service_exe, service)
+            cmd = [service_exe, service, "stop"]
         elif "status" == command:
-            cmd = "%s %s status" % (service_exe, service)
+            cmd = [service_exe, service, "status"]
         command = CommandRunner(cmd)
-        command.run()
+        command.run(shared_shell=True)
         return command
 
     def _handle_systemd_command(self, service, command):
         exe = "/bin/systemctl"
-        cmd = ""
+        cmd = []
         service = '%s.service' % service
-        if "enable" == command:
-            cmd = "%s enable %s" % (exe, service)
-        elif "disable" == command:
-            cmd = "%s disable %s" % (exe, service)
-        elif "start" == command:
-            cmd = "%s start %s" % (exe, service)
-        elif "stop" == command:
-            cmd = "%s stop %s" % (exe, service)
-        elif "status" == command:
-            cmd = "%s status %s" % (exe, service)
+        if command in ("enable", "disable", "start", "stop", "status"):
+            cmd = [exe, command, service]
         command = CommandRunner(cmd)
-        command.run()
+        command.run(shared_shell=True)
         return command
 
+    def _change_service(self, handler, service, command):
+        if handler(self, service, command).status:
+            LOG.warn("Failed to %s service %s" % (command, service))
+            self.failed = True
+
     def _initialize_service(self, handler, service, properties):
         if "enabled" in properties:
             enable = to_boolean(properties["enabled"])
             if enable:
                 LOG.info("Enabling service %s" % service)
-                handler(self, service, "enable")
+                self._change_service(handler, service, "enable")
             else:
                 LOG.info("Disabling service %s" % service)
-                handler(self, service, "disable")
+                self._change_service(handler, service, "disable")
 
         if "ensureRunning" in properties:
             ensure_running = to_boolean(properties["ensureRunning"])
@@ -698,10 +2500,10 @@ class ServicesHandler(object):
             running = command.status == 0
             if ensure_running and not running:
                 LOG.info("Starting service %s" % service)
-                handler(self, service, "start")
+                self._change_service(handler, service, "start")
             elif not ensure_running and running:
                 LOG.info("Stopping service %s" % service)
-                handler(self, service, "stop")
+                self._change_service(handler, service, "stop")
 
     def _monitor_service(self, handler, service, properties):
         if "ensureRunning" in properties:
@@ -843,6 +2645,7 @@ class CommandsHandler(object):
 
     def __init__(self, commands):
         self.commands = commands
+        self.failed = False
 
     def apply_commands(self):
         """
@@ -859,9 +2662,20 @@ class CommandsHandler(object):
         command_status = None
         cwd = None
         env = properties.get("env", None)
+        timeout = None
+
+        if "timeout" in properties:
+            try:
+                timeout = float(properties["timeout"])
+            except (TypeError, ValueError):
+                LOG.error("%s has failed. " % command_label +
+                          "invalid timeout %s" % properties["timeout"])
+                self.failed = True
+                return
 
         if "test" in properties:
-            test_status = CommandRunner(properties["test"]).run().status
+            test_status = CommandRunner(properties["test"]).run(
+                timeout=timeout).status
             if test_status != 0:
                 LOG.info("%s test returns false, skipping command"
                          % command_label)
@@ -878,11 +2692,14 @@ class CommandsHandler(object):
 
         if "command" in properties:
             try:
-                # TODO(pfreund) aws doc : "Either an array or a string
-                # specifying the command to run" Need the array.
+                # aws doc : "Either an array or a string specifying the
+                # command to run"; an array is run without a shell
                 command = CommandRunner(properties["command"])
-                command.run('root', cwd, env)
+                command.run('root', cwd, env, stream=True, timeout=timeout)
                 command_status = command.status
+                if command.timed_out:
+                    LOG.error("%s timed out after %ss" %
+                              (command_label, timeout))
             except OSError as e:
                 if e.errno == errno.EEXIST:
                     LOG.debug(str(e))
@@ -899,17 +2716,20 @@ class CommandsHandler(object):
             if "ignoreErrors" in properties:
                 if properties["ignoreErrors"] == "false":
                     LOG.error("%s has failed. Not ignoring" % command_label)
+                    self.failed = True
                 else:
                     LOG.info("%s has failed. Explicit ignoring"
                              % command_label)
             else:
                 LOG.error("%s has failed." % command_label)
+                self.failed = True
 
 
 class GroupsHandler(object):
 
     def __init__(self, groups):
         self.groups = groups
+        self.failed = False
 
     def apply_groups(self):
         """
@@ -931,8 +2751,11 @@ class GroupsHandler(object):
             param_list.append("--gid " + gid)
 
         command = CommandRunner("groupadd " + ' '.join(param_list))
-        command.run()
+        command.run(shared_shell=True)
         command_status = command.status
+        # a group which already exists is not retried
+        if command_status not in (0, 9):
+            self.failed = True
 
         if command_status == 0:
             LOG.info("%s has been successfully created" % group)
@@ -956,6 +2779,7 @@ class UsersHandler(object):
 
     def __init__(self, users):
         self.users = users
+        self.failed = False
 
     def apply_users(self):
         """
@@ -988,8 +2812,11 @@ class UsersHandler(object):
         param_list.append("--shell /sbin/nologin")
 
         command = CommandRunner("useradd " + ' '.join(param_list))
-        command.run()
+        command.run(shared_shell=True)
         command_status = command.status
+        # a user who already exists is not retried
+        if command_status not in (0, 9):
+            self.failed = True
 
         if command_status == 0:
             LOG.info("%s has been successfully created" % user)
@@ -1012,14 +2839,136 @@ class UsersHandler(object):
             LOG.error("An error occured creating %s user" % user)
 
 
+class ConnectionPool(object):
+    """
+    Cache of CloudFormationConnection objects, keyed on credentials and
+    endpoint, so that repeated metadata polls reuse the same connection
+    (and the keep-alive HTTP connections boto holds for it) instead of
+    setting up a new one each time.
+    Connections which have not been used for idle_timeout seconds are
+    dropped.
+    """
+
+    def __init__(self, idle_timeout=600):
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        for key, (client, last_used) in self._connections.items():
+            if now - last_used > self.idle_timeout:
+                LOG.debug("Closing idle connection to %s:%s" % key[2:])
+                client.close()
+                del self._connections[key]
+
+    def get(self, access_key, secret_key, port):
+        """
+        Return a connection for the given credentials and port, creating
+        it if there is no cached one.
+        """
+        connection_class = cloudformation_connection_class()
+        host = connection_class.DefaultRegionEndpoint
+        key = (access_key, secret_key, host, port)
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            if key in self._connections:
+                client = self._connections[key][0]
+            else:
+                client = connection_class(
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    is_secure=False, port=port,
+                    path="/v1", debug=0)
+            self._connections[key] = (client, now)
+        return client
+
+    def clear(self):
+        with self._lock:
+            for client, last_used in self._connections.values():
+                client.close()
+            self._connections.clear()
+
+
+connection_pool = ConnectionPool()
+
+
+class ConfigJournal(object):
+    """
+    Records, for each section of each config, a digest of the section
+    metadata when it was last applied and whether applying it succeeded,
+    so that a later cfn-init run can skip sections which are unchanged.
+    """
+
+    def __init__(self, path='/var/lib/heat-cfntools/cfn-init-state'):
+        self.path = path
+        try:
+            with open(path) as f:
+                self._state = json.load(f)
+        except (IOError, ValueError):
+            self._state = {}
+
+    def is_current(self, config, section, data):
+        """
+        Indicates whether data was successfully applied by the last run.
+        """
+        entry = self._state.get('%s.%s' % (config, section))
+        return entry is not None and entry['succeeded'] and \
+            entry['digest'] == metadata_digest(data)
+
+    def record(self, config, section, data, succeeded):
+        self._state['%s.%s' % (config, section)] = {
+            'digest': metadata_digest(data),
+            'succeeded': succeeded}
+        write_file_atomic(self.path, json.dumps(self._state))
+
+
 class MetadataServerConnectionError(Exception):
     pass
 
 
+# serialises access to the last_metadata cache file when several Metadata
+# objects are retrieved concurrently
+_last_metadata_lock = threading.Lock()
+
+
+def retrieve_metadata(metadata_list, concurrency=1, conditional=False):
+    """
+    Call retrieve() on each of a list of Metadata objects, with at most
+    concurrency retrievals in flight at once. A retrieval which fails is
+    logged and does not stop the others.
+
+    Returns:
+        a list of (metadata, exception or None) pairs, in the order given
+    """
+    def retrieve(metadata):
+        try:
+            metadata.retrieve(conditional=conditional)
+        except Exception as ex:
+            LOG.exception("Error retrieving metadata for %s" %
+                          metadata.resource)
+            return metadata, ex
+        return metadata, None
+
+    if concurrency <= 1 or len(metadata_list) <= 1:
+        return [retrieve(metadata) for metadata in metadata_list]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(concurrency, len(metadata_list)))
+    try:
+        return pool.map(retrieve, metadata_list)
+    finally:
+        pool.close()
+        pool.join()
+
+
 class Metadata(object):
     _metadata = None
     _init_key = "AWS::CloudFormation::Init"
     DEFAULT_PORT = 8000
+    # where retrieve saves the metadata, with the resource name appended
+    last_metadata_path = '/tmp/last_metadata'
+    metadata_server_file = '/var/lib/heat-cfntools/cfn-metadata-server'
 
     def __init__(self, stack, resource, access_key=None,
                  secret_key=None, credentials_file=None, region=None,
@@ -1039,30 +2988,101 @@ class Metadata(object):
         self._is_local_metadata = True
         self._metadata = None
         self._has_changed = False
-
-    def remote_metadata(self):
+        self._changes = []
+        self._credentials = None
+        self._credentials_mtime = None
+        self._port = None
+        self._port_mtime = None
+        self._last_metadata = None
+        self._etag = None
+        self._response_digest = None
+
+    def _get_credentials(self):
         """
-        Connect to the metadata server and retreive the metadata from there.
+        Return the (access key, secret key) pair, only re-parsing the
+        credentials file when it has been modified.
         """
-
         if self.credentials_file:
-            credentials = parse_creds_file(self.credentials_file)
-            access_key = credentials['AWSAccessKeyId']
-            secret_key = credentials['AWSSecretKey']
+            mtime = os.stat(self.credentials_file).st_mtime
+            if self._credentials is None or mtime != self._credentials_mtime:
+                credentials = parse_creds_file(self.credentials_file)
+                self._credentials = (credentials['AWSAccessKeyId'],
+                                     credentials['AWSSecretKey'])
+                self._credentials_mtime = mtime
+            return self._credentials
         elif self.access_key and self.secret_key:
-            access_key = self.access_key
-            secret_key = self.secret_key
+            return (self.access_key, self.secret_key)
         else:
             raise MetadataServerConnectionError("No credentials!")
 
-        port = metadata_server_port() or self.DEFAULT_PORT
+    def _get_port(self):
+        """
+        Return the metadata server port, only re-reading the
+        cfn-metadata-server file when it has been modified.
+        """
+        try:
+            mtime = os.stat(self.metadata_server_file).st_mtime
+        except OSError:
+            mtime = None
+        if self._port is None or mtime != self._port_mtime:
+            self._port = (metadata_server_port(self.metadata_server_file) or
+                          self.DEFAULT_PORT)
+            self._port_mtime = mtime
+        return self._port
+
+    def _describe_if_changed(self, client):
+        """
+        Make a DescribeStackResource request, returning None without
+        decoding the response if it is unchanged since the last request.
+
+        The ETag of the last response is sent in an If-None-Match header so
+        that a server supporting conditional requests can reply with 304 Not
+        Modified; otherwise the digest of the raw response body is compared
+        with that of the last response.
+        """
+        params = {'ContentType': 'JSON', 'StackName': self.stack,
+                  'LogicalResourceId': self.resource}
+        headers = {}
+        if self._etag and self._last_metadata is not None:
+            headers['If-None-Match'] = self._etag
+        request = client.build_base_http_request('GET', '/', None, params,
+                                                 headers, '',
+                                                 client.server_name())
+        request.params['Action'] = 'DescribeStackResource'
+        request.params['Version'] = client.APIVersion
+        response = client._mexe(request)
+        body = response.read()
+        if response.status == 304:
+            return None
+        if response.status != 200:
+            raise client.ResponseError(response.status, response.reason, body)
+
+        digest = hashlib.md5(body).hexdigest()
+        if digest == self._response_digest and \
+                self._last_metadata is not None:
+            return None
+        self._etag = response.getheader('etag')
+        self._response_digest = digest
+        return json.loads(body)
+
+    def remote_metadata(self, conditional=False):
+        """
+        Connect to the metadata server and retreive the metadata from there.
+
+        If conditional is True, None is returned when the metadata has not
+        changed since the last call.
+        """
+        access_key, secret_key = self._get_credentials()
 
-        client = CloudFormationConnection(aws_access_key_id=access_key,
-                                          aws_secret_access_key=secret_key,
-                                          is_secure=False, port=port,
-                                          path="/v1", debug=0)
+        client = connection_pool.get(access_key, secret_key,
+                                     self._get_port())
 
-        res = client.describe_stack_resource(self.stack, self.resource)
+        if conditional:
+            res = self._describe_if_changed(client)
+            if res is None:
+                return None
+        else:
+            res = client.describe_stack_resource(self.stack, self.resource)
         # Note pending upstream patch will make this response a
         # boto.cloudformation.stack.StackResourceDetail object
         # which aligns better with all the existing calls
@@ -1075,21 +3095,44 @@ class Metadata(object):
             self,
             meta_str=None,
             default_path='/var/lib/heat-cfntools/cfn-init-data',
-            last_path='/tmp/last_metadata'):
+            last_path=None,
+            conditional=False):
         """
         Read the metadata from the given filename
+
+        The metadata is saved at last_path, by default
+        /tmp/last_metadata.<resource>, so that the metadata of each resource
+        is compared with its own when cfn-hup polls several resources.
+
+        If conditional is True, remote metadata which has not changed since
+        the last call on this object is neither decoded nor written out
+        again, and the previously retrieved metadata is reused.
         """
+        if last_path is None:
+            last_path = self.last_metadata_path
+            if self.resource:
+                last_path += '.%s' % self.resource
         if meta_str:
             self._data = meta_str
         else:
             try:
-                self._data = self.remote_metadata()
+                self._data = self.remote_metadata(conditional=conditional)
+                if self._data is None:
+                    LOG.debug("Metadata for %s is unchanged" % self.resource)
+                    self._metadata = self._last_metadata
+                    self._has_changed = False
+                    self._changes = []
+                    return
             except MetadataServerConnectionError as ex:
                 LOG.warn("Unable to retrieve remote metadata : %s" % str(ex))
+                # the metadata read below need not be what the server last
+                # sent, so the next request must not be made conditional
+                self._etag = None
+                self._response_digest = None
 
                 # If reading remote metadata fails, we fall-back on local files
                 # in order to get the most up-to-date version, we try:
-                # /tmp/last_metadata, followed by
+                # last_path (/tmp/last_metadata.<resource>), followed by
                 # /var/lib/heat-cfntools/cfn-init-data
                 # This should allow us to do the right thing both during the
                 # first cfn-init run (when we only have cfn-init-data), and
@@ -1115,30 +3158,61 @@ class Metadata(object):
                     LOG.error("Unable to read any valid metadata!")
                     return
 
+        self._last_metadata = None
         if isinstance(self._data, str):
             self._metadata = json.loads(self._data)
         else:
             self._metadata = self._data
+        self._last_metadata = self._metadata
+
+        current_digest = metadata_digest(self._metadata)
+        digest_path = '%s.digest' % last_path
 
-        cm = hashlib.md5(json.dumps(self._metadata))
-        current_md5 = cm.hexdigest()
-        old_md5 = None
+        with _last_metadata_lock:
+            old_digest = self._last_digest(last_path, digest_path)
+            self._has_changed = old_digest != current_digest
+            self._changes = []
 
+            # save current metadata to file, only if it has changed
+            if self._has_changed:
+                self._changes = metadata_diff(self._load_last(last_path),
+                                              self._metadata)
+                write_file_atomic(last_path,
+                                  json.dumps(self._metadata, sort_keys=True))
+                write_file_atomic(digest_path, current_digest)
+
+    def _load_last(self, last_path):
+        """
+        Return the metadata saved at last_path, or None.
+        """
         try:
             with open(last_path) as lm:
-                om = hashlib.md5()
-                om.update(lm.read())
-                old_md5 = om.hexdigest()
+                return json.load(lm)
         except Exception:
-            pass
-        if old_md5 != current_md5:
-            self._has_changed = True
+            return None
 
-        # save current metadata to file
-        tmp_mdpath = last_path
-        with open(tmp_mdpath, 'w+') as cf:
-            os.chmod(tmp_mdpath, 0600)
-            cf.write(json.dumps(self._metadata))
+    def _last_digest(self, last_path, digest_path):
+        """
+        Return the digest of the metadata saved at last_path, or None.
+        """
+        if not os.path.exists(last_path):
+            return None
+        try:
+            with open(digest_path) as df:
+                return df.read().strip()
+        except IOError:
+            pass
+        # saved by a version which did not write a digest file; write it
+        # now so that the saved metadata is only hashed once
+        last_metadata = self._load_last(last_path)
+        if last_metadata is None:
+            return None
+        digest = metadata_digest(last_metadata)
+        try:
+            write_file_atomic(digest_path, digest)
+        except (IOError, OSError) as e:
+            LOG.debug("Could not write %s: %s" % (digest_path, e))
+        return digest
 
     def __str__(self):
         return json.dumps(self._metadata)
@@ -1154,7 +3228,18 @@ class Metadata(object):
             self._metadata = self._metadata[self._init_key]
         return is_valid
 
-    def _process_config(self, config="config"):
+    # handlers for each config section, in the order they are applied
+    _section_handlers = [
+        ("packages", PackagesHandler, "apply_packages"),
+        ("sources", SourcesHandler, "apply_sources"),
+        ("groups", GroupsHandler, "apply_groups"),
+        ("users", UsersHandler, "apply_users"),
+        ("files", FilesHandler, "apply_files"),
+        ("commands", CommandsHandler, "apply_commands"),
+        ("services", ServicesHandler, "apply_services")
+    ]
+
+    def _process_config(self, config="config", journal=None):
         """
         Parse and process a config section
           * packages
@@ -1164,6 +3249,13 @@ class Metadata(object):
           * files
           * commands
           * services
+
+        If a ConfigJournal is given, sections it records as successfully
+        applied with the same metadata are skipped, and the outcome of
+        processing each other section is recorded in it.
+
+        The files and sources of the sections to be processed are
+        downloaded concurrently before any section is applied.
         """
 
         try:
@@ -1171,28 +3263,60 @@ class Metadata(object):
         except KeyError:
             raise Exception("Could not find '%s' set in template, may need to"
                             " specify another set." % config)
-        PackagesHandler(self._config.get("packages")).apply_packages()
-        SourcesHandler(self._config.get("sources")).apply_sources()
-        GroupsHandler(self._config.get("groups")).apply_groups()
-        UsersHandler(self._config.get("users")).apply_users()
-        FilesHandler(self._config.get("files")).apply_files()
-        CommandsHandler(self._config.get("commands")).apply_commands()
-        ServicesHandler(self._config.get("services")).apply_services()
+        prefetcher = Prefetcher()
+        handlers = []
+        for section, handler, apply_name in self._section_handlers:
+            data = self._config.get(section)
+            if journal is not None and journal.is_current(config, section,
+                                                          data):
+                LOG.info("%s %s are unchanged, skipping" % (config, section))
+                continue
+            if hasattr(handler, 'download_urls'):
+                h = handler(data, downloader=prefetcher)
+            else:
+                h = handler(data)
+            handlers.append((section, data, h, apply_name))
+
+        try:
+            prefetcher.fetch(url for section, data, h, apply_name in handlers
+                             if hasattr(h, 'download_urls')
+                             for url in h.download_urls())
+            for section, data, h, apply_name in handlers:
+                if journal is None:
+                    getattr(h, apply_name)()
+                    continue
+                try:
+                    getattr(h, apply_name)()
+                except Exception:
+                    journal.record(config, section, data, False)
+                    raise
+                journal.record(config, section, data,
+                               not getattr(h, 'failed', False))
+        finally:
+            prefetcher.close()
+
+    def changed_paths(self):
+        """
+        Return the dotted paths of the metadata changed by the last
+        retrieve, in the same form as hook paths.
+        """
+        prefix = 'Resources.%s.Metadata' % self.resource
+        return ['.'.join([prefix] + list(path)) for path in self._changes]
 
-    def cfn_init(self):
+    def cfn_init(self, journal=None):
         """
         Process the resource metadata
+
+        If a ConfigJournal is given, sections which were successfully
+        applied by an earlier run with the same metadata are skipped.
         """
         if not self._is_valid_metadata():
             raise Exception("invalid metadata")
         else:
             executionlist = ConfigsetsHandler(self._metadata.get("configSets"),
                                               self.configsets).get_configsets()
-            if not executionlist:
-                self._process_config()
-            else:
-                for item in executionlist:
-                    self._process_config(item)
+            for item in executionlist or ["config"]:
+                self._process_config(item, journal)
 
     def cfn_hup(self, hooks):
         """
@@ -1208,5 +3332,7 @@ class Metadata(object):
                 sh.monitor_services()
 
             if self._has_changed:
+                changed_paths = self.changed_paths()
                 for h in hooks:
-                    h.event('post.update', self.resource, self.resource)
+                    h.event('post.update', self.resource, self.resource,
+                            changed_paths)
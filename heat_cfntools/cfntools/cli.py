@@ -0,0 +1,760 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Entry points for the cfn-* tools
+
+Each tool has a main(argv) function which parses argv (without the
+program name) and returns the exit status, so the tools can be run
+inside an existing process as well as from the scripts in bin/. main()
+is a multicall dispatcher choosing the tool from the name it was
+invoked as, in the manner of busybox.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import os.path
+import subprocess
+import sys
+import time
+
+from heat_cfntools.cfntools import cfn_helper
+
+LOG = logging.getLogger('cfntools')
+
+log_format = '%(levelname)s [%(asctime)s] %(message)s'
+log_dir = '/var/log'
+
+
+def log_to_file(name, level=logging.DEBUG, console=True):
+    '''
+    Set up logging for the tool called name, to /var/log/<name>.log and,
+    if console is set, to stderr. Calling this again in the same process
+    (e.g. when cfn-hup runs a tool in process) does not add the log file
+    a second time.
+    '''
+    log_file_name = os.path.join(log_dir, '%s.log' % name)
+    if not console:
+        logging.basicConfig(filename=log_file_name, format=log_format,
+                            level=level)
+        return
+    logging.basicConfig(format=log_format, level=level)
+    for handler in LOG.handlers:
+        if getattr(handler, 'baseFilename', None) == \
+                os.path.abspath(log_file_name):
+            return
+    file_handler = logging.FileHandler(log_file_name)
+    file_handler.setFormatter(logging.Formatter(log_format))
+    LOG.addHandler(file_handler)
+
+
+def _add_metadata_args(parser, required):
+    parser.add_argument('-s', '--stack',
+                        dest="stack_name",
+                        help="A Heat stack name",
+                        required=required)
+    parser.add_argument('-r', '--resource',
+                        dest="logical_resource_id",
+                        help="A Heat logical resource ID",
+                        required=required)
+    parser.add_argument('--access-key',
+                        dest="access_key",
+                        help="A Keystone access key",
+                        required=False)
+    parser.add_argument('--secret-key',
+                        dest="secret_key",
+                        help="A Keystone secret key",
+                        required=False)
+    parser.add_argument('--region',
+                        dest="region",
+                        help="Openstack region",
+                        required=False)
+
+
+def get_metadata_main(argv=None):
+    '''
+    cfn-get-metadata: fetch and log the metadata of a resource.
+    '''
+    parser = argparse.ArgumentParser(prog='cfn-get-metadata',
+                                     description=" ")
+    _add_metadata_args(parser, required=True)
+    parser.add_argument('--credential-file',
+                        dest="credential_file",
+                        help="credential-file",
+                        required=False)
+    parser.add_argument('-u', '--url',
+                        dest="url",
+                        help="service url",
+                        required=False)
+    parser.add_argument('-k', '--key',
+                        dest="key",
+                        help="key",
+                        required=False)
+    args = parser.parse_args(argv)
+
+    if not args.stack_name:
+        print 'The Stack name must not be empty.'
+        return 1
+
+    if not args.logical_resource_id:
+        print 'The Resource ID must not be empty'
+        return 1
+
+    log_to_file('cfn-get-metadata')
+
+    metadata = cfn_helper.Metadata(args.stack_name,
+                                   args.logical_resource_id,
+                                   access_key=args.access_key,
+                                   secret_key=args.secret_key,
+                                   region=args.region,
+                                   credentials_file=args.credential_file)
+    metadata.retrieve()
+    LOG.debug(str(metadata))
+    return 0
+
+
+def init_main(argv=None):
+    '''
+    cfn-init: fetch the metadata of a resource and apply its
+    AWS::CloudFormation::Init configuration.
+    '''
+    parser = argparse.ArgumentParser(prog='cfn-init', description=" ")
+    _add_metadata_args(parser, required=False)
+    parser.add_argument('-c', '--configsets',
+                        dest="configsets",
+                        help="An optional list of configSets "
+                             "(default: default)",
+                        required=False)
+    parser.add_argument('--incremental',
+                        dest="incremental",
+                        action="store_true",
+                        help="Skip config sections which were successfully "
+                             "applied by an earlier run with the same "
+                             "metadata",
+                        required=False)
+    parser.add_argument('--yum-cache-ttl',
+                        dest="yum_cache_ttl",
+                        type=int,
+                        help="Seconds for which the yum cache is reused "
+                             "before being remade (default: %d)" %
+                             cfn_helper.RpmHelper.cache_ttl,
+                        required=False)
+    parser.add_argument('--command-timeout',
+                        dest="command_timeout",
+                        type=float,
+                        help="Seconds after which a command which has not "
+                             "finished is killed (default: no timeout)",
+                        required=False)
+    parser.add_argument('--download-cache-size',
+                        dest="download_cache_size",
+                        type=int,
+                        help="Megabytes of downloaded files to keep in %s "
+                             "for later runs, or 0 to keep none "
+                             "(default: %d)" % (
+                                 cfn_helper.DownloadCache.cache_dir,
+                                 cfn_helper.DownloadCache.max_size >> 20),
+                        required=False)
+    parser.add_argument('--reuse-shell',
+                        dest="reuse_shell",
+                        action="store_true",
+                        help="Run group, user and service commands in one "
+                             "long-running shell instead of a new shell "
+                             "each",
+                        required=False)
+    args = parser.parse_args(argv)
+
+    log_to_file('cfn-init')
+
+    # these are class state, so put them back for later runs in the same
+    # process
+    cache_ttl = cfn_helper.RpmHelper.cache_ttl
+    default_timeout = cfn_helper.CommandRunner.default_timeout
+    use_shell_workers = cfn_helper.CommandRunner.use_shell_workers
+    cache_size = cfn_helper.DownloadCache.max_size
+    if args.yum_cache_ttl is not None:
+        cfn_helper.RpmHelper.cache_ttl = args.yum_cache_ttl
+    if args.command_timeout is not None:
+        cfn_helper.CommandRunner.default_timeout = args.command_timeout
+    if args.download_cache_size is not None:
+        cfn_helper.DownloadCache.max_size = args.download_cache_size << 20
+    if args.reuse_shell:
+        cfn_helper.CommandRunner.use_shell_workers = True
+    try:
+        metadata = cfn_helper.Metadata(args.stack_name,
+                                       args.logical_resource_id,
+                                       access_key=args.access_key,
+                                       secret_key=args.secret_key,
+                                       region=args.region,
+                                       configsets=args.configsets)
+        metadata.retrieve()
+        journal = None
+        if args.incremental:
+            journal = cfn_helper.ConfigJournal()
+        try:
+            metadata.cfn_init(journal=journal)
+        except Exception:
+            LOG.exception("Error processing metadata")
+            return 1
+    finally:
+        cfn_helper.RpmHelper.cache_ttl = cache_ttl
+        cfn_helper.CommandRunner.default_timeout = default_timeout
+        cfn_helper.CommandRunner.use_shell_workers = use_shell_workers
+        cfn_helper.DownloadCache.max_size = cache_size
+        cfn_helper.ShellWorker.close_all()
+        cfn_helper.get_downloader().close()
+    return 0
+
+
+def signal_main(argv=None):
+    '''
+    cfn-signal: report success or failure to a WaitCondition handle.
+    '''
+    parser = argparse.ArgumentParser(prog='cfn-signal', description=" ")
+    parser.add_argument('-s', '--success',
+                        dest="success",
+                        help="signal status to report",
+                        default='true',
+                        required=False)
+    parser.add_argument('-r', '--reason',
+                        dest="reason",
+                        help="The reason for the failure",
+                        default="Configuration Complete",
+                        required=False)
+    parser.add_argument('--data',
+                        dest="data",
+                        default="Application has completed configuration.",
+                        help="The data to send",
+                        required=False)
+    parser.add_argument('-i', '--id',
+                        dest="unique_id",
+                        help="the unique id to send back to the "
+                             "WaitCondition",
+                        default='00000',
+                        required=False)
+    parser.add_argument('-e', '--exit',
+                        dest="exit_code",
+                        help="The exit code from a procecc to interpret",
+                        default=None,
+                        required=False)
+    parser.add_argument('url',
+                        help='the url to post to')
+    args = parser.parse_args(argv)
+
+    log_to_file('cfn-signal')
+
+    LOG.debug('cfn-signal called %s ' % (str(args)))
+
+    status = 'FAILURE'
+    if args.exit_code:
+        # "exit_code" takes presedence over "success".
+        if args.exit_code == '0':
+            status = 'SUCCESS'
+    else:
+        if args.success == 'true':
+            status = 'SUCCESS'
+
+    body = {
+        "Status": status,
+        "Reason": args.reason,
+        "UniqueId": args.unique_id,
+        "Data": args.data
+    }
+
+    cmd_str = "curl -X PUT -H \'Content-Type:\' --data-binary \'%s\' " \
+              "\"%s\"" % (json.dumps(body), args.url)
+    command = cfn_helper.CommandRunner(cmd_str).run()
+    return command.status
+
+
+KILO = 1024
+MEGA = 1048576
+GIGA = 1073741824
+unit_map = {'bytes': 1,
+            'kilobytes': KILO,
+            'megabytes': MEGA,
+            'gigabytes': GIGA}
+
+
+def parse_haproxy_unix_socket(res, latency_only=False):
+    # http://docs.amazonwebservices.com/ElasticLoadBalancing/latest
+    # /DeveloperGuide/US_MonitoringLoadBalancerWithCW.html
+
+    type_map = {'FRONTEND': '0', 'BACKEND': '1', 'SERVER': '2', 'SOCKET': '3'}
+    num_map = {'status': 17, 'svname': 1, 'check_duration': 38, 'type': 32,
+               'req_tot': 48, 'hrsp_2xx': 40, 'hrsp_3xx': 41, 'hrsp_4xx': 42,
+               'hrsp_5xx': 43}
+
+    def add_stat(key, value, unit='Counter'):
+        res[key] = {'Value': value,
+                    'Units': unit}
+
+    echo = subprocess.Popen(['echo', 'show stat'],
+                            stdout=subprocess.PIPE)
+    socat = subprocess.Popen(['socat', 'stdio', '/tmp/.haproxy-stats'],
+                             stdin=echo.stdout,
+                             stdout=subprocess.PIPE)
+    end_pipe = socat.stdout
+    raw = [l.strip('\n').split(',') for l in end_pipe
+           if l[0] != '#' and len(l) > 2]
+    latency = 0
+    up_count = 0
+    down_count = 0
+    for f in raw:
+        if latency_only is False:
+            if f[num_map['type']] == type_map['FRONTEND']:
+                add_stat('RequestCount', f[num_map['req_tot']])
+                add_stat('HTTPCode_ELB_4XX', f[num_map['hrsp_4xx']])
+                add_stat('HTTPCode_ELB_5XX', f[num_map['hrsp_5xx']])
+            elif f[num_map['type']] == type_map['BACKEND']:
+                add_stat('HTTPCode_Backend_2XX', f[num_map['hrsp_2xx']])
+                add_stat('HTTPCode_Backend_3XX', f[num_map['hrsp_3xx']])
+                add_stat('HTTPCode_Backend_4XX', f[num_map['hrsp_4xx']])
+                add_stat('HTTPCode_Backend_5XX', f[num_map['hrsp_5xx']])
+            else:
+                if f[num_map['status']] == 'UP':
+                    up_count = up_count + 1
+                else:
+                    down_count = down_count + 1
+        if f[num_map['check_duration']] != '':
+            latency = max(float(f[num_map['check_duration']]), latency)
+
+    # note: haproxy's check_duration is in ms, but Latency is in seconds
+    add_stat('Latency', str(latency / 1000), unit='Seconds')
+    if latency_only is False:
+        add_stat('HealthyHostCount', str(up_count))
+        add_stat('UnHealthyHostCount', str(down_count))
+
+
+def send_stats(credentials, watch, namespace, info):
+    os.environ['BOTO_CONFIG'] = '/var/lib/heat-cfntools/cfn-boto-cfg'
+    from boto.ec2.cloudwatch import CloudWatchConnection
+
+    # Create boto connection, need the hard-coded port/path as boto
+    # can't read these from config values in BOTO_CONFIG
+    # FIXME : currently only http due to is_secure=False
+    client = CloudWatchConnection(
+        aws_access_key_id=credentials['AWSAccessKeyId'],
+        aws_secret_access_key=credentials['AWSSecretKey'],
+        is_secure=False, port=8003, path="/v1", debug=0)
+
+    # Then we send the metric datapoints passed in "info", note this could
+    # contain multiple keys as the options parsed above are noe exclusive
+    # The alarm name is passed as a dimension so the metric datapoint can
+    # be associated with the alarm/watch in the engine
+    metric_dims = [{'AlarmName': watch}]
+    for key in info:
+        LOG.info("Sending watch %s metric %s, Units %s, Value %s" %
+                 (watch, key, info[key]['Units'], info[key]['Value']))
+        client.put_metric_data(namespace=namespace,
+                               name=key,
+                               value=info[key]['Value'],
+                               timestamp=None,  # means use "now" in the engine
+                               unit=info[key]['Units'],
+                               dimensions=metric_dims,
+                               statistics=None)
+
+
+def push_stats_main(argv=None):
+    '''
+    cfn-push-stats: send system and service metrics to a watch.
+    '''
+    log_to_file('cfn-push-stats', console=False)
+
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+        LOG.warn("psutil not available. If you want process and memory "
+                 "statistics, you need to install it.")
+
+    parser = argparse.ArgumentParser(prog='cfn-push-stats', description=" ")
+    parser.add_argument('-v', '--verbose', action="store_true",
+                        help="Verbose logging", required=False)
+    parser.add_argument('--credential-file', dest="credential_file",
+                        help="credential-file", required=False,
+                        default='/etc/cfn/cfn-credentials')
+    parser.add_argument('--service-failure', required=False,
+                        action="store_true",
+                        help='Reports a service falure.')
+    parser.add_argument('--mem-util', required=False, action="store_true",
+                        help='Reports memory utilization in percentages.')
+    parser.add_argument('--mem-used', required=False, action="store_true",
+                        help='Reports memory used (excluding cache and '
+                             'buffers) in megabytes.')
+    parser.add_argument('--mem-avail', required=False, action="store_true",
+                        help='Reports available memory (including cache and '
+                             'buffers) in megabytes.')
+    parser.add_argument('--swap-util', required=False, action="store_true",
+                        help='Reports swap utilization in percentages.')
+    parser.add_argument('--swap-used', required=False, action="store_true",
+                        help='Reports allocated swap space in megabytes.')
+    parser.add_argument('--disk-space-util', required=False,
+                        action="store_true",
+                        help='Reports disk space utilization in percentages.')
+    parser.add_argument('--disk-space-used', required=False,
+                        action="store_true",
+                        help='Reports allocated disk space in gigabytes.')
+    parser.add_argument('--disk-space-avail', required=False,
+                        action="store_true",
+                        help='Reports available disk space in gigabytes.')
+    parser.add_argument('--memory-units', required=False, default='megabytes',
+                        help='Specifies units for memory metrics.')
+    parser.add_argument('--disk-units', required=False, default='megabytes',
+                        help='Specifies units for disk metrics.')
+    parser.add_argument('--disk-path', required=False, default='/',
+                        help='Selects the disk by the path on which to '
+                             'report.')
+    parser.add_argument('--cpu-util', required=False, action="store_true",
+                        help='Reports cpu utilization in percentages.')
+    parser.add_argument('--haproxy', required=False, action='store_true',
+                        help='Reports HAProxy loadbalancer usage.')
+    parser.add_argument('--haproxy-latency', required=False,
+                        action='store_true',
+                        help='Reports HAProxy latency')
+    parser.add_argument('--heartbeat', required=False, action='store_true',
+                        help='Sends a Heartbeat.')
+    parser.add_argument('--watch', required=True,
+                        help='the name of the watch to post to.')
+    args = parser.parse_args(argv)
+
+    LOG.debug('cfn-push-stats called %s ' % (str(args)))
+
+    credentials = cfn_helper.parse_creds_file(args.credential_file)
+
+    namespace = 'system/linux'
+    data = {}
+
+    # service failure
+    # ===============
+    if args.service_failure:
+        data['ServiceFailure'] = {
+            'Value': 1,
+            'Units': 'Counter'}
+
+    # heatbeat
+    # ========
+    if args.heartbeat:
+        data['Heartbeat'] = {
+            'Value': 1,
+            'Units': 'Counter'}
+
+    # memory space
+    # ============
+    if args.mem_util or args.mem_used or args.mem_avail:
+        mem = psutil.phymem_usage()
+    if args.mem_util:
+        data['MemoryUtilization'] = {
+            'Value': mem.percent,
+            'Units': 'Percent'}
+    if args.mem_used:
+        data['MemoryUsed'] = {
+            'Value': mem.used / unit_map[args.memory_units],
+            'Units': args.memory_units}
+    if args.mem_avail:
+        data['MemoryAvailable'] = {
+            'Value': mem.free / unit_map[args.memory_units],
+            'Units': args.memory_units}
+
+    # swap space
+    # ==========
+    if args.swap_util or args.swap_used:
+        swap = psutil.virtmem_usage()
+    if args.swap_util:
+        data['SwapUtilization'] = {
+            'Value': swap.percent,
+            'Units': 'Percent'}
+    if args.swap_used:
+        data['SwapUsed'] = {
+            'Value': swap.used / unit_map[args.memory_units],
+            'Units': args.memory_units}
+
+    # disk space
+    # ==========
+    if args.disk_space_util or args.disk_space_used or args.disk_space_avail:
+        disk = psutil.disk_usage(args.disk_path)
+    if args.disk_space_util:
+        data['DiskSpaceUtilization'] = {
+            'Value': disk.percent,
+            'Units': 'Percent'}
+    if args.disk_space_used:
+        data['DiskSpaceUsed'] = {
+            'Value': disk.used / unit_map[args.disk_units],
+            'Units': args.disk_units}
+    if args.disk_space_avail:
+        data['DiskSpaceAvailable'] = {
+            'Value': disk.free / unit_map[args.disk_units],
+            'Units': args.disk_units}
+
+    # cpu utilization
+    # ===============
+    if args.cpu_util:
+        # blocks for 1 second.
+        cpu_percent = psutil.cpu_percent(interval=1)
+        data['CPUUtilization'] = {
+            'Value': cpu_percent,
+            'Units': 'Percent'}
+
+    # HAProxy
+    # =======
+    if args.haproxy:
+        namespace = 'AWS/ELB'
+        data = {}
+        parse_haproxy_unix_socket(data)
+    elif args.haproxy_latency:
+        namespace = 'AWS/ELB'
+        data = {}
+        parse_haproxy_unix_socket(data, latency_only=True)
+    send_stats(credentials, args.watch, namespace, data)
+    return 0
+
+
+def hup_main(argv=None):
+    '''
+    cfn-hup: poll the metadata of the resources named in the hook
+    configuration and run the hooks whose paths changed.
+    '''
+    parser = argparse.ArgumentParser(prog='cfn-hup', description=" ")
+    parser.add_argument('-c', '--config',
+                        dest="config_dir",
+                        help="Hook Config Directory",
+                        required=False,
+                        default='/etc/cfn/hooks.d')
+    parser.add_argument('-f', '--no-daemon',
+                        dest="no_deamon",
+                        action="store_true",
+                        help="Do not run as a deamon",
+                        required=False)
+    parser.add_argument('-v', '--verbose',
+                        action="store_true",
+                        dest="verbose",
+                        help="Verbose logging",
+                        required=False)
+    args = parser.parse_args(argv)
+
+    # Setup logging
+    if args.verbose:
+        log_to_file('cfn-hup', level=logging.DEBUG, console=False)
+    else:
+        log_to_file('cfn-hup', level=logging.INFO, console=False)
+
+    main_conf_path = '/etc/cfn/cfn-hup.conf'
+    try:
+        main_config_file = open(main_conf_path)
+    except IOError:
+        LOG.error('Could not open main configuration at %s' % main_conf_path)
+        return 1
+
+    config_files = []
+    hooks_conf_path = '/etc/cfn/hooks.conf'
+    if os.path.exists(hooks_conf_path):
+        try:
+            config_files.append(open(hooks_conf_path))
+        except IOError as exc:
+            LOG.exception(exc)
+
+    if args.config_dir and os.path.exists(args.config_dir):
+        try:
+            for f in os.listdir(args.config_dir):
+                config_files.append(open(os.path.join(args.config_dir, f)))
+
+        except OSError as exc:
+            LOG.exception(exc)
+
+    if not config_files:
+        LOG.error('No hook files found at %s or %s' % (hooks_conf_path,
+                                                       args.config_dir))
+        return 1
+
+    try:
+        mainconfig = cfn_helper.HupConfig([main_config_file] + config_files)
+    except Exception as ex:
+        LOG.error('Cannot load configuration: %s' % str(ex))
+        return 1
+
+    if not mainconfig.unique_resources_get():
+        LOG.error('No hooks were found. Add some to %s or %s' %
+                  (hooks_conf_path, args.config_dir))
+        return 1
+
+    # Metadata objects are kept between polls so that a resident cfn-hup
+    # only pays for the network round trip on each interval
+    metadata_cache = {}
+
+    def poll():
+        resources = mainconfig.unique_resources_get()
+        for r in resources:
+            if r not in metadata_cache:
+                metadata_cache[r] = cfn_helper.Metadata(
+                    mainconfig.stack,
+                    r,
+                    credentials_file=mainconfig.credential_file,
+                    region=mainconfig.region)
+        metadata_list = [metadata_cache[r] for r in resources]
+
+        # fetch every resource's metadata concurrently, then run the hooks
+        # for each resource in turn; a resource whose metadata could not
+        # be fetched is skipped until the next poll
+        LOG.debug('Polling metadata for resources %s' % resources)
+        results = cfn_helper.retrieve_metadata(metadata_list,
+                                               mainconfig.concurrency,
+                                               conditional=True)
+        for metadata, error in results:
+            if error is None:
+                metadata.cfn_hup(mainconfig.hooks)
+        return all(error is None for metadata, error in results)
+
+    if args.no_deamon:
+        try:
+            if not poll():
+                return 1
+        except Exception:
+            LOG.exception("Error processing metadata")
+            return 1
+        return 0
+
+    while True:
+        try:
+            poll()
+        except Exception:
+            LOG.exception("Error processing metadata")
+        time.sleep(mainconfig.poll_delay())
+
+
+def create_symlink(source_file, target_file, override=False):
+    if os.path.exists(target_file):
+        if (override):
+            os.remove(target_file)
+        else:
+            print '%s already exists, will not replace with symlink' % \
+                target_file
+            return
+    print '%s -> %s' % (source_file, target_file)
+    os.symlink(source_file, target_file)
+
+
+def check_dirs(source_dir, target_dir):
+    print '%s -> %s' % (source_dir, target_dir)
+
+    if source_dir == target_dir:
+        print 'Source and target are the same %s' % target_dir
+        return False
+
+    if not os.path.exists(target_dir):
+        try:
+            os.makedirs(target_dir)
+        except OSError as exc:
+            print 'Could not create target directory %s: %s' % (target_dir,
+                                                                exc)
+            return False
+    return True
+
+
+def create_symlinks(source_dir, target_dir, glob_pattern, override):
+    source_files = glob.glob(os.path.join(source_dir, glob_pattern))
+    for source_file in source_files:
+        target_file = os.path.join(target_dir, os.path.basename(source_file))
+        create_symlink(source_file, target_file, override=override)
+
+
+def create_aws_symlinks_main(argv=None):
+    '''
+    cfn-create-aws-symlinks: link the cfn-* tools into /opt/aws/bin.
+    '''
+    description = 'Creates symlinks for the cfn-* scripts in this ' \
+                  'directory to /opt/aws/bin'
+    parser = argparse.ArgumentParser(prog='cfn-create-aws-symlinks',
+                                     description=description)
+    parser.add_argument(
+        '-t', '--target',
+        dest="target_dir",
+        help="Target directory to create symlinks",
+        default='/opt/aws/bin',
+        required=False)
+    parser.add_argument(
+        '-s', '--source',
+        dest="source_dir",
+        help="Source directory to create symlinks from. "
+             "Defaults to the directory where this script is",
+        default='/usr/bin',
+        required=False)
+    parser.add_argument(
+        '-f', '--force',
+        dest="force",
+        action='store_true',
+        help="If specified, will create symlinks even if there is already "
+             "a target file",
+        required=False)
+    args = parser.parse_args(argv)
+
+    if not check_dirs(args.source_dir, args.target_dir):
+        return 1
+
+    create_symlinks(args.source_dir, args.target_dir, 'cfn-*', args.force)
+    return 0
+
+
+tools = {
+    'cfn-create-aws-symlinks': create_aws_symlinks_main,
+    'cfn-get-metadata': get_metadata_main,
+    'cfn-hup': hup_main,
+    'cfn-init': init_main,
+    'cfn-push-stats': push_stats_main,
+    'cfn-signal': signal_main,
+}
+
+# tools which cfn-hup hooks may run inside the cfn-hup process instead of
+# starting a new interpreter for them; cfn-push-stats is left out as it
+# may sleep while sampling the CPU, which would stall cfn-hup
+cfn_helper.in_process_tools.update({
+    'cfn-init': init_main,
+    'cfn-signal': signal_main,
+})
+
+
+def run_tool(argv):
+    '''
+    Run the tool named by argv[0] (a path or a plain name) in this process
+    and return its exit status, including when it exits through
+    SystemExit (e.g. on an argument error).
+    '''
+    tool = tools[os.path.basename(argv[0])]
+    try:
+        return tool(argv[1:])
+    except SystemExit as ex:
+        return ex.code
+
+
+def main(argv=None):
+    '''
+    Multicall entry point: run the tool named by the basename of argv[0],
+    so that a link called cfn-init runs cfn-init. If argv[0] names no
+    tool, the tool name is taken from argv[1] instead, as in
+    "cfn-tools cfn-signal <url>".
+    '''
+    if argv is None:
+        argv = sys.argv
+    name = os.path.basename(argv[0])
+    if name not in tools:
+        argv = argv[1:]
+        if not argv or os.path.basename(argv[0]) not in tools:
+            print >> sys.stderr, 'usage: %s TOOL [ARGS...]\n' \
+                'where TOOL is one of: %s' % (name, ', '.join(sorted(tools)))
+            return 2
+    return run_tool(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
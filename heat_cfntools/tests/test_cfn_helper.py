@@ -14,30 +14,100 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import BaseHTTPServer
 import boto.cloudformation as cfn
+import bz2
+import contextlib
+import gzip
+import hashlib
 import json
+import logging
 import mox
+import os
+import pwd
+import shutil
+import socket
+import SocketServer
+import StringIO
 import subprocess
+import sys
+import tarfile
 import tempfile
 import testtools
 import testtools.matchers as ttm
+import threading
+import time
+import zipfile
 
 from heat_cfntools.cfntools import cfn_helper
 
+ROOT_SHELL = pwd.getpwnam('root').pw_shell or '/bin/sh'
+
 
 class FakePOpen():
     def __init__(self, stdout='', stderr='', returncode=0):
         self.returncode = returncode
-        self.stdout = stdout
-        self.stderr = stderr
+        self.stdout = StringIO.StringIO(stdout)
+        self.stderr = StringIO.StringIO(stderr)
 
     def communicate(self):
-        return (self.stdout, self.stderr)
+        return (self.stdout.getvalue(), self.stderr.getvalue())
 
     def wait(self):
         pass
 
 
+class FakeHTTPServer(object):
+    """
+    Local HTTP server for tests, run in a background thread. Each GET
+    request is passed to handler, which returns (status, headers, body).
+    """
+
+    def __init__(self, handler):
+        class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, headers, body = handler(self)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        connections = self.connections = []
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def process_request(self, request, client_address):
+                connections.append(request)
+                SocketServer.ThreadingMixIn.process_request(
+                    self, request, client_address)
+
+        self.server = Server(('127.0.0.1', 0), RequestHandler)
+        self.port = self.server.server_port
+        self.url = 'http://127.0.0.1:%d' % self.port
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # close any kept-alive connections, ending their handler threads
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
 class MockPopenTestCase(testtools.TestCase):
 
     def mock_cmd_run(self, command, cwd=None, env=None):
@@ -49,14 +119,16 @@ class MockPopenTestCase(testtools.TestCase):
         self.m = mox.Mox()
         self.m.StubOutWithMock(subprocess, 'Popen')
         self.addCleanup(self.m.UnsetStubs)
+        # commands for root are run directly, without su
+        self.patch(os, 'geteuid', lambda: 0)
 
 
 class TestCommandRunner(MockPopenTestCase):
 
     def test_command_runner(self):
-        self.mock_cmd_run(['su', 'root', '-c', '/bin/command1']).AndReturn(
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/command1']).AndReturn(
             FakePOpen('All good'))
-        self.mock_cmd_run(['su', 'root', '-c', '/bin/command2']).AndReturn(
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/command2']).AndReturn(
             FakePOpen('Doing something', 'error', -1))
         self.m.ReplayAll()
         cmd2 = cfn_helper.CommandRunner('/bin/command2')
@@ -71,57 +143,428 @@ class TestCommandRunner(MockPopenTestCase):
             str(cmd2))
         self.m.VerifyAll()
 
+    def test_command_runner_stream(self):
+        self.mock_cmd_run(['/bin/chatty']).AndReturn(
+            FakePOpen('line1\nline2\n', 'oops\n', 1))
+        self.m.ReplayAll()
+        logged = []
+        self.patch(cfn_helper.LOG, 'debug', logged.append)
+        cmd = cfn_helper.CommandRunner(['/bin/chatty']).run(stream=True)
+        self.assertEqual(1, cmd.status)
+        self.assertEqual('line1\nline2\n', cmd.stdout)
+        self.assertEqual('oops\n', cmd.stderr)
+        self.assertEqual(12, cmd.stdout_bytes)
+        self.assertEqual(5, cmd.stderr_bytes)
+        self.assertIn('stdout: line1', logged)
+        self.assertIn('stdout: line2', logged)
+        self.assertIn('stderr: oops', logged)
+        self.m.VerifyAll()
+
+    def test_output_buffer(self):
+        buf = cfn_helper.OutputBuffer(limit=10)
+        buf.write('0123')
+        self.assertEqual('0123', buf.getvalue())
+        buf.write('456789abcdefghij')
+        self.assertEqual('0123456789abcdefghij', buf.getvalue())
+        for i in range(1000):
+            buf.write('x' * 7 + '\n')
+        buf.write('the end\n')
+        self.assertEqual(8028, buf.total)
+        self.assertEqual('0123456789\n[... 8008 bytes omitted ...]\n'
+                         'x\nthe end\n', buf.getvalue())
+        self.assertTrue(len(buf._tail) <= 3)
+
+    def test_command_runner_argv(self):
+        self.mock_cmd_run(['/bin/echo', 'a b', '$HOME']).AndReturn(
+            FakePOpen('a b $HOME'))
+        self.m.ReplayAll()
+        cmd = cfn_helper.CommandRunner(['/bin/echo', 'a b', '$HOME']).run()
+        self.assertEqual(
+            "CommandRunner:\n\tcommand: /bin/echo 'a b' '$HOME'\n"
+            "\tstdout: a b $HOME",
+            str(cmd))
+        self.m.VerifyAll()
+
+    def test_command_runner_other_user(self):
+        nobody = pwd.getpwnam('nobody')
+        switches = []
+        self.patch(os, 'setgroups', lambda groups: switches.append(groups))
+        self.patch(os, 'setgid', lambda gid: switches.append(gid))
+        self.patch(os, 'setuid', lambda uid: switches.append(uid))
+
+        def popen(command, cwd=None, env=None, preexec_fn=None, **kwargs):
+            self.assertEqual(['/bin/true'], command)
+            self.assertEqual(nobody.pw_dir, env['HOME'])
+            self.assertEqual('nobody', env['USER'])
+            self.assertEqual('bar', env['FOO'])
+            preexec_fn()
+            return FakePOpen()
+
+        subprocess.Popen(
+            ['/bin/true'], cwd=None, env=mox.IgnoreArg(),
+            preexec_fn=mox.IgnoreArg(), stderr=-1, stdout=-1
+        ).WithSideEffects(popen).AndReturn(FakePOpen())
+        self.m.ReplayAll()
+        cfn_helper.CommandRunner(['/bin/true']).run('nobody',
+                                                    env={'FOO': 'bar'})
+        self.assertEqual(nobody.pw_gid, switches[0][-1])
+        self.assertEqual([nobody.pw_gid, nobody.pw_uid], switches[1:])
+        self.m.VerifyAll()
+
+    def test_command_runner_su(self):
+        # not root, so su is needed to become another user
+        self.patch(os, 'geteuid', lambda: 12345)
+        self.mock_cmd_run(['su', 'root', '-c', "/bin/echo 'a b'"]).AndReturn(
+            FakePOpen())
+        self.m.ReplayAll()
+        cfn_helper.CommandRunner(['/bin/echo', 'a b']).run('root')
+        self.m.VerifyAll()
+
+    def test_commands_handler_timeout(self):
+        subprocess.Popen(
+            [ROOT_SHELL, '-c', '/bin/slow'], cwd=None, env=None,
+            preexec_fn=mox.IgnoreArg(), stderr=-1, stdout=-1
+        ).AndReturn(FakePOpen())
+        self.m.ReplayAll()
+        handler = cfn_helper.CommandsHandler({
+            'a': {'command': '/bin/slow', 'timeout': '30'},
+            'b': {'command': '/bin/never', 'timeout': 'soon'}})
+        handler.apply_commands()
+        self.assertTrue(handler.failed)
+        self.m.VerifyAll()
+
+
+class TestCommandTimeout(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCommandTimeout, self).setUp()
+        self.user = pwd.getpwuid(os.geteuid()).pw_name
+
+    def test_timeout(self):
+        with tempfile.NamedTemporaryFile() as pid_file:
+            cmd = cfn_helper.CommandRunner(
+                'sleep 30 & echo $! > %s; sleep 30' % pid_file.name)
+            cmd.run(self.user, timeout=0.5)
+            self.assertTrue(cmd.timed_out)
+            self.assertEqual(-9, cmd.status)
+            self.assertTrue(0.5 <= cmd.duration < 10)
+            # the background sleep was killed along with the shell
+            pid = int(pid_file.read())
+        for i in range(50):
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('process %d was not killed' % pid)
+
+    def test_no_timeout(self):
+        self.patch(cfn_helper.CommandRunner, 'default_timeout', 10)
+        cmd = cfn_helper.CommandRunner(['echo', 'quick'])
+        self.assertIsNone(cmd.duration)
+        cmd.run(self.user, stream=True)
+        self.assertFalse(cmd.timed_out)
+        self.assertEqual(0, cmd.status)
+        self.assertEqual('quick\n', cmd.stdout)
+        self.assertTrue(cmd.start_time <= cmd.end_time)
+        self.assertEqual(cmd.end_time - cmd.start_time, cmd.duration)
+
+
+class TestShellWorker(testtools.TestCase):
+
+    def setUp(self):
+        super(TestShellWorker, self).setUp()
+        self.user = pwd.getpwuid(os.geteuid()).pw_name
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(cfn_helper.ShellWorker.close_all)
+        self.worker = cfn_helper.ShellWorker.get(self.user, self.tmpdir)
+
+    def test_run(self):
+        self.assertEqual((0, 'hello\n', ''), self.worker.run('echo hello'))
+        self.assertEqual((3, 'no newline', 'oops\n'), self.worker.run(
+            "printf 'no newline'; echo oops >&2; exit 3"))
+        self.assertEqual((0, '', ''), self.worker.run('true'))
+
+    def test_commands_isolated(self):
+        self.assertEqual(0, self.worker.run('cd /; FOO=bar; export FOO')[0])
+        self.assertEqual((0, '%s\n\n' % self.tmpdir, ''),
+                         self.worker.run('pwd; echo "$FOO"'))
+        # the command cannot read the commands queued after it
+        self.assertEqual((0, '', ''), self.worker.run('cat'))
+
+    def test_syntax_error(self):
+        status, stdout, stderr = self.worker.run('if then')
+        self.assertNotEqual(0, status)
+        self.assertNotEqual('', stderr)
+        self.assertEqual((0, 'still here\n', ''),
+                         self.worker.run('echo still here'))
+
+    def test_reused(self):
+        self.assertIs(self.worker,
+                      cfn_helper.ShellWorker.get(self.user, self.tmpdir))
+        self.assertIsNot(self.worker,
+                         cfn_helper.ShellWorker.get(self.user, None))
+        pid = self.worker.run('echo $$')[1]
+        self.assertEqual(pid, self.worker.run('echo $$')[1])
+
+    def test_worker_killed(self):
+        self.assertEqual(-1, self.worker.run('kill -9 $$')[0])
+        self.assertEqual((0, 'again\n', ''), self.worker.run('echo again'))
+
+    def test_command_runner(self):
+        self.patch(cfn_helper.CommandRunner, 'use_shell_workers', True)
+        self.worker.run('true')
+        # the worker is already running, so no process is started
+        m = mox.Mox()
+        m.StubOutWithMock(subprocess, 'Popen')
+        self.addCleanup(m.UnsetStubs)
+        m.ReplayAll()
+
+        cmd = cfn_helper.CommandRunner(['echo', "it's"])
+        cmd.run(self.user, self.tmpdir, shared_shell=True)
+        self.assertEqual(0, cmd.status)
+        self.assertEqual("it's\n", cmd.stdout)
+        self.assertEqual(5, cmd.stdout_bytes)
+        self.assertEqual(0, cmd.stderr_bytes)
+        self.assertIsNotNone(cmd.duration)
+        m.VerifyAll()
+
+    def test_close_all(self):
+        pid = self.worker.run('echo $$')[1]
+        cfn_helper.ShellWorker.close_all()
+        worker = cfn_helper.ShellWorker.get(self.user, self.tmpdir)
+        self.assertIsNot(self.worker, worker)
+        self.assertNotEqual(pid, worker.run('echo $$')[1])
+
+
+class TestPackagesHandler(MockPopenTestCase):
+
+    def setUp(self):
+        super(TestPackagesHandler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.repos_dir = os.path.join(self.tmpdir, 'yum.repos.d')
+        os.mkdir(self.repos_dir)
+        self.patch(cfn_helper.RpmHelper, 'cache_stamp',
+                   os.path.join(self.tmpdir, 'yum-makecache'))
+        self.patch(cfn_helper.RpmHelper, 'cache_dir', self.tmpdir)
+        self.patch(cfn_helper.RpmHelper, 'repo_configs', [self.repos_dir])
+
+    def test_prepcache(self):
+        self.mock_cmd_run(['yum', '-y', 'makecache']).AndReturn(
+            FakePOpen(returncode=1))
+        for i in range(3):
+            self.mock_cmd_run(['yum', '-y', 'makecache']).AndReturn(
+                FakePOpen())
+        self.m.ReplayAll()
+
+        stamp = cfn_helper.RpmHelper.cache_stamp
+        # failed, so not recorded
+        cfn_helper.RpmHelper.prepcache()
+        self.assertFalse(os.path.exists(stamp))
+        cfn_helper.RpmHelper.prepcache()
+        self.assertTrue(os.path.exists(stamp))
+
+        # fresh
+        cfn_helper.RpmHelper.prepcache()
+
+        # expired
+        made = time.time() - 120
+        os.utime(stamp, (made, made))
+        cfn_helper.RpmHelper.prepcache(ttl=60)
+        cfn_helper.RpmHelper.prepcache(ttl=60)
+
+        # repository added
+        os.utime(stamp, (made, made))
+        with open(os.path.join(self.repos_dir, 'new.repo'), 'w'):
+            pass
+        cfn_helper.RpmHelper.prepcache()
+        cfn_helper.RpmHelper.prepcache()
+        self.m.VerifyAll()
+
+    def _mock_package_queries(self, installed, available_cmd, available):
+        self.mock_cmd_run(
+            ['rpm', '-qa', '--queryformat',
+             '%{NAME} %{VERSION}-%{RELEASE}\\n']
+        ).AndReturn(FakePOpen(installed))
+        self.mock_cmd_run(
+            ['yum', '-C', '-y', '--showduplicates', 'list', 'available'] +
+            available_cmd.split()
+        ).AndReturn(FakePOpen('Available Packages\n' + available))
+
+    def test_yum_packages(self):
+        self.mock_cmd_run(['yum', '-y', 'makecache']).AndReturn(FakePOpen())
+        self.m.StubOutWithMock(cfn_helper.PackagesHandler,
+                               '_plan_yum_packages')
+        cfn_helper.PackagesHandler._plan_yum_packages(
+            {'httpd': [], 'mysql': [], 'wget': '1.12'}).AndReturn(
+                (['httpd', 'mysql'], ['wget-1.12']))
+        self.mock_cmd_run(
+            ['yum', '-y', 'install', 'httpd', 'mysql']).AndReturn(FakePOpen())
+        self.mock_cmd_run(['yum', '-y', 'downgrade', 'wget-1.12']).AndReturn(
+            FakePOpen())
+        self.m.ReplayAll()
+
+        handler = cfn_helper.PackagesHandler({"yum": {
+            'httpd': [], 'mysql': [], 'wget': '1.12'}})
+        handler.apply_packages()
+        self.m.VerifyAll()
+        self.assertFalse(handler.failed)
+
+    def test_yum_packages_failed(self):
+        self.mock_cmd_run(['yum', '-y', 'makecache']).AndReturn(FakePOpen())
+        self.m.StubOutWithMock(cfn_helper.PackagesHandler,
+                               '_plan_yum_packages')
+        cfn_helper.PackagesHandler._plan_yum_packages(
+            {'httpd': []}).AndReturn((['httpd'], []))
+        self.mock_cmd_run(['yum', '-y', 'install', 'httpd']).AndReturn(
+            FakePOpen(returncode=1))
+        self.m.ReplayAll()
+
+        handler = cfn_helper.PackagesHandler({"yum": {'httpd': []}})
+        handler.apply_packages()
+        self.m.VerifyAll()
+        self.assertTrue(handler.failed)
+
+    def test_plan_yum_packages(self):
+        self._mock_package_queries(
+            'httpd 2.2.22-1.fc16\n'
+            'wget 1.14-5.fc19\n'
+            'bash 4.2.45-1.fc19\n',
+            'httpd-2.4.4 mysql vim-7.4 wget-1.12',
+            'httpd.x86_64  2.4.4-3.fc19  fedora\n'
+            'mysql.x86_64  5.5-1.fc19    updates\n'
+            'wget.x86_64   1.12-1.fc19   fedora\n')
+        self.m.ReplayAll()
+
+        packages = {
+            "bash": [],
+            "httpd": ["2.2", "2.4.4"],
+            "mysql": [],
+            "vim": "7.4",
+            "wget": "1.12"}
+        ph = cfn_helper.PackagesHandler({"yum": packages})
+        self.assertEqual((['httpd-2.4.4', 'mysql'], ['wget-1.12']),
+                         ph._plan_yum_packages(packages))
+        self.m.VerifyAll()
+
+    def test_yum_available_packages(self):
+        self.mock_cmd_run(
+            ['yum', '-C', '-y', '--showduplicates', 'list', 'available',
+             'httpd', 'missing', 'python-virtualenv-clone-0.2.4']
+        ).AndReturn(FakePOpen(
+            'Loaded plugins: langpacks, refresh-packagekit\n'
+            'Available Packages\n'
+            'httpd.x86_64              2.4.4-3.fc19              fedora\n'
+            'httpd.x86_64              2.4.6-2.fc19              updates\n'
+            'python-virtualenv-clone.noarch\n'
+            '                          1:0.2.4-2.fc19            fedora\n'))
+        self.m.ReplayAll()
+
+        available = cfn_helper.RpmHelper.yum_available_packages(
+            ['httpd', 'python-virtualenv-clone-0.2.4', 'missing'])
+        self.assertEqual({
+            'httpd': ['2.4.4-3.fc19', '2.4.6-2.fc19'],
+            'python-virtualenv-clone': ['0.2.4-2.fc19']
+        }, available)
+        self.assertEqual({}, cfn_helper.RpmHelper.yum_available_packages([]))
+        self.m.VerifyAll()
+
+    def test_compare_rpm_versions(self):
+        compare = cfn_helper.RpmHelper.compare_rpm_versions
+        for older, newer in [
+                ('2.2', '2.2-1.fc16'),
+                ('2.2-1.fc16', '2.2.22-1.fc16'),
+                ('2.2.9', '2.2.10'),
+                ('1.0', '1.0.1'),
+                ('1.0a', '1.0.1'),
+                ('1.0~rc1', '1.0'),
+                ('1.0~rc1', '1.0~rc2'),
+                ('1.0-1.fc18', '1.0-1.fc19'),
+                ('2.0', '1:1.0'),
+                (None, '1.0')]:
+            self.assertEqual(-1, compare(older, newer))
+            self.assertEqual(1, compare(newer, older))
+        for v1, v2 in [
+                ('1.01', '1.1'),
+                ('1.0a', '1.0.a'),
+                ('0:1.0-1', '1.0-1'),
+                (None, None)]:
+            self.assertEqual(0, compare(v1, v2))
+
+    def test_newest_rpm_version(self):
+        newest = cfn_helper.RpmHelper.newest_rpm_version
+        self.assertEqual('2.2.22-1.fc16', newest(
+            ['2.0', '2.2', '2.2.22-1.fc16', '2.2-1.fc16']))
+        self.assertEqual('2.2', newest('2.2'))
+        self.assertIsNone(newest([]))
+
+    def test_rpm_version_match(self):
+        installed = ['2.2.22-1.fc16', '2.4.4-1.fc19']
+        self.assertTrue(cfn_helper.RpmHelper.rpm_version_match(installed))
+        self.assertTrue(cfn_helper.RpmHelper.rpm_version_match(
+            installed, '2.2.22'))
+        self.assertTrue(cfn_helper.RpmHelper.rpm_version_match(
+            installed, '2.4.4-1.fc19'))
+        self.assertFalse(cfn_helper.RpmHelper.rpm_version_match(
+            installed, '2.2'))
+        self.assertFalse(cfn_helper.RpmHelper.rpm_version_match(
+            installed, '2.4.4-2.fc19'))
+        self.assertFalse(cfn_helper.RpmHelper.rpm_version_match([]))
+
 
 class TestServicesHandler(MockPopenTestCase):
 
     def test_services_handler_systemd(self):
         # apply_services
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl enable httpd.service']
+            ['/bin/systemctl', 'enable', 'httpd.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status httpd.service']
+            ['/bin/systemctl', 'status', 'httpd.service']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl start httpd.service']
+            ['/bin/systemctl', 'start', 'httpd.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl enable mysqld.service']
+            ['/bin/systemctl', 'enable', 'mysqld.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status mysqld.service']
+            ['/bin/systemctl', 'status', 'mysqld.service']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl start mysqld.service']
+            ['/bin/systemctl', 'start', 'mysqld.service']
         ).AndReturn(FakePOpen())
 
         # monitor_services not running
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status httpd.service']
+            ['/bin/systemctl', 'status', 'httpd.service']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl start httpd.service']
+            ['/bin/systemctl', 'start', 'httpd.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/services_restarted']
+            [ROOT_SHELL, '-c', '/bin/services_restarted']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status mysqld.service']
+            ['/bin/systemctl', 'status', 'mysqld.service']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl start mysqld.service']
+            ['/bin/systemctl', 'start', 'mysqld.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/services_restarted']
+            [ROOT_SHELL, '-c', '/bin/services_restarted']
         ).AndReturn(FakePOpen())
 
         # monitor_services running
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status httpd.service']
+            ['/bin/systemctl', 'status', 'httpd.service']
         ).AndReturn(FakePOpen())
 
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status mysqld.service']
+            ['/bin/systemctl', 'status', 'mysqld.service']
         ).AndReturn(FakePOpen())
 
         self.m.ReplayAll()
@@ -153,22 +596,22 @@ class TestServicesHandler(MockPopenTestCase):
     def test_services_handler_systemd_disabled(self):
         # apply_services
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl disable httpd.service']
+            ['/bin/systemctl', 'disable', 'httpd.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status httpd.service']
+            ['/bin/systemctl', 'status', 'httpd.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl stop httpd.service']
+            ['/bin/systemctl', 'stop', 'httpd.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl disable mysqld.service']
+            ['/bin/systemctl', 'disable', 'mysqld.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl status mysqld.service']
+            ['/bin/systemctl', 'status', 'mysqld.service']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/systemctl stop mysqld.service']
+            ['/bin/systemctl', 'stop', 'mysqld.service']
         ).AndReturn(FakePOpen())
 
         self.m.ReplayAll()
@@ -195,51 +638,51 @@ class TestServicesHandler(MockPopenTestCase):
     def test_services_handler_sysv(self):
         # apply_services
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/chkconfig httpd on']
+            ['/sbin/chkconfig', 'httpd', 'on']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd status']
+            ['/sbin/service', 'httpd', 'status']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd start']
+            ['/sbin/service', 'httpd', 'start']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/chkconfig mysqld on']
+            ['/sbin/chkconfig', 'mysqld', 'on']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld status']
+            ['/sbin/service', 'mysqld', 'status']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld start']
+            ['/sbin/service', 'mysqld', 'start']
         ).AndReturn(FakePOpen())
 
         # monitor_services not running
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd status']
+            ['/sbin/service', 'httpd', 'status']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd start']
+            ['/sbin/service', 'httpd', 'start']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/services_restarted']
+            [ROOT_SHELL, '-c', '/bin/services_restarted']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld status']
+            ['/sbin/service', 'mysqld', 'status']
         ).AndReturn(FakePOpen(returncode=-1))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld start']
+            ['/sbin/service', 'mysqld', 'start']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/services_restarted']
+            [ROOT_SHELL, '-c', '/bin/services_restarted']
         ).AndReturn(FakePOpen())
 
         # monitor_services running
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd status']
+            ['/sbin/service', 'httpd', 'status']
         ).AndReturn(FakePOpen())
 
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld status']
+            ['/sbin/service', 'mysqld', 'status']
         ).AndReturn(FakePOpen())
 
         self.m.ReplayAll()
@@ -271,22 +714,22 @@ class TestServicesHandler(MockPopenTestCase):
     def test_services_handler_sysv_disabled(self):
         # apply_services
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/chkconfig httpd off']
+            ['/sbin/chkconfig', 'httpd', 'off']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd status']
+            ['/sbin/service', 'httpd', 'status']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service httpd stop']
+            ['/sbin/service', 'httpd', 'stop']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/chkconfig mysqld off']
+            ['/sbin/chkconfig', 'mysqld', 'off']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld status']
+            ['/sbin/service', 'mysqld', 'status']
         ).AndReturn(FakePOpen())
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/sbin/service mysqld stop']
+            ['/sbin/service', 'mysqld', 'stop']
         ).AndReturn(FakePOpen())
 
         self.m.ReplayAll()
@@ -328,6 +771,7 @@ credential-file=%s''' % fcreds.name)
             '{stack: teststack, credential_file: %s, '
             'region: nova, interval:10}' % fcreds.name,
             str(mainconfig))
+        self.assertEqual(4, mainconfig.concurrency)
         main_conf.close()
 
         main_conf = tempfile.NamedTemporaryFile()
@@ -345,15 +789,36 @@ interval=120''' % fcreds.name)
 
         fcreds.close()
 
+    def test_poll_delay(self):
+        fcreds = tempfile.NamedTemporaryFile()
+        fcreds.write('AWSAccessKeyId=foo\nAWSSecretKey=bar\n')
+        fcreds.flush()
+
+        main_conf = tempfile.NamedTemporaryFile()
+        main_conf.write('''[main]
+stack=teststack
+credential-file=%s
+interval=2''' % fcreds.name)
+        main_conf.flush()
+        mainconfig = cfn_helper.HupConfig([open(main_conf.name)])
+        for i in range(20):
+            delay = mainconfig.poll_delay()
+            self.assertTrue(108 <= delay <= 132)
+
+        mainconfig.jitter = 0
+        self.assertEqual(120, mainconfig.poll_delay())
+        main_conf.close()
+        fcreds.close()
+
     def test_hup_config(self):
-        self.mock_cmd_run(['su', 'root', '-c', '/bin/hook2']).AndReturn(
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/hook2']).AndReturn(
             FakePOpen('All good'))
-        self.mock_cmd_run(['su', 'root', '-c', '/bin/hook1']).AndReturn(
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/hook1']).AndReturn(
             FakePOpen('All good'))
-        self.mock_cmd_run(['su', 'root', '-c', '/bin/hook3']).AndReturn(
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/hook3']).AndReturn(
             FakePOpen('All good'))
         self.mock_cmd_run(
-            ['su', 'root', '-c', '/bin/cfn-http-restarted']).AndReturn(
+            [ROOT_SHELL, '-c', '/bin/cfn-http-restarted']).AndReturn(
                 FakePOpen('All good'))
         self.m.ReplayAll()
 
@@ -399,12 +864,15 @@ interval=120''' % fcreds.name)
 stack=teststack
 credential-file=%s
 region=region1
-interval=120''' % fcreds.name)
+interval=120
+concurrency=8''' % fcreds.name)
         main_conf.flush()
 
         mainconfig = cfn_helper.HupConfig([
             open(main_conf.name),
             open(hooks_conf.name)])
+        self.assertEqual(8, mainconfig.concurrency)
+        self.assertFalse(mainconfig.in_process_hooks)
         unique_resources = mainconfig.unique_resources_get()
         self.assertSequenceEqual([
             'resource2',
@@ -437,6 +905,101 @@ interval=120''' % fcreds.name)
         self.m.VerifyAll()
 
 
+class TestHookPath(MockPopenTestCase):
+
+    def test_hook_path_filter(self):
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/init-hook']).AndReturn(
+            FakePOpen('All good'))
+        self.mock_cmd_run([ROOT_SHELL, '-c', '/bin/files-hook']).AndReturn(
+            FakePOpen('All good'))
+        self.m.ReplayAll()
+
+        init_hook = cfn_helper.Hook(
+            'init-hook', 'post.update',
+            'Resources.resource1.Metadata.AWS::CloudFormation::Init',
+            'root', '/bin/init-hook')
+        files_hook = cfn_helper.Hook(
+            'files-hook', 'post.update',
+            'Resources.resource1.Metadata.AWS::CloudFormation::Init.'
+            'config.files',
+            'root', '/bin/files-hook')
+
+        services = ['Resources.resource1.Metadata.AWS::CloudFormation::Init.'
+                    'config.services']
+        other = ['Resources.resource1.Metadata.other']
+        self.assertTrue(init_hook.path_matches(services))
+        self.assertFalse(files_hook.path_matches(services))
+        self.assertFalse(init_hook.path_matches(other))
+        self.assertTrue(files_hook.path_matches(
+            ['Resources.resource1.Metadata']))
+        self.assertFalse(files_hook.path_matches(
+            ['Resources.resource1.Metadata.AWS::CloudFormation::Init.'
+             'config.filesystems']))
+
+        # only init-hook runs for a services change
+        init_hook.event('post.update', 'resource1', 'resource1', services)
+        files_hook.event('post.update', 'resource1', 'resource1', services)
+        init_hook.event('post.update', 'resource1', 'resource1', other)
+        files_hook.event('post.update', 'resource1', 'resource1', other)
+        # without changed paths every matching hook runs
+        files_hook.event('post.update', 'resource1', 'resource1')
+        self.m.VerifyAll()
+
+    def test_hook_in_process(self):
+        self.mock_cmd_run(
+            [ROOT_SHELL, '-c', '/opt/aws/bin/cfn-init -s "my stack"']
+        ).AndReturn(FakePOpen())
+        self.mock_cmd_run(
+            [ROOT_SHELL, '-c', '/opt/aws/bin/cfn-init -s stack']
+        ).AndReturn(FakePOpen())
+        subprocess.Popen(
+            [pwd.getpwnam('nobody').pw_shell, '-c',
+             '/opt/aws/bin/cfn-init -s stack'],
+            cwd=None, env=mox.IgnoreArg(), preexec_fn=mox.IgnoreArg(),
+            stderr=-1, stdout=-1).AndReturn(FakePOpen())
+        self.m.ReplayAll()
+
+        calls = []
+        self.patch(cfn_helper, 'in_process_tools',
+                   {'cfn-init': lambda argv: calls.append(argv)})
+
+        def event(action, runas='root', in_process=True):
+            hook = cfn_helper.Hook('hook', 'post.update',
+                                   'Resources.resource1.Metadata', runas,
+                                   action, in_process=in_process)
+            hook.event('post.update', 'resource1', 'resource1')
+
+        event('/opt/aws/bin/cfn-init -s stack -r resource1')
+        # needs a shell
+        event('/opt/aws/bin/cfn-init -s "my stack"')
+        # disabled
+        event('/opt/aws/bin/cfn-init -s stack', in_process=False)
+        # another user
+        event('/opt/aws/bin/cfn-init -s stack', runas='nobody')
+        self.assertEqual([['-s', 'stack', '-r', 'resource1']], calls)
+        self.m.VerifyAll()
+
+    def test_hook_in_process_logging(self):
+        self.m.ReplayAll()
+        log = logging.getLogger('cfntools')
+        handlers = list(log.handlers)
+        level = log.level
+
+        def tool(argv):
+            log.addHandler(logging.StreamHandler(StringIO.StringIO()))
+            log.setLevel(logging.DEBUG)
+            return 1
+
+        self.patch(cfn_helper, 'in_process_tools', {'cfn-signal': tool})
+        hook = cfn_helper.Hook('hook', 'post.update',
+                               'Resources.resource1.Metadata', 'root',
+                               '/opt/aws/bin/cfn-signal', in_process=True)
+        hook.event('post.update', 'resource1', 'resource1')
+        self.assertEqual(handlers, log.handlers)
+        self.assertEqual(level, log.level)
+        self.m.VerifyAll()
+
+
 class TestCfnHelper(testtools.TestCase):
 
     def _check_metadata_content(self, content, value):
@@ -486,6 +1049,27 @@ class TestCfnHelper(testtools.TestCase):
         self.assertFalse(cfn_helper.to_boolean(None))
         self.assertFalse(cfn_helper.to_boolean('fingle'))
 
+    def test_metadata_diff(self):
+        init = "AWS::CloudFormation::Init"
+        old = {init: {"config": {
+            "files": {"/tmp/foo": {"content": "bar"}},
+            "services": {"sysvinit": {"httpd": {"enabled": "true"}}}}},
+            "other": 1}
+        self.assertEqual([], cfn_helper.metadata_diff(old, old))
+        self.assertEqual([()], cfn_helper.metadata_diff(None, old))
+
+        new = json.loads(json.dumps(old))
+        new[init]["config"]["files"]["/tmp/foo"]["content"] = "baz"
+        new[init]["config"]["packages"] = {"yum": {"httpd": []}}
+        new["other"] = 2
+        self.assertEqual([
+            (init, "config", "files"),
+            (init, "config", "packages"),
+            ("other",)
+        ], cfn_helper.metadata_diff(old, new))
+        self.assertEqual([(init,), ("other",)],
+                         cfn_helper.metadata_diff(old, new, depth=1))
+
     def test_parse_creds_file(self):
         def parse_creds_test(file_contents, creds_match):
             with tempfile.NamedTemporaryFile(mode='w') as fcreds:
@@ -507,8 +1091,724 @@ class TestCfnHelper(testtools.TestCase):
         )
 
 
+class TestDownloader(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDownloader, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(os, 'environ', dict((k, v) for k, v in os.environ.items()
+                                       if k.lower() != 'http_proxy'))
+        self.files = {'/a': 'aaa' * 50000, '/b': 'bbb'}
+        self.server = FakeHTTPServer(self._handle)
+        self.addCleanup(self.server.stop)
+        self.downloader = cfn_helper.Downloader()
+        self.addCleanup(self.downloader.close)
+
+    def _handle(self, request):
+        if request.path.startswith('/redirect'):
+            return 302, {'Location': '/b'}, ''
+        if request.path not in self.files:
+            return 404, {}, 'not found'
+        return 200, {}, self.files[request.path]
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def test_download(self):
+        self.assertEqual(150000, self.downloader.download(
+            self.server.url + '/a', self._path('a')))
+        self.downloader.download(self.server.url + '/b', self._path('b'))
+        self.downloader.download(self.server.url + '/redirect',
+                                 self._path('c'))
+        for name, path in (('a', '/a'), ('b', '/b'), ('c', '/b')):
+            with open(self._path(name)) as f:
+                self.assertEqual(self.files[path], f.read())
+        # all the downloads shared one connection
+        self.assertEqual(1, len(self.server.connections))
+        self.assertEqual(['a', 'b', 'c'], sorted(os.listdir(self.tmpdir)))
+
+    def test_stale_connection(self):
+        self.downloader.download(self.server.url + '/b', self._path('b'))
+        self.server.connections[0].shutdown(socket.SHUT_RDWR)
+        self.downloader.download(self.server.url + '/a', self._path('a'))
+        with open(self._path('a')) as f:
+            self.assertEqual(self.files['/a'], f.read())
+        self.assertEqual(2, len(self.server.connections))
+
+    def test_not_found(self):
+        with open(self._path('a'), 'w') as f:
+            f.write('old')
+        self.assertRaises(cfn_helper.DownloadError,
+                          self.downloader.download,
+                          self.server.url + '/missing', self._path('a'))
+        with open(self._path('a')) as f:
+            self.assertEqual('old', f.read())
+        self.assertRaises(cfn_helper.DownloadError,
+                          self.downloader.download,
+                          'ftp://example.com/a', self._path('a'))
+
+    def test_checksum(self):
+        digest = hashlib.sha256(self.files['/a']).hexdigest()
+        self.downloader.download(self.server.url + '/a', self._path('a'),
+                                 'sha256:%s' % digest.upper())
+        self.assertTrue(os.path.exists(self._path('a')))
+        self.assertRaises(cfn_helper.DownloadError,
+                          self.downloader.download,
+                          self.server.url + '/a', self._path('bad'),
+                          'md5:%s' % digest)
+        self.assertRaises(cfn_helper.DownloadError,
+                          self.downloader.download,
+                          self.server.url + '/a', self._path('bad'),
+                          'crc:1234')
+        self.assertEqual(['a'], os.listdir(self.tmpdir))
+
+    def test_files_handler(self):
+        self.patch(cfn_helper, 'get_downloader', lambda: self.downloader)
+        dest = self._path('sub/b')
+        cfn_helper.FilesHandler({
+            dest: {'source': self.server.url + '/b', 'mode': '000640'},
+            self._path('missing'): {'source': self.server.url + '/none'},
+        }).apply_files()
+        with open(dest) as f:
+            self.assertEqual('bbb', f.read())
+        self.assertEqual(0640, os.stat(dest).st_mode & 0777)
+        self.assertFalse(os.path.exists(self._path('missing')))
+
+
+class TestDownloadCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDownloadCache, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(os, 'environ', dict((k, v) for k, v in os.environ.items()
+                                       if k.lower() != 'http_proxy'))
+        self.files = {'/a': 'a' * 1000, '/b': 'b' * 1000, '/c': 'c' * 1000}
+        self.served = []
+        self.server = FakeHTTPServer(self._handle)
+        self.addCleanup(self.server.stop)
+        self.cache = cfn_helper.DownloadCache(self._path('cache'))
+        self.downloader = cfn_helper.Downloader(self.cache)
+        self.addCleanup(self.downloader.close)
+
+    def _handle(self, request):
+        body = self.files[request.path]
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            self.served.append(304)
+            return 304, {}, ''
+        self.served.append(200)
+        return 200, {'ETag': etag}, body
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def _download(self, name, checksum=None):
+        dest = self._path(name)
+        self.downloader.download(self.server.url + '/' + name, dest,
+                                 checksum)
+        with open(dest) as f:
+            return f.read()
+
+    def test_conditional_get(self):
+        self.assertEqual(self.files['/a'], self._download('a'))
+        os.remove(self._path('a'))
+        self.assertEqual(self.files['/a'], self._download('a'))
+        self.assertEqual([200, 304], self.served)
+
+        self.files['/a'] = 'changed'
+        self.assertEqual('changed', self._download('a'))
+        self.assertEqual([200, 304, 200], self.served)
+
+    def test_checksum_hit(self):
+        self._download('a')
+        digest = hashlib.sha256(self.files['/a']).hexdigest()
+        self.files['/a'] = 'changed'
+        # the checksum identifies the file, so the server is not asked
+        self.assertEqual('a' * 1000,
+                         self._download('a', 'sha256:%s' % digest))
+        self.assertEqual([200], self.served)
+
+    def test_eviction(self):
+        self.cache.max_size = 2000
+        self.cache.used_granularity = 0
+        self._download('a')
+        self._download('b')
+        self._download('a')
+        self._download('c')
+        objects = os.listdir(self._path('cache/objects'))
+        self.assertEqual(sorted(hashlib.sha256(self.files[name]).hexdigest()
+                                for name in ('/a', '/c')), sorted(objects))
+        del self.served[:]
+        self._download('b')
+        self._download('c')
+        self.assertEqual([200, 304], self.served)
+
+    def test_fetch(self):
+        url = self.server.url + '/a'
+        staged = self._path('staged')
+        path = self.downloader.fetch(url, staged)
+        # written once, into the cache
+        digest = hashlib.sha256(self.files['/a']).hexdigest()
+        self.assertEqual(self.cache.object_path(digest), path)
+        self.assertEqual([os.path.basename(path)],
+                         os.listdir(self._path('cache/objects')))
+        self.assertFalse(os.path.exists(staged))
+        self.assertEqual(path, self.downloader.fetch(url, staged))
+        self.assertEqual([200, 304], self.served)
+
+        # too large to be cached
+        self.cache.max_size = 500
+        self.assertEqual(staged,
+                         self.downloader.fetch(self.server.url + '/b', staged))
+        with open(staged) as f:
+            self.assertEqual(self.files['/b'], f.read())
+
+    def test_prefetch_from_cache(self):
+        self.patch(cfn_helper, 'get_downloader', lambda: self.downloader)
+        prefetcher = cfn_helper.Prefetcher()
+        self.addCleanup(prefetcher.close)
+        url = self.server.url + '/a'
+        prefetcher.fetch([url, url])
+        self.assertEqual([], os.listdir(prefetcher._dir))
+        with prefetcher.open(url) as stream:
+            self.assertEqual(self.files['/a'], stream.read())
+        prefetcher.download(url, self._path('a'))
+        with open(self._path('a')) as f:
+            self.assertEqual(self.files['/a'], f.read())
+        self.assertEqual(1, len(os.listdir(self._path('cache/objects'))))
+        self.assertEqual([200], self.served)
+
+    def test_index_unchanged(self):
+        self._download('a')
+        writes = []
+        self.patch(cfn_helper, 'write_file_atomic',
+                   lambda *args: writes.append(args))
+        # lookups and recent uses leave the index as it is
+        self._download('a')
+        self.assertIsNotNone(self.cache.get(self.server.url + '/a'))
+        self.assertEqual([], writes)
+        self.cache.used_granularity = 0
+        self._download('a')
+        self.assertEqual(1, len(writes))
+
+    def test_disabled(self):
+        self.cache.max_size = 0
+        self._download('a')
+        self._download('a')
+        self.assertEqual([200, 200], self.served)
+        self.assertFalse(os.path.exists(self._path('cache')))
+
+    def test_unavailable(self):
+        open(self._path('file'), 'w').close()
+        self.cache.cache_dir = self._path('file/cache')
+        self.assertEqual(self.files['/a'], self._download('a'))
+        self.assertEqual(self.files['/a'], self._download('a'))
+        self.assertEqual([200, 200], self.served)
+
+
+class TestFilesHandler(testtools.TestCase):
+
+    def setUp(self):
+        super(TestFilesHandler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'file')
+        self.downloads = []
+
+    def download(self, url, dest, checksum=None):
+        self.downloads.append(url)
+        with open(dest, 'w') as f:
+            f.write(url.split('/')[-1])
+
+    def _apply(self, meta):
+        handler = cfn_helper.FilesHandler({self.path: meta}, self)
+        handler.apply_files()
+        return handler.changed_files
+
+    def test_content(self):
+        self.assertEqual([self.path], self._apply({'content': 'foo',
+                                                  'mode': '000640'}))
+        inode = os.stat(self.path).st_ino
+        self.assertEqual([], self._apply({'content': 'foo',
+                                          'mode': '000640'}))
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+
+        # a new mode is set without writing the file again
+        self.assertEqual([self.path], self._apply({'content': 'foo',
+                                                  'mode': '000600'}))
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+
+        # new content replaces the file, keeping its mode
+        self.assertEqual([self.path], self._apply({'content': 'bar'}))
+        self.assertNotEqual(inode, os.stat(self.path).st_ino)
+        self.assertThat(self.path, ttm.FileContains('bar'))
+        self.assertEqual(0600, os.stat(self.path).st_mode & 0777)
+        self.assertEqual(['file'], os.listdir(self.tmpdir))
+
+    def test_json_content(self):
+        self._apply({'content': {'a': [1]}})
+        self.assertEqual([], self._apply({'content': {'a': [1]}}))
+        self.assertThat(self.path, ttm.FileContains(
+            json.dumps({'a': [1]}, indent=4)))
+
+    def test_source(self):
+        url = 'http://example.com/foo'
+        self.assertEqual([self.path], self._apply({'source': url}))
+        inode = os.stat(self.path).st_ino
+        self.assertEqual([], self._apply({'source': url}))
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+        self.assertEqual([url, url], self.downloads)
+
+        # a file matching its checksum is not downloaded again
+        checksum = 'sha256:%s' % hashlib.sha256('foo').hexdigest()
+        self.assertEqual([], self._apply({'source': url,
+                                          'checksum': checksum}))
+        self.assertEqual(2, len(self.downloads))
+        self.assertEqual(['file'], os.listdir(self.tmpdir))
+
+    def test_batched_sync(self):
+        synced = []
+        self.patch(cfn_helper, '_syncfs',
+                   lambda path: synced.append(path) or True)
+        self.patch(cfn_helper, 'sync_dirs',
+                   lambda dirs: synced.append(sorted(dirs)))
+        files = dict((os.path.join(self.tmpdir, name), {'content': name})
+                     for name in ('a', 'b', 'sub/c'))
+        handler = cfn_helper.FilesHandler(files)
+        handler.apply_files()
+        self.assertEqual(sorted(files), sorted(handler.changed_files))
+        # one syncfs for the filesystem, before any file was in place
+        self.assertEqual(2, len(synced))
+        self.assertTrue(os.path.basename(synced[0]).startswith('.a.'))
+        self.assertEqual([self.tmpdir, os.path.join(self.tmpdir, 'sub')],
+                         sorted(set(synced[1])))
+
+    def test_fsync_fallback(self):
+        self.patch(cfn_helper, '_syncfs', lambda path: False)
+        self.patch(cfn_helper, 'sync_dirs', lambda dirs: None)
+        fsynced = []
+        real_fsync = os.fsync
+        self.patch(os, 'fsync',
+                   lambda fd: fsynced.append(fd) or real_fsync(fd))
+        cfn_helper.FilesHandler({
+            os.path.join(self.tmpdir, 'a'): {'content': 'a'},
+            os.path.join(self.tmpdir, 'b'): {'content': 'b'}}).apply_files()
+        self.assertEqual(2, len(fsynced))
+
+    def test_fsync_fallback_per_filesystem(self):
+        paths = [os.path.join(self.tmpdir, name) for name in 'abc']
+        for path in paths:
+            open(path, 'w').close()
+        devices = {paths[0]: 1, paths[1]: 2, paths[2]: 2}
+
+        class FakeStat(object):
+            def __init__(self, path):
+                self.st_dev = devices[path]
+        self.patch(os, 'stat', FakeStat)
+        # syncfs fails on the second filesystem only
+        self.patch(cfn_helper, '_syncfs', lambda path: devices[path] == 1)
+        fsynced = []
+        real_fsync = os.fsync
+        self.patch(os, 'fsync',
+                   lambda fd: fsynced.append(fd) or real_fsync(fd))
+        cfn_helper.sync_files(paths)
+        self.assertEqual(2, len(fsynced))
+
+    def test_syncfs(self):
+        self.assertTrue(cfn_helper._syncfs(self.tmpdir))
+
+    def test_staging_error(self):
+        blocker = os.path.join(self.tmpdir, 'blocker')
+        open(blocker, 'w').close()
+        # 'a' is staged before writing under 'blocker' fails
+        handler = cfn_helper.FilesHandler({
+            os.path.join(self.tmpdir, 'a'): {'content': 'a'},
+            os.path.join(blocker, 'file'): {'content': 'b'}})
+        self.assertRaises(OSError, handler.apply_files)
+        # nothing was put in place, and no temporary file is left behind
+        self.assertEqual(['blocker'], os.listdir(self.tmpdir))
+
+    def test_checksum_not_prefetched(self):
+        requests = []
+        server = FakeHTTPServer(
+            lambda request: requests.append(request.path) or (200, {}, 'foo'))
+        self.addCleanup(server.stop)
+        self.patch(os, 'environ', dict((k, v) for k, v in os.environ.items()
+                                       if k.lower() != 'http_proxy'))
+        downloader = cfn_helper.Downloader()
+        self.addCleanup(downloader.close)
+        self.patch(cfn_helper, 'get_downloader', lambda: downloader)
+        with open(self.path, 'w') as f:
+            f.write('foo')
+        checksum = 'sha256:%s' % hashlib.sha256('foo').hexdigest()
+        other = os.path.join(self.tmpdir, 'other')
+
+        md = cfn_helper.Metadata('teststack', None)
+        md._metadata = {'config': {'files': {
+            self.path: {'source': server.url + '/foo', 'checksum': checksum},
+            other: {'source': server.url + '/other'}}}}
+        md._process_config()
+        # only the file without a matching checksum was fetched
+        self.assertEqual(['/other'], requests)
+        self.assertThat(other, ttm.FileContains('foo'))
+
+    def test_always_write(self):
+        self.patch(cfn_helper.FilesHandler, 'compare_before_write', False)
+        self._apply({'content': 'foo'})
+        inode = os.stat(self.path).st_ino
+        self.assertEqual([self.path], self._apply({'content': 'foo'}))
+        self.assertNotEqual(inode, os.stat(self.path).st_ino)
+
+
+class TestSourcesHandler(testtools.TestCase):
+
+    class Stream(object):
+        """A file object which can only be read, not seeked."""
+
+        def __init__(self, data):
+            self._data = StringIO.StringIO(data)
+
+        def read(self, size=-1):
+            return self._data.read(size)
+
+    def setUp(self):
+        super(TestSourcesHandler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.archives = {}
+        self.opened = []
+
+    @contextlib.contextmanager
+    def open(self, url):
+        self.opened.append(url)
+        yield self.Stream(self.archives[url])
+
+    def _tar(self, mode, members):
+        data = StringIO.StringIO()
+        tar = tarfile.open(fileobj=data, mode=mode)
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0755
+            tar.addfile(info, StringIO.StringIO(content))
+        tar.close()
+        return data.getvalue()
+
+    def _apply(self, sources):
+        handler = cfn_helper.SourcesHandler(sources, self)
+        self.assertEqual(sorted(sources.values()),
+                         sorted(handler.download_urls()))
+        handler.apply_sources()
+        return handler
+
+    def _read(self, *path):
+        with open(os.path.join(self.tmpdir, *path)) as f:
+            return f.read()
+
+    def test_tarballs(self):
+        sources = {}
+        for name, mode in (('a.tgz', 'w:gz'), ('b.tar.bz2', 'w:bz2'),
+                           ('c.tar', 'w')):
+            url = 'http://example.com/%s' % name
+            self.archives[url] = self._tar(mode, [('dir/file', name)])
+            sources[os.path.join(self.tmpdir, name[0])] = url
+        self._apply(sources)
+        self.assertEqual(sorted(self.archives), sorted(self.opened))
+        for name in ('a.tgz', 'b.tar.bz2', 'c.tar'):
+            self.assertEqual(name, self._read(name[0], 'dir', 'file'))
+        self.assertEqual(0755, os.stat(os.path.join(
+            self.tmpdir, 'a', 'dir', 'file')).st_mode & 0777)
+
+    def test_tarball_outside_dest(self):
+        url = 'http://example.com/evil.tgz'
+        self.archives[url] = self._tar('w:gz', [
+            ('../escaped', 'x'), ('/abs', 'x'), ('ok', 'ok')])
+        self._apply({os.path.join(self.tmpdir, 'dest'): url})
+        self.assertEqual(['dest'], os.listdir(self.tmpdir))
+        self.assertEqual(['ok'], os.listdir(os.path.join(self.tmpdir,
+                                                         'dest')))
+
+    def test_zip(self):
+        data = StringIO.StringIO()
+        archive = zipfile.ZipFile(data, 'w')
+        info = zipfile.ZipInfo('dir/script')
+        info.external_attr = 0750 << 16
+        archive.writestr(info, 'zipped')
+        archive.close()
+        url = 'https://github.com/user/repo/zipball/master'
+        self.archives[url] = data.getvalue()
+        self._apply({os.path.join(self.tmpdir, 'z'): url})
+        self.assertEqual('zipped', self._read('z', 'dir', 'script'))
+        self.assertEqual(0750, os.stat(os.path.join(
+            self.tmpdir, 'z', 'dir', 'script')).st_mode & 0777)
+
+    def test_compressed_file(self):
+        data = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=data, mode='w') as f:
+            f.write('gzipped')
+        self.archives['http://example.com/f.gz'] = data.getvalue()
+        self.archives['http://example.com/g.bz2'] = bz2.compress('bzipped')
+        self._apply({os.path.join(self.tmpdir, 'f'): 'http://example.com/f.gz',
+                     os.path.join(self.tmpdir, 'g'):
+                     'http://example.com/g.bz2'})
+        self.assertEqual('gzipped', self._read('f', 'f'))
+        self.assertEqual('bzipped', self._read('g', 'g'))
+
+    def test_corrupt(self):
+        url = 'http://example.com/bad.tgz'
+        self.archives[url] = 'not a tarball'
+        self.assertTrue(self._apply({os.path.join(self.tmpdir, 'bad'):
+                                     url}).failed)
+        self.assertEqual([], os.listdir(os.path.join(self.tmpdir, 'bad')))
+
+    def test_download(self):
+        body = self._tar('w:gz', [('file', 'served')])
+        server = FakeHTTPServer(lambda request: (200, {}, body))
+        self.addCleanup(server.stop)
+        self.patch(os, 'environ', dict((k, v) for k, v in os.environ.items()
+                                       if k.lower() != 'http_proxy'))
+        downloader = cfn_helper.Downloader()
+        self.addCleanup(downloader.close)
+        cfn_helper.SourcesHandler(
+            {os.path.join(self.tmpdir, 'a'): server.url + '/a.tgz',
+             os.path.join(self.tmpdir, 'b'): server.url + '/b.tgz'},
+            downloader).apply_sources()
+        self.assertEqual('served', self._read('a', 'file'))
+        self.assertEqual('served', self._read('b', 'file'))
+
+
+class TestPrefetcher(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPrefetcher, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.active = {}
+        self.peak = {}
+        # downloads from a host wait for this many of them to overlap
+        self.overlap = {}
+        self.lock = threading.Condition()
+        self.requests = []
+        self.patch(cfn_helper, 'get_downloader', lambda: self)
+        self.prefetcher = cfn_helper.Prefetcher()
+        self.addCleanup(self.prefetcher.close)
+
+    def download(self, url, dest, checksum=None):
+        host = url.split('/')[2]
+        with self.lock:
+            self.requests.append(url)
+            self.active[host] = self.active.get(host, 0) + 1
+            self.peak[host] = max(self.peak.get(host, 0), self.active[host])
+            self.lock.notify_all()
+            deadline = time.time() + 5
+            while self.peak[host] < self.overlap.get(host, 0) and \
+                    time.time() < deadline:
+                self.lock.wait(deadline - time.time())
+            self.active[host] -= 1
+        if 'missing' in url:
+            raise cfn_helper.DownloadError('%s not found' % url)
+        with open(dest, 'w') as f:
+            f.write(url)
+
+    def fetch(self, url, dest):
+        if 'broken' in url:
+            raise ValueError('broken download')
+        self.download(url, dest)
+        return dest
+
+    def test_fetch_bounded_per_host(self):
+        self.patch(cfn_helper.Prefetcher, 'per_host', 2)
+        self.overlap['a'] = 2
+        urls = ['http://a/%d' % i for i in range(6)] + ['http://b/0']
+        self.prefetcher.fetch(urls + ['http://b/0'])
+        self.assertEqual({'a': 2, 'b': 1}, self.peak)
+        self.assertEqual(sorted(urls), sorted(self.requests))
+
+    def test_download(self):
+        self.prefetcher.fetch(['http://a/x', 'http://a/x', 'http://a/y',
+                               'http://a/missing'])
+        self.assertEqual(2, len(os.listdir(self.prefetcher._dir)))
+        del self.requests[:]
+        for name in ('1', '2'):
+            self.prefetcher.download('http://a/x', self._path(name))
+        self.prefetcher.download('http://a/y', self._path('3'))
+        # only the failed prefetch is fetched again
+        self.assertRaises(cfn_helper.DownloadError,
+                          self.prefetcher.download, 'http://a/missing',
+                          self._path('4'))
+        self.assertEqual(['http://a/missing'], self.requests)
+        for name, url in (('1', 'http://a/x'), ('2', 'http://a/x'),
+                          ('3', 'http://a/y')):
+            with open(self._path(name)) as f:
+                self.assertEqual(url, f.read())
+        self.assertEqual([], os.listdir(self.prefetcher._dir))
+
+    def test_fetch_error(self):
+        # an unexpected error is only a miss, and the URL is downloaded
+        # when it is asked for
+        self.prefetcher.fetch(['http://a/broken'])
+        self.assertEqual([], self.requests)
+        self.prefetcher.download('http://a/broken', self._path('1'))
+        self.assertEqual(['http://a/broken'], self.requests)
+
+    def test_open(self):
+        self.prefetcher.fetch(['http://a/x'])
+        with self.prefetcher.open('http://a/x') as stream:
+            self.assertEqual('http://a/x', stream.read())
+        self.assertEqual([], os.listdir(self.prefetcher._dir))
+
+    def test_checksum(self):
+        self.prefetcher.fetch(['http://a/x'])
+        self.assertRaises(cfn_helper.DownloadError,
+                          self.prefetcher.download, 'http://a/x',
+                          self._path('bad'), 'md5:0')
+        self.assertFalse(os.path.exists(self._path('bad')))
+
+    def test_process_config(self):
+        md = cfn_helper.Metadata('teststack', None)
+        md._metadata = {'config': {
+            'files': {self._path('f'): {'source': 'http://a/f'},
+                      self._path('g'): {'content': 'g'}}}}
+        md._process_config()
+        with open(self._path('f')) as f:
+            self.assertEqual('http://a/f', f.read())
+        self.assertEqual(['http://a/f'], self.requests)
+
+    def _path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+
+class TestConnectionPool(testtools.TestCase):
+
+    def test_connection_reused(self):
+        pool = cfn_helper.ConnectionPool()
+        client = pool.get('foo', 'bar', 8000)
+        self.assertIsInstance(client, cfn.CloudFormationConnection)
+        self.assertIs(client, pool.get('foo', 'bar', 8000))
+        self.assertIsNot(client, pool.get('foo', 'bar', 8001))
+        self.assertIsNot(client, pool.get('foo', 'baz', 8000))
+
+        pool.clear()
+        self.assertIsNot(client, pool.get('foo', 'bar', 8000))
+
+    def test_idle_connection_evicted(self):
+        now = [1000.0]
+        self.patch(cfn_helper.time, 'time', lambda: now[0])
+
+        pool = cfn_helper.ConnectionPool(idle_timeout=60)
+        client = pool.get('foo', 'bar', 8000)
+        now[0] += 59
+        self.assertIs(client, pool.get('foo', 'bar', 8000))
+        now[0] += 59
+        self.assertIs(client, pool.get('foo', 'bar', 8000))
+        now[0] += 61
+        self.assertIsNot(client, pool.get('foo', 'bar', 8000))
+
+
+class TestLazyImports(testtools.TestCase):
+
+    def _modules_after(self, code):
+        script = ('import sys\n'
+                  'from heat_cfntools.cfntools import cfn_helper\n'
+                  '%s\n'
+                  'print "\\n".join(sys.modules)\n' % code)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        p = subprocess.Popen([sys.executable, '-c', script], cwd=root,
+                             stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        self.assertEqual(0, p.returncode)
+        return set(out.split())
+
+    def test_import_is_light(self):
+        modules = self._modules_after('')
+        self.assertNotIn('boto', modules)
+        self.assertNotIn('rpmUtils', modules)
+        self.assertNotIn('multiprocessing', modules)
+        for module in ('httplib', 'urllib', 'tarfile', 'zipfile'):
+            self.assertNotIn(module, modules)
+
+    def test_boto_imported_on_use(self):
+        modules = self._modules_after(
+            'cfn_helper.ConnectionPool().get("foo", "bar", 8000)')
+        self.assertIn('boto.cloudformation', modules)
+
+
 class TestMetadataRetrieve(testtools.TestCase):
 
+    def setUp(self):
+        super(TestMetadataRetrieve, self).setUp()
+        # retrieve saves <last_path>.digest next to the temporary files
+        # the tests use as the metadata cache, so keep them all together
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.patch(tempfile, 'tempdir', tmpdir)
+        self.patch(cfn_helper.Metadata, 'last_metadata_path',
+                   os.path.join(tmpdir, 'last_metadata'))
+
+    def test_retrieve_metadata_concurrency(self):
+        lock = threading.Condition()
+        in_flight = [0]
+        max_in_flight = [0]
+        # retrievals wait for this many of them to overlap
+        overlap = [3]
+        retrieved = []
+
+        class FakeMetadata(object):
+            def __init__(self, resource):
+                self.resource = resource
+
+            def retrieve(self, conditional=False):
+                with lock:
+                    in_flight[0] += 1
+                    max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+                    lock.notify_all()
+                    deadline = time.time() + 5
+                    while max_in_flight[0] < overlap[0] and \
+                            time.time() < deadline:
+                        lock.wait(deadline - time.time())
+                    in_flight[0] -= 1
+                    retrieved.append(self.resource)
+
+        metadata_list = [FakeMetadata(i) for i in range(6)]
+        results = cfn_helper.retrieve_metadata(metadata_list, 3)
+        self.assertEqual([(md, None) for md in metadata_list], results)
+        self.assertEqual(range(6), sorted(retrieved))
+        self.assertEqual(3, max_in_flight[0])
+
+        retrieved[:] = []
+        max_in_flight[0] = 0
+        overlap[0] = 0
+        cfn_helper.retrieve_metadata(metadata_list)
+        self.assertEqual(range(6), retrieved)
+        self.assertEqual(1, max_in_flight[0])
+
+    def test_retrieve_metadata_error(self):
+        error = Exception('server unavailable')
+
+        class FakeMetadata(object):
+            def __init__(self, resource):
+                self.resource = resource
+                self.retrieved = False
+
+            def retrieve(self, conditional=False):
+                if self.resource == 1:
+                    raise error
+                self.retrieved = True
+
+        for concurrency in (1, 3):
+            metadata_list = [FakeMetadata(i) for i in range(3)]
+            results = cfn_helper.retrieve_metadata(metadata_list,
+                                                   concurrency)
+            # the others are still retrieved
+            self.assertEqual([(metadata_list[0], None),
+                              (metadata_list[1], error),
+                              (metadata_list[2], None)], results)
+            self.assertEqual([True, False, True],
+                             [md.retrieved for md in metadata_list])
+
     def test_metadata_retrieve_files(self):
 
         md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
@@ -569,6 +1869,85 @@ class TestMetadataRetrieve(testtools.TestCase):
         self.assertDictEqual(md_data, md._metadata)
         self.assertEqual(md_str, str(md))
 
+    def test_metadata_retrieve_has_changed(self):
+
+        md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
+            "/tmp/foo": {"content": "bar"}}}}}
+
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+
+        md = cfn_helper.Metadata('teststack', None)
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        self.assertTrue(md._has_changed)
+
+        # a resident cfn-hup reuses the same object for every poll
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        self.assertFalse(md._has_changed)
+
+    def test_metadata_retrieve_per_resource(self):
+        md_data = dict((r, {"AWS::CloudFormation::Init": {"config": {
+            "files": {"/tmp/%s" % r: {"content": r}}}}})
+            for r in ('resource1', 'resource2'))
+        metadata_list = [cfn_helper.Metadata('teststack', r)
+                         for r in sorted(md_data)]
+        for md in metadata_list:
+            md.retrieve(meta_str=md_data[md.resource])
+            self.assertTrue(md._has_changed)
+        # each resource is compared with its own saved metadata
+        for md in metadata_list:
+            md.retrieve(meta_str=md_data[md.resource])
+            self.assertFalse(md._has_changed)
+        self.assertThat(cfn_helper.Metadata.last_metadata_path +
+                        '.resource2',
+                        ttm.FileContains(json.dumps(md_data['resource2'],
+                                                    sort_keys=True)))
+
+    def test_metadata_retrieve_digest(self):
+        md_data = {"AWS::CloudFormation::Init": {"config": {
+            "files": {"/tmp/foo": {"content": "bar"}},
+            "packages": {"yum": {"httpd": []}}}}}
+        md_str = json.dumps(md_data, sort_keys=True)
+
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+        digest_name = last_file.name + '.digest'
+
+        # a cache saved without a digest, with keys in a different order
+        with open(last_file.name, 'w') as f:
+            f.write('{"AWS::CloudFormation::Init": {"config": {'
+                    '"packages": {"yum": {"httpd": []}}, '
+                    '"files": {"/tmp/foo": {"content": "bar"}}}}}')
+        md = cfn_helper.Metadata('teststack', None)
+        md.retrieve(meta_str=md_str, last_path=last_file.name)
+        self.assertFalse(md._has_changed)
+        # the digest is written on first use, so the next run does not
+        # read the saved metadata again
+        self.assertThat(digest_name, ttm.FileContains(
+            cfn_helper.metadata_digest(md_data)))
+        reads = []
+        load_last = md._load_last
+        self.patch(md, '_load_last',
+                   lambda path: reads.append(path) or load_last(path))
+        md.retrieve(meta_str=md_str, last_path=last_file.name)
+        self.assertFalse(md._has_changed)
+        self.assertEqual([], reads)
+
+        md_data['AWS::CloudFormation::Init']['config']['files'] = {}
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        self.assertTrue(md._has_changed)
+        self.assertThat(last_file.name, ttm.FileContains(
+            json.dumps(md_data, sort_keys=True)))
+        self.assertThat(digest_name, ttm.FileContains(
+            cfn_helper.metadata_digest(md_data)))
+
+        # only the digest is compared, and the cache is not rewritten
+        with open(last_file.name, 'w') as f:
+            f.write('not even json')
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        self.assertFalse(md._has_changed)
+        self.assertThat(last_file.name, ttm.FileContains('not even json'))
+
     def test_is_valid_metadata(self):
         md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
             "/tmp/foo": {"content": "bar"}}}}}
@@ -624,6 +2003,300 @@ class TestMetadataRetrieve(testtools.TestCase):
         finally:
             m.UnsetStubs()
 
+    def _serve_metadata(self, md_data, honour_etag):
+        requests = []
+        served = {'md_data': md_data}
+
+        def handler(request):
+            body = json.dumps({
+                'DescribeStackResourceResponse': {
+                    'DescribeStackResourceResult': {
+                        'StackResourceDetail': {
+                            'Metadata': served['md_data']}}}})
+            if_none_match = request.headers.get('If-None-Match')
+            requests.append(if_none_match)
+            if not honour_etag:
+                return 200, {}, body
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            if if_none_match == etag:
+                return 304, {}, ''
+            return 200, {'ETag': etag}, body
+
+        server = FakeHTTPServer(handler)
+        self.addCleanup(server.stop)
+        self.addCleanup(cfn_helper.connection_pool.clear)
+        self.patch(cfn.CloudFormationConnection, 'DefaultRegionEndpoint',
+                   '127.0.0.1')
+        self.patch(cfn_helper, 'metadata_server_port',
+                   lambda datafile: server.port)
+        return requests, served
+
+    def _count_json_loads(self):
+        loads = []
+        real_loads = json.loads
+
+        def counting_loads(s, *args, **kwargs):
+            loads.append(s)
+            return real_loads(s, *args, **kwargs)
+        self.patch(cfn_helper.json, 'loads', counting_loads)
+        return loads
+
+    def _check_conditional_retrieve(self, honour_etag):
+        md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
+            "/tmp/foo": {"content": "bar"}}}}}
+        requests, served = self._serve_metadata(md_data, honour_etag)
+        loads = self._count_json_loads()
+
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+
+        md = cfn_helper.Metadata('teststack', 'resource1',
+                                 access_key='foo', secret_key='bar')
+        md.retrieve(last_path=last_file.name, conditional=True)
+        self.assertEqual(1, len(loads))
+        self.assertTrue(md._has_changed)
+        self.assertDictEqual(md_data, md._metadata)
+        md.cfn_hup([])
+
+        # unchanged: nothing is decoded and the cache file is not rewritten
+        os.remove(last_file.name)
+        md.retrieve(last_path=last_file.name, conditional=True)
+        self.assertEqual(1, len(loads))
+        self.assertFalse(md._has_changed)
+        self.assertDictEqual(md_data, md._metadata)
+        self.assertFalse(os.path.exists(last_file.name))
+        md.cfn_hup([])
+
+        new_md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
+            "/tmp/foo": {"content": "baz"}}}}}
+        served['md_data'] = new_md_data
+        md.retrieve(last_path=last_file.name, conditional=True)
+        self.assertEqual(2, len(loads))
+        self.assertTrue(md._has_changed)
+        self.assertDictEqual(new_md_data, md._metadata)
+        return requests
+
+    def test_conditional_retrieve_etag(self):
+        requests = self._check_conditional_retrieve(honour_etag=True)
+        self.assertEqual(3, len(requests))
+        self.assertIsNone(requests[0])
+        self.assertIsNotNone(requests[1])
+        self.assertEqual(requests[1], requests[2])
+
+    def test_conditional_retrieve_no_etag(self):
+        requests = self._check_conditional_retrieve(honour_etag=False)
+        self.assertEqual([None, None, None], requests)
+
+    def test_metadata_server_port_reread(self):
+        with tempfile.NamedTemporaryFile() as server_file:
+            pass
+        self.patch(cfn_helper.Metadata, 'metadata_server_file',
+                   server_file.name)
+        reads = []
+        real_port = cfn_helper.metadata_server_port
+        self.patch(cfn_helper, 'metadata_server_port',
+                   lambda datafile: reads.append(datafile) or
+                   real_port(datafile))
+
+        md = cfn_helper.Metadata('teststack', 'resource1')
+        self.assertEqual(md.DEFAULT_PORT, md._get_port())
+        with open(server_file.name, 'w') as f:
+            f.write('http://127.0.0.1:8001')
+        self.assertEqual(8001, md._get_port())
+        self.assertEqual(8001, md._get_port())
+        self.assertEqual(2, len(reads))
+
+        # a resident cfn-hup sees the server move
+        with open(server_file.name, 'w') as f:
+            f.write('http://127.0.0.1:8002')
+        os.utime(server_file.name, (0, 0))
+        self.assertEqual(8002, md._get_port())
+
+    def test_conditional_retrieve_fallback(self):
+        md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
+            "/tmp/foo": {"content": "bar"}}}}}
+        requests, served = self._serve_metadata(md_data, honour_etag=True)
+
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+
+        md = cfn_helper.Metadata('teststack', 'resource1',
+                                 access_key='foo', secret_key='bar')
+        md.retrieve(last_path=last_file.name, conditional=True)
+
+        # the server is unreachable, so the local copy is used
+        local_md_data = {"AWS::CloudFormation::Init": {"config": {}}}
+        with open(last_file.name, 'w') as f:
+            f.write(json.dumps(local_md_data))
+
+        def unavailable():
+            raise cfn_helper.MetadataServerConnectionError('unavailable')
+        self.patch(md, '_get_credentials', unavailable)
+        md.retrieve(last_path=last_file.name, conditional=True)
+        self.assertDictEqual(local_md_data, md._metadata)
+
+        # once it is back, its metadata replaces the local copy
+        del md._get_credentials
+        md.retrieve(last_path=last_file.name, conditional=True)
+        self.assertDictEqual(md_data, md._metadata)
+        self.assertEqual([None, None], requests)
+
+    def test_cfn_hup_changed_paths(self):
+        init = "AWS::CloudFormation::Init"
+        md_data = {init: {"config": {
+            "files": {"/tmp/foo": {"content": "bar"}}}}}
+
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+
+        md = cfn_helper.Metadata('teststack', 'resource1')
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        self.assertEqual(['Resources.resource1.Metadata'],
+                         md.changed_paths())
+
+        md_data[init]["config"]["commands"] = {"test": {"command": "true"}}
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        self.assertEqual(
+            ['Resources.resource1.Metadata.AWS::CloudFormation::Init.'
+             'config.commands'], md.changed_paths())
+
+        m = mox.Mox()
+        hook = m.CreateMock(cfn_helper.Hook)
+        hook.event('post.update', 'resource1', 'resource1',
+                   md.changed_paths())
+        m.ReplayAll()
+        md.cfn_hup([hook])
+        m.VerifyAll()
+
+    def test_cfn_init_journal(self):
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+        with tempfile.NamedTemporaryFile() as journal_file:
+            pass
+
+        commands_run = []
+
+        def apply_commands(handler):
+            commands_run.append(handler.commands)
+            handler.failed = len(commands_run) == 1
+        self.patch(cfn_helper.CommandsHandler, 'apply_commands',
+                   apply_commands)
+
+        with tempfile.NamedTemporaryFile(mode='w+') as foo_file:
+            md_data = {"AWS::CloudFormation::Init": {"config": {
+                "files": {foo_file.name: {"content": "bar"}},
+                "commands": {"test": {"command": "/bin/test"}}}}}
+            config = md_data["AWS::CloudFormation::Init"]["config"]
+
+            md = cfn_helper.Metadata('teststack', None)
+            md.retrieve(meta_str=md_data, last_path=last_file.name)
+            md.cfn_init(journal=cfn_helper.ConfigJournal(journal_file.name))
+            self.assertThat(foo_file.name, ttm.FileContains('bar'))
+            self.assertEqual(1, len(commands_run))
+
+            journal = cfn_helper.ConfigJournal(journal_file.name)
+            self.assertTrue(journal.is_current(
+                'config', 'files', config['files']))
+            self.assertTrue(journal.is_current('config', 'packages', None))
+            self.assertFalse(journal.is_current(
+                'config', 'commands', config['commands']))
+
+            # an unchanged section is skipped, a failed one is retried
+            # files are replaced, so empty the file now at the path
+            open(foo_file.name, 'w').close()
+            md = cfn_helper.Metadata('teststack', None)
+            md.retrieve(meta_str=md_data, last_path=last_file.name)
+            md.cfn_init(journal=journal)
+            self.assertThat(foo_file.name, ttm.FileContains(''))
+            self.assertEqual(2, len(commands_run))
+            self.assertTrue(journal.is_current(
+                'config', 'commands', config['commands']))
+
+            config['files'][foo_file.name]['content'] = 'baz'
+            md = cfn_helper.Metadata('teststack', None)
+            md.retrieve(meta_str=md_data, last_path=last_file.name)
+            md.cfn_init(journal=journal)
+            self.assertThat(foo_file.name, ttm.FileContains('baz'))
+            self.assertEqual(2, len(commands_run))
+
+    def test_cfn_init_journal_failed_commands(self):
+        with tempfile.NamedTemporaryFile() as journal_file:
+            pass
+
+        statuses = {'groupadd': 9, 'useradd': 6,
+                    '/sbin/chkconfig': 0, '/sbin/service': 1}
+
+        def run(command, *args, **kwargs):
+            command._status = statuses[command.command_str.split()[0]]
+            return command
+        self.patch(cfn_helper.CommandRunner, 'run', run)
+
+        md_data = {"AWS::CloudFormation::Init": {"config": {
+            "groups": {"group1": {}},
+            "users": {"user1": {"groups": ["nogroup"]}},
+            "services": {"sysvinit": {"httpd": {
+                "enabled": "true", "ensureRunning": "true"}}}}}}
+        config = md_data["AWS::CloudFormation::Init"]["config"]
+        md = cfn_helper.Metadata('teststack', None)
+        md.retrieve(meta_str=md_data)
+        journal = cfn_helper.ConfigJournal(journal_file.name)
+        md.cfn_init(journal=journal)
+        # the group already exists, but the user could not be added and
+        # the service did not start
+        self.assertTrue(journal.is_current('config', 'groups',
+                                           config['groups']))
+        self.assertFalse(journal.is_current('config', 'users',
+                                            config['users']))
+        self.assertFalse(journal.is_current('config', 'services',
+                                            config['services']))
+
+    def test_cfn_init_journal_failed_download(self):
+        with tempfile.NamedTemporaryFile() as last_file:
+            pass
+        with tempfile.NamedTemporaryFile() as journal_file:
+            pass
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        dest = os.path.join(tmpdir, 'foo')
+        downloads = []
+
+        class FakeDownloader(object):
+            available = False
+
+            def download(self, url, path, checksum=None):
+                downloads.append(url)
+                if not self.available:
+                    raise cfn_helper.DownloadError('%s not found' % url)
+                with open(path, 'w') as f:
+                    f.write('foo')
+
+            def fetch(self, url, path):
+                self.download(url, path)
+                return path
+
+        fake = FakeDownloader()
+        self.patch(cfn_helper, 'get_downloader', lambda: fake)
+        md_data = {"AWS::CloudFormation::Init": {"config": {"files": {
+            dest: {"source": "http://example.com/foo"}}}}}
+        files = md_data["AWS::CloudFormation::Init"]["config"]["files"]
+        journal = cfn_helper.ConfigJournal(journal_file.name)
+
+        md = cfn_helper.Metadata('teststack', None)
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        md.cfn_init(journal=journal)
+        self.assertFalse(os.path.exists(dest))
+        self.assertFalse(journal.is_current('config', 'files', files))
+
+        # the failed section is retried by the next incremental run
+        fake.available = True
+        del downloads[:]
+        md = cfn_helper.Metadata('teststack', None)
+        md.retrieve(meta_str=md_data, last_path=last_file.name)
+        md.cfn_init(journal=journal)
+        self.assertEqual(['http://example.com/foo'], downloads)
+        self.assertThat(dest, ttm.FileContains('foo'))
+        self.assertTrue(journal.is_current('config', 'files', files))
+
     def test_cfn_init(self):
 
         with tempfile.NamedTemporaryFile() as last_file:
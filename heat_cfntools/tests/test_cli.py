@@ -0,0 +1,116 @@
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import logging
+import mox
+import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import testtools
+
+from heat_cfntools.cfntools import cfn_helper
+from heat_cfntools.cfntools import cli
+from heat_cfntools.tests.test_cfn_helper import FakePOpen
+from heat_cfntools.tests.test_cfn_helper import ROOT_SHELL
+
+
+class TestCli(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCli, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.patch(cli, 'log_dir', self.tmpdir)
+        self.patch(logging, 'basicConfig', lambda **kwargs: None)
+        self.patch(cli.LOG, 'handlers', [])
+
+    def _fake_tools(self):
+        calls = []
+        self.patch(cli, 'tools', {
+            'cfn-init': lambda argv: calls.append(('cfn-init', argv)),
+            'cfn-signal': lambda argv: calls.append(('cfn-signal', argv)) or 3,
+        })
+        return calls
+
+    def test_main_dispatch(self):
+        calls = self._fake_tools()
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.assertEqual(None, cli.main(['/opt/aws/bin/cfn-init', '-s', 'x']))
+        self.assertEqual(3, cli.main(['/usr/bin/cfn-tools', 'cfn-signal',
+                                      'http://foo']))
+        self.assertEqual(2, cli.main(['/usr/bin/cfn-tools', 'cfn-bogus']))
+        self.assertEqual(2, cli.main(['/usr/bin/cfn-tools']))
+        self.assertEqual([('cfn-init', ['-s', 'x']),
+                          ('cfn-signal', ['http://foo'])], calls)
+
+    def test_run_tool_system_exit(self):
+        # argument errors exit through argparse
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.assertEqual(2, cli.run_tool(['cfn-signal', '--bogus']))
+
+    def test_in_process_tools(self):
+        self.assertEqual(['cfn-init', 'cfn-signal'],
+                         sorted(cfn_helper.in_process_tools))
+
+    def test_log_to_file_once(self):
+        cli.log_to_file('cfn-test')
+        cli.log_to_file('cfn-test')
+        self.assertEqual(1, len(cli.LOG.handlers))
+        cli.LOG.handlers[0].close()
+
+    def test_signal(self):
+        m = mox.Mox()
+        m.StubOutWithMock(subprocess, 'Popen')
+        self.addCleanup(m.UnsetStubs)
+        self.patch(os, 'geteuid', lambda: 0)
+        body = {"Status": "FAILURE", "Reason": "Configuration Complete",
+                "UniqueId": "00000",
+                "Data": "Application has completed configuration."}
+        subprocess.Popen(
+            [ROOT_SHELL, '-c',
+             "curl -X PUT -H 'Content-Type:' --data-binary '%s' "
+             "\"http://foo/bar\"" % json.dumps(body)],
+            cwd=None, env=None, stderr=-1, stdout=-1).AndReturn(
+                FakePOpen(returncode=7))
+        m.ReplayAll()
+
+        self.assertEqual(7, cli.signal_main(['-e', '1', 'http://foo/bar']))
+        m.VerifyAll()
+        for handler in cli.LOG.handlers:
+            handler.close()
+
+    def test_init_restores_yum_cache_ttl(self):
+        runs = []
+
+        class FakeMetadata(object):
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def retrieve(self):
+                pass
+
+            def cfn_init(self, journal=None):
+                runs.append(cfn_helper.RpmHelper.cache_ttl)
+
+        self.patch(cfn_helper, 'Metadata', FakeMetadata)
+        ttl = cfn_helper.RpmHelper.cache_ttl
+        self.assertEqual(0, cli.init_main(['--yum-cache-ttl', '60']))
+        self.assertEqual(0, cli.init_main([]))
+        self.assertEqual([60, ttl], runs)
+        self.assertEqual(ttl, cfn_helper.RpmHelper.cache_ttl)
+        for handler in cli.LOG.handlers:
+            handler.close()
@@ -46,5 +46,6 @@ setuptools.setup(
         'bin/cfn-init',
         'bin/cfn-push-stats',
         'bin/cfn-signal',
-        'bin/cfn-create-aws-symlinks'],
+        'bin/cfn-create-aws-symlinks',
+        'bin/cfn-tools'],
     py_modules=[])
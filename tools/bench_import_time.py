@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Start-up benchmark: time a fresh interpreter importing cfn_helper,
+against an empty interpreter, and list any heavy modules the import
+pulls in.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+RUNS = 20
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+HEAVY = ('boto', 'rpmUtils', 'yum', 'multiprocessing')
+
+
+def best(code):
+    times = []
+    for i in range(RUNS):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], cwd=ROOT)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    base = best('pass')
+    cfn = best('import heat_cfntools.cfntools.cfn_helper')
+    print 'empty interpreter    %8.1f ms' % (base * 1000)
+    print 'import cfn_helper    %8.1f ms (+%.1f ms)' % (
+        cfn * 1000, (cfn - base) * 1000)
+
+    out = subprocess.Popen(
+        [sys.executable, '-c',
+         'import sys\n'
+         'import heat_cfntools.cfntools.cfn_helper\n'
+         'print "\\n".join(sys.modules)\n'],
+        cwd=ROOT, stdout=subprocess.PIPE).communicate()[0]
+    loaded = [m for m in HEAVY if m in out.split()]
+    if loaded:
+        print 'heavy modules loaded at import: %s' % ', '.join(loaded)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
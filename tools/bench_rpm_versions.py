@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Micro-benchmark of RPM version sorting: the cached sort keys of
+RpmHelper.newest_rpm_version against sorting with rpmUtils'
+compareVerOnly, when rpmUtils is installed.
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from heat_cfntools.cfntools.cfn_helper import RpmHelper
+
+try:
+    import rpmUtils.miscutils as rpmutils
+except ImportError:
+    rpmutils = None
+
+REPEAT = 5
+NUMBER = 20
+
+
+def make_versions(count):
+    rand = random.Random(42)
+    versions = []
+    for i in range(count):
+        version = '%d.%d.%d' % (rand.randint(0, 3), rand.randint(0, 20),
+                                rand.randint(0, 99))
+        if rand.random() < 0.8:
+            version += '-%d.fc%d' % (rand.randint(1, 9), rand.randint(16, 20))
+        if rand.random() < 0.1:
+            version = '%d:%s' % (rand.randint(1, 2), version)
+        versions.append(version)
+    return versions
+
+
+def best(stmt):
+    return min(timeit.repeat(stmt, repeat=REPEAT, number=NUMBER)) / NUMBER
+
+
+def report(name, seconds):
+    print '%-32s %10.3f ms' % (name, seconds * 1000)
+
+
+def main():
+    for count in (10, 100, 1000):
+        versions = make_versions(count)
+        print '%d versions' % count
+
+        if rpmutils is not None:
+            report('rpmUtils compareVerOnly sort',
+                   best(lambda: sorted(versions, rpmutils.compareVerOnly,
+                                       reverse=True)[0]))
+        else:
+            print '  (rpmUtils not installed, skipping comparison)'
+
+        def cold():
+            RpmHelper._version_keys.clear()
+            RpmHelper.newest_rpm_version(versions)
+        report('newest_rpm_version (cold)', best(cold))
+        report('newest_rpm_version (cached)',
+               best(lambda: RpmHelper.newest_rpm_version(versions)))
+        print
+
+
+if __name__ == '__main__':
+    main()